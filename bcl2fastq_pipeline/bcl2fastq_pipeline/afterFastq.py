@@ -2,28 +2,36 @@
 This file includes code that actually runs FastQC and any other tools after the fastq files have actually been made. This uses a pool of workers to process each request.
 """
 
-import json
+import importlib
 import logging
 import multiprocessing as mp
 import os
 import shutil
 import subprocess
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
 import yaml
 
-from configmaker.configmaker import SEQUENCERS
-
+from bcl2fastq_pipeline import (
+    harvest,
+    interop,
+    libprep,
+    qc_cache,
+    stats_json,
+    tracing,
+    workspace,
+)
 from bcl2fastq_pipeline.config import PipelineConfig
+from bcl2fastq_pipeline.manifest import get_manifest
 
 log = logging.getLogger(__name__)
 
 
 def get_read_geometry(run_dir):
-    with (run_dir / "Stats" / "Stats.json").open() as stats_file:
-        stats_json = json.load(stats_file)
-    lane_info = stats_json["ReadInfosForLanes"][0].get("ReadInfos", None)
+    read_infos = stats_json.load(run_dir).read_infos
+    lane_info = read_infos[0].get("ReadInfos", None) if read_infos else None
     if not lane_info:
         return "Read geometry could not be automatically determined."
     R1 = None
@@ -55,20 +63,22 @@ def to_dirs(files):
 
 
 def get_sequencer(run_id):
-    return SEQUENCERS.get(run_id.split("_")[1], "Sequencer could not be automatically determined.")
+    # configmaker is imported here, the parsers of this module do not need it
+    sequencers = importlib.import_module("configmaker.configmaker").SEQUENCERS
+    return sequencers.get(run_id.split("_")[1], "Sequencer could not be automatically determined.")
 
 
 def md5sum_worker(cfg):
-    project_dirs = get_project_dirs(cfg)
-    pnames = get_project_names(project_dirs)
-    for p in pnames:
+    manifest = get_manifest(cfg)
+    for p in manifest.project_names():
         md_path = Path(f"md5sum_{p}_fastq.txt")
-        if not (cfg.output_path / md_path).exists():
-            cmd = (
-                f"find {p} -type f -name '*.fastq.gz' | parallel -j 5 md5sum > md5sum_{p}_fastq.txt"
-            )
-            log.info(f"[md5sum_worker] Processing {cfg.output_path}/{p}")
-            subprocess.check_call(cmd, shell=True, cwd=cfg.output_path)
+        with tracing.span("md5sum_worker", project=p) as span:
+            if not (cfg.output_path / md_path).exists():
+                cmd = f"find {p} -type f -name '*.fastq.gz' | parallel -j 5 md5sum > md5sum_{p}_fastq.txt"
+                log.info(f"[md5sum_worker] Processing {cfg.output_path}/{p}")
+                tracing.check_call(cmd, name="md5sum", shell=True, cwd=cfg.output_path)
+                span.set(files=len(manifest.project_files(p)), bytes=manifest.project_size(p))
+            manifest.update_md5(cfg.output_path / md_path)
 
 
 def md5sum_archive(archive_path: Path):
@@ -85,10 +95,41 @@ def md5sum_archive_worker(cfg):
     output_path = Path(cfg.output_path)
     archives = list(output_path.glob("*.7za"))
 
-    with mp.Pool() as pool:
-        pool.map(md5sum_archive, archives)
+    with tracing.span("md5sum_archive", files=len(archives)) as span:
+        span.set(bytes=sum(a.stat().st_size for a in archives))
+        with mp.Pool() as pool:
+            pool.map(md5sum_archive, archives)
+
+
+def interop_csvs(cfg):
+    """
+    Write Stats/interop_summary.csv and Stats/interop_index-summary.csv.
+
+    The InterOp binaries are read natively; the Illumina command line tools are
+    only used for formats the native reader does not know.
+    """
+    cwd = cfg.output_path / "Stats"
+    summary = None
+    outputs = {
+        "interop_summary": (interop.write_summary_csv, cwd / "interop_summary.csv"),
+        "interop_index-summary": (
+            interop.write_index_summary_csv,
+            cwd / "interop_index-summary.csv",
+        ),
+    }
+    for tool, (writer, out_f) in outputs.items():
+        log.info(f"[multiqc_worker] {tool} on {cfg.output_path}")
+        try:
+            summary = summary or interop.RunSummary.from_run(cfg.output_path)
+            writer(cfg.output_path, out_f, summary)
+            continue
+        except interop.InterOpFormatError as e:
+            log.warning(f"[multiqc_worker] Native InterOp reader failed ({e}), running {tool}")
+        cmd = f"{tool} {cfg.output_path} --csv=1 > {out_f}"
+        tracing.check_call(cmd, name=tool, shell=True, cwd=cwd)
 
 
+@tracing.traced()
 def multiqc_stats(cfg):
     cwd = cfg.output_path / "Stats"
 
@@ -100,15 +141,7 @@ def multiqc_stats(cfg):
     )
 
     # Illumina interop
-    out_f = cfg.output_path / "Stats" / "interop_summary.csv"
-    cmd = f"interop_summary {cfg.output_path} --csv=1 > {out_f}"
-    log.info(f"[multiqc_worker] Interop summary on {cfg.output_path}")
-    subprocess.check_call(cmd, shell=True, cwd=cwd)
-
-    out_f = cfg.output_path / "Stats" / "interop_index-summary.csv"
-    cmd = f"interop_index-summary {cfg.output_path} --csv=1 > {out_f}"
-    log.info(f"[multiqc_worker] Interop index summary on {cfg.output_path}")
-    subprocess.check_call(cmd, shell=True, cwd=cwd)
+    interop_csvs(cfg)
 
     in_confs = list(cfg.output_path.glob(".multiqc_config*.yaml"))
     samples_custom_data = dict()
@@ -121,8 +154,7 @@ def multiqc_stats(cfg):
     with in_confs[0].open() as in_conf_fh:
         mqc_conf = yaml.load(in_conf_fh, Loader=yaml.FullLoader)
 
-    pnames = get_project_names(get_project_dirs(cfg))
-    pnames = ", ".join(pnames)
+    pnames = ", ".join(get_manifest(cfg).project_names())
     mqc_conf["title"] = pnames
     mqc_conf["intro_text"] = (
         "This report is generated for projects run at Genomics Core Facility, NTNU, Trondheim. The results are reported per sample."
@@ -154,7 +186,7 @@ def multiqc_stats(cfg):
             cmd = cmd.replace("-m bclconvert", "-m bcl2fastq")
             log.info(f"[multiqc_worker] Running: {cmd}")
 
-    subprocess.check_call(cmd, shell=True, cwd=cwd)
+    tracing.check_call(cmd, name="multiqc", shell=True, cwd=cwd)
 
 
 def generate_password(cfg, prefix: str) -> str:
@@ -180,8 +212,7 @@ def generate_password(cfg, prefix: str) -> str:
 
 
 def archive_worker(cfg):
-    project_dirs = get_project_dirs(cfg)
-    pnames = get_project_names(project_dirs)
+    pnames = get_manifest(cfg).project_names()
     run_date = str(cfg.run.run_id).split("_")[0]
 
     for p in pnames:
@@ -212,12 +243,14 @@ def archive_worker(cfg):
             f"{cfg.output_path}/md5sum_{p}_fastq.txt "
         )
 
-        if cfg.run.libprep and "10X Genomics" in cfg.run.libprep:
+        if cfg.run.libprep_info.is_10x:
             extra = cfg.run.run_id.split("_")[-1][1:]
             cmd += f" {cfg.output_path}/{extra}"
 
         log.info(f"[archive_worker] Zipping {archive_fastq}")
-        subprocess.check_call(cmd, shell=True)
+        with tracing.span("archive", project=p, kind="fastq") as span:
+            tracing.check_call(cmd, name="7za", shell=True)
+            span.set(bytes=archive_fastq.stat().st_size)
 
         # ------------------------------------------------------------------ #
         # Archive pipeline output (QC)
@@ -236,7 +269,9 @@ def archive_worker(cfg):
         cmd = f"7za a -l {opts} {flowdir}/QC_{p}_{run_date}.7za {qc_dir} "
 
         log.info(f"[archive_worker] Archiving QC output → {qc_archive}\n")
-        subprocess.check_call(cmd, shell=True)
+        with tracing.span("archive", project=p, kind="qc") as span:
+            tracing.check_call(cmd, name="7za", shell=True)
+            span.set(bytes=qc_archive.stat().st_size)
 
 
 def get_project_names(dirs):
@@ -250,96 +285,147 @@ def get_project_names(dirs):
 
 def get_project_dirs(cfg):
     """
-    Find project directories under cfg.output_path containing FASTQ files.
+    Project directories under cfg.output_path containing FASTQ files.
 
-    Searches one and two levels deep for *.fastq.gz files,
-    then extracts their parent directories via to_dirs().
+    Read from the run manifest, which is built once by scanning one and two
+    levels deep for *.fastq.gz files.
     """
-    fastq_paths = list(cfg.output_path.glob("*/*.fastq.gz"))
-    fastq_paths += list(cfg.output_path.glob("*/*/*.fastq.gz"))
-    return to_dirs(fastq_paths)
-
-
-def post_workflow(project_id, base_dir, pipeline):
-    run_date = str(base_dir.name).split("_")[0]
-    analysis_dir = Path(os.environ["TMPDIR"]) / f"{project_id}_{run_date}"
-    bfq_dir = analysis_dir / "data" / "tmp" / pipeline / "bfq"
-    odir = base_dir / f"QC_{project_id}" / "bfq"
-    odir.mkdir(parents=True, exist_ok=True)
-
-    shutil.copytree(bfq_dir, odir, symlinks=False, dirs_exist_ok=True)
-
-    # Copy sample info
-    shutil.copy2(
-        analysis_dir / "data" / "tmp" / "sample_info.tsv",
-        base_dir / f"{project_id}_samplesheet.tsv",
-    )
-
-    return True
+    return get_manifest(cfg).project_dirs()
 
 
-def full_align(cfg):
-    # old_wd = Path.cwd()
+def project_weights(manifest, projects):
+    """
+    Relative amount of analysis work per project.
 
-    # os.chdir(os.environ["TMPDIR"])
-    project_names = get_project_names(get_project_dirs(cfg))
+    Half of the weight comes from the share of samples and half from the share
+    of FASTQ bytes, so many small samples and a few large ones both count.
+    """
+    samples = {p: max(1, len(manifest.samples(p))) for p in projects}
+    sizes = {p: max(1, manifest.project_size(p)) for p in projects}
+    tot_samples = sum(samples.values())
+    tot_sizes = sum(sizes.values())
+    return {p: 0.5 * samples[p] / tot_samples + 0.5 * sizes[p] / tot_sizes for p in projects}
+
+
+def align_project(cfg, p, cores):
+    """Set up and run the snakemake analysis of one project, then copy its reports."""
+    manifest = get_manifest(cfg)
+    with tracing.span(
+        "full_align",
+        project=p,
+        cores=cores,
+        samples=len(manifest.samples(p)),
+        files=len(manifest.project_files(p)),
+        bytes=manifest.project_size(p),
+    ):
+        return _align_project(cfg, p, cores)
+
+
+def _align_project(cfg, p, cores):
     run_date = str(cfg.output_path.name).split("_")[0]
-    for p in project_names:
-        analysis_dir = Path(os.environ["TMPDIR"]) / f"{p}_{run_date}"
-        analysis_dir.mkdir(parents=True, exist_ok=True)
-        (analysis_dir / "src").mkdir(parents=True, exist_ok=True)
-        (analysis_dir / "data").mkdir(parents=True, exist_ok=True)
-        log.info(f"Setting up analysis for {analysis_dir}")
-
-        # os.chdir(analysis_dir)
-
-        src = Path("/opt/gcf-workflows")
-        dst = analysis_dir / "src" / "gcf-workflows"
-
-        # copy snakemake pipeline
-        if dst.exists():
-            shutil.rmtree(dst)
-        shutil.copytree(src, dst)
-
-        create_fastq = " --skip-create-fastq-dir" if Path("data/raw/fastq").exists() else ""
-        machine = get_sequencer(cfg.run.run_id)
-        # create config.yaml
-        cmd = f"/opt/conda/bin/python /opt/conda/bin/configmaker.py {cfg.output_path} -p {p} --libkit '{cfg.run.libprep}' --machine '{machine}' {create_fastq}"
-        subprocess.check_call(cmd, shell=True, cwd=analysis_dir)
-
-        # run snakemake pipeline
-        cmd = "snakemake --use-singularity --singularity-prefix $SINGULARITY_CACHEDIR --cores 32 --verbose -p multiqc_report"
-        subprocess.check_call(cmd, shell=True, cwd=analysis_dir)
-
-        # copy report
-        shutil.copy2(
-            analysis_dir / "data" / "tmp" / cfg.run.pipeline / "bfq" / f"multiqc_{p}.html",
-            cfg.output_path / f"multiqc_{p}_{run_date}.html",
-        )
-
-        # if additional html reports exists (single cell), copy
-        extra_html = (analysis_dir / "data" / "tmp" / cfg.run.pipeline / "bfq" / "summaries").glob(
-            "all_samples*.html"
-        )
-        extra_html = list(extra_html)
-        if extra_html:
-            shutil.copy2(
-                extra_html[0], cfg.output_path / f"all_samples_web_summary_{p}_{run_date}.html"
-            )
-
-        # Copy sample info
-        shutil.copy2(
+    analysis_dir = Path(os.environ["TMPDIR"]) / f"{p}_{run_date}"
+    analysis_dir.mkdir(parents=True, exist_ok=True)
+    (analysis_dir / "src").mkdir(parents=True, exist_ok=True)
+    (analysis_dir / "data").mkdir(parents=True, exist_ok=True)
+    log.info(f"Setting up analysis for {analysis_dir}")
+
+    # link the snakemake pipeline
+    workspace.provision(analysis_dir)
+
+    machine = get_sequencer(cfg.run.run_id)
+    # create config.yaml
+    argv = [str(cfg.output_path), "-p", p, "--libkit", cfg.run.libprep, "--machine", machine]
+    if (analysis_dir / "data" / "raw" / "fastq").exists():
+        argv.append("--skip-create-fastq-dir")
+    workspace.run_configmaker(analysis_dir, argv)
+
+    # reuse per-sample QC output of identical fastq files from earlier runs
+    try:
+        qc_cache.restore(cfg, p, analysis_dir)
+    except Exception:
+        log.exception(f"[full_align] Could not restore cached QC output for {p}")
+
+    # run snakemake pipeline
+    log.info(f"[full_align] Running snakemake for {p} on {cores} cores")
+    cmd = f"snakemake --use-singularity --singularity-prefix $SINGULARITY_CACHEDIR --cores {cores} --verbose -p multiqc_report"
+    tracing.check_call(cmd, name="snakemake", shell=True, cwd=analysis_dir)
+
+    try:
+        qc_cache.store(cfg, p, analysis_dir)
+    except Exception:
+        log.exception(f"[full_align] Could not cache QC output for {p}")
+
+    harvest_project(cfg, p, analysis_dir)
+    return p
+
+
+def harvest_project(cfg, p, analysis_dir):
+    """Copy the report, sample info and multiqc config of an analysis to the run output."""
+    run_date = str(cfg.output_path.name).split("_")[0]
+    bfq_dir = analysis_dir / "data" / "tmp" / cfg.run.pipeline / "bfq"
+    pairs = [
+        (bfq_dir / f"multiqc_{p}.html", cfg.output_path / f"multiqc_{p}_{run_date}.html"),
+        (
             analysis_dir / "data" / "tmp" / "sample_info.tsv",
             cfg.output_path / f"{p}_samplesheet.tsv",
+        ),
+        (bfq_dir / ".multiqc_config.yaml", cfg.output_path / f".multiqc_config_{p}.yaml"),
+    ]
+    # if additional html reports exists (single cell), copy
+    extra_html = list((bfq_dir / "summaries").glob("all_samples*.html"))
+    if extra_html:
+        pairs.append(
+            (extra_html[0], cfg.output_path / f"all_samples_web_summary_{p}_{run_date}.html")
         )
+    report = harvest.harvest_files(pairs)
+    get_manifest(cfg).record(f"harvest/{p}", report.as_dict() | {"src": str(analysis_dir)})
 
-        # copy mqc_config
-        shutil.copy2(
-            analysis_dir / "data" / "tmp" / cfg.run.pipeline / "bfq" / ".multiqc_config.yaml",
-            cfg.output_path / f".multiqc_config_{p}.yaml",
-        )
 
-    # os.chdir(old_wd)
+def full_align(cfg):
+    """
+    Run the snakemake analysis of all projects concurrently.
+
+    The cores in [System] analysis_cores (default 32) are shared out by
+    project weight: the largest project starts first with its share of the
+    free cores (keeping analysis_min_cores, default 4, free for each waiting
+    project where possible), smaller projects are started with what is left.
+    A running snakemake cannot grow, so cores freed by a finished project go
+    to the projects still waiting. Reports are copied as soon as each project is
+    done. If a project fails, no new projects are started and the first
+    error is raised after the running ones have finished.
+    """
+    manifest = get_manifest(cfg)
+    project_names = manifest.project_names()
+    total = int(cfg.static.system.get("analysis_cores", 32))
+    min_cores = min(total, int(cfg.static.system.get("analysis_min_cores", 4)))
+
+    weights = project_weights(manifest, project_names)
+    pending = sorted(project_names, key=lambda p: weights[p], reverse=True)
+    running = {}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, len(pending))) as pool:
+        while running or (pending and not errors):
+            free = total - sum(running.values())
+            while pending and not errors and (free >= min_cores or not running):
+                p = pending.pop(0)
+                share = round(free * weights[p] / (weights[p] + sum(weights[q] for q in pending)))
+                # leave room for the projects still waiting, but never less than half
+                share = min(share, max(free - min_cores * len(pending), free // 2))
+                cores = min(free, max(min_cores, share))
+                running[pool.submit(tracing.propagate(align_project), cfg, p, cores)] = cores
+                free -= cores
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                running.pop(fut)
+                try:
+                    log.info(f"[full_align] Analysis finished for {fut.result()}")
+                except Exception as e:
+                    log.exception("[full_align] Analysis failed")
+                    errors.append(e)
+
+    if errors:
+        raise errors[0]
     (cfg.output_path / "analysis.made").write_text("")
     return True
 
@@ -355,7 +441,7 @@ def postMakeSteps():
     """
     cfg = PipelineConfig.get()
 
-    cfg.run.set_pipeline_from_yaml(Path("/opt/gcf-workflows/libprep.config"))
+    cfg.run.set_pipeline_from_yaml(libprep.LIBPREP_CONFIG)
 
     # md5sum fastqs
     md5sum_worker(cfg)
@@ -0,0 +1,123 @@
+"""
+Planning of email attachments within a size budget.
+
+The reports attached to the finished email (multiqc, web summaries,
+sequencer stats) can together be larger than the mail server accepts. The
+planner decides what is attached so the message always fits:
+
+    1. everything as-is, if that fits the budget
+    2. otherwise one zip archive with all files (HTML compresses well)
+    3. otherwise the zip without the files that compress to the largest
+       size, dropped one at a time until it fits; these are listed in the
+       email instead, with their size and location
+
+The budget applies to the base64 encoded size. The files are never read
+into memory: the zip is written from disk, and the outbox streams the
+attachments into the spooled message.
+"""
+
+from __future__ import annotations
+
+import html
+import logging
+import zipfile
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUDGET_MB = 20
+# room for the message body and MIME headers
+BODY_RESERVE = 512 * 1024
+# local file header + central directory entry, without the file name
+ZIP_ENTRY_OVERHEAD = 30 + 46
+ZIP_END_OVERHEAD = 22
+
+
+def encoded_size(n: int) -> int:
+    """Size of n bytes after base64 encoding with 76 character lines."""
+    b64 = 4 * ((n + 2) // 3)
+    return b64 + b64 // 76 + 1
+
+
+@dataclass
+class AttachmentPlan:
+    """
+    What to attach to a message.
+
+    Attributes
+    ----------
+    attach : list[tuple[Path, str]]
+        (path, attachment file name) pairs, for Outbox.enqueue().
+    omitted : list[Path]
+        Files that did not fit the budget.
+    zip_path : Path | None
+        The zip archive written by the planner, if any.
+    """
+
+    attach: list[tuple[Path, str]] = field(default_factory=list)
+    omitted: list[Path] = field(default_factory=list)
+    zip_path: Path | None = None
+
+    def summary_html(self) -> str:
+        """A note about the compressed and omitted attachments for the email body."""
+        msg = ""
+        if self.zip_path is not None:
+            msg += "\n<br>The reports are attached as a zip archive to keep the email small.\n<br>"
+        if self.omitted:
+            msg += "<strong>Reports too large to attach</strong> (available on the server):\n<br>"
+            for f in self.omitted:
+                size_mb = f.stat().st_size / 1024**2
+                msg += f"{html.escape(str(f))} ({size_mb:.1f} MB)\n<br>"
+        return msg
+
+
+def _write_zip(zip_path: Path, files: list[Path]) -> dict[str, int]:
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        for f in files:
+            zf.write(f, f.name)
+        return {i.filename: i.compress_size for i in zf.infolist()}
+
+
+def _zip_size(files: list[Path], compressed: dict[str, int]) -> int:
+    return ZIP_END_OVERHEAD + sum(
+        compressed[f.name] + ZIP_ENTRY_OVERHEAD + 2 * len(f.name.encode()) for f in files
+    )
+
+
+def plan(
+    files: list[Path], budget: int, workdir: Path, zip_name: str = "reports.zip"
+) -> AttachmentPlan:
+    """
+    Choose how to attach files within budget bytes (of encoded message size).
+
+    A zip archive, if needed, is written to workdir/zip_name.
+    """
+    files = [Path(f) for f in files]
+    sizes = {f: f.stat().st_size for f in files}
+    room = budget - BODY_RESERVE
+    if sum(encoded_size(s) for s in sizes.values()) <= room:
+        return AttachmentPlan(attach=[(f, f.name) for f in files])
+
+    zip_path = Path(workdir) / zip_name
+    compressed = _write_zip(zip_path, files)
+    keep = sorted(files, key=lambda f: compressed[f.name])
+    omitted = []
+    while keep and encoded_size(_zip_size(keep, compressed)) > room:
+        omitted.append(keep.pop())
+
+    if omitted:
+        log.warning(
+            f"[attachments] {len(omitted)} reports exceed the budget of "
+            f"{budget / 1024**2:.1f} MB: {', '.join(f.name for f in omitted)}"
+        )
+        if not keep:
+            zip_path.unlink()
+            return AttachmentPlan(omitted=omitted)
+        _write_zip(zip_path, keep)
+    log.info(
+        f"[attachments] Zipped {len(keep)} reports: {sum(sizes[f] for f in keep) / 1024**2:.1f} MB "
+        f"→ {zip_path.stat().st_size / 1024**2:.1f} MB"
+    )
+    return AttachmentPlan(attach=[(zip_path, zip_name)], omitted=omitted, zip_path=zip_path)
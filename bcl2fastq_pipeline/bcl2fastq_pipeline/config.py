@@ -32,20 +32,30 @@ PosixPath('/mnt/data/output')
 
 from __future__ import annotations
 
-import csv
+import importlib
 import logging
-import re
 
 from configparser import ConfigParser
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import ClassVar
+from typing import TYPE_CHECKING, ClassVar
 
-import yaml
+if TYPE_CHECKING:
+    from bcl2fastq_pipeline import libprep
 
 log = logging.getLogger(__name__)
 
 
+def _lazy(name: str):
+    """
+    Import name on first use.
+
+    The flowcell_manager CLI only needs the [Paths] of the config, so loading it
+    must not pull in pandas (inputs) and yaml (libprep).
+    """
+    return importlib.import_module(name)
+
+
 # --------------------------------------------------------------------------- #
 # Data classes
 # --------------------------------------------------------------------------- #
@@ -63,6 +73,7 @@ class Paths:
         log_dir
         report_dir
         analysis_dir
+        scratch_dir    (optional, local disk for prefetched run folders)
     """
 
     ekista_base_dir: Path
@@ -72,6 +83,7 @@ class Paths:
     manager_dir: Path
     report_dir: Path | None = None
     analysis_dir: Path | None = None
+    scratch_dir: Path | None = None
 
 
 @dataclass(frozen=True)
@@ -217,47 +229,28 @@ class RunContext:
             QIAseq miRNA SE:
               workflow: mirna
 
-        This method:
+        The lookup goes through the libprep registry, which only parses the
+        file again when it changes:
           • Matches self.libprep (case-insensitive) against YAML keys
           • If not found, also tries "<libprep> SE" and "<libprep> PE"
-          • Extracts the inner "workflow" value if present
-          • Sets self.pipeline to that workflow name or "UNKNOWN" if not found
+          • Sets self.pipeline to the "workflow" value or "UNKNOWN" if not found
         """
         if not self.libprep:
             self.pipeline = None
             return
 
-        yaml_file = Path(yaml_path)
-        if not yaml_file.exists():
-            log.warning(f"[RunContext] libprep.config not found: {yaml_file}")
-            self.pipeline = "UNKNOWN"
-            return
-
         try:
-            with yaml_file.open(encoding="utf-8") as fh:
-                data = yaml.safe_load(fh) or {}
+            info = _lazy("bcl2fastq_pipeline.libprep").lookup(self.libprep, yaml_path)
         except Exception as e:
-            log.exception(f"[RunContext] Failed to parse {yaml_file}: {e}")
+            log.exception(f"[RunContext] Failed to parse {yaml_path}: {e}")
             self.pipeline = "UNKNOWN"
             return
+        self.pipeline = info.workflow or "UNKNOWN"
 
-        libprep_clean = self.libprep.strip().lower()
-        candidates = [libprep_clean, f"{libprep_clean} se", f"{libprep_clean} pe"]
-
-        workflow = None
-
-        for key, value in (data or {}).items():
-            if not isinstance(value, dict):
-                continue  # skip malformed entries
-
-            key_norm = str(key).strip().lower()
-            if key_norm in candidates:
-                wf = value.get("workflow")
-                if wf:
-                    workflow = wf
-                    break
-
-        self.pipeline = str(workflow).strip() if workflow else "UNKNOWN"
+    @property
+    def libprep_info(self) -> libprep.Libprep:
+        """Registry entry of the run's libprep."""
+        return _lazy("bcl2fastq_pipeline.libprep").lookup(self.libprep)
 
     def reset(self) -> None:
         """Clear run-specific information."""
@@ -329,6 +322,7 @@ class PipelineConfig:
             report_dir=Path(p.get("reportDir", "/mnt/reports")),
             analysis_dir=Path(p.get("analysisDir", "/mnt/analysis")),
             manager_dir=Path(p.get("manager_dir", "/mnt/manager")),
+            scratch_dir=Path(p["scratchDir"]) if p.get("scratchDir") else None,
         )
 
         static = StaticConfig(
@@ -420,7 +414,7 @@ class PipelineConfig:
         out_path.parent.mkdir(parents=True, exist_ok=True)
 
         with out_path.open("w", encoding="utf-8") as fh:
-            yaml.safe_dump(cfg_dict, fh, sort_keys=False, default_flow_style=False)
+            _lazy("yaml").safe_dump(cfg_dict, fh, sort_keys=False, default_flow_style=False)
 
 
 # --------------------------------------------------------------------------- #
@@ -431,11 +425,12 @@ def parse_custom_options(sample_sheet_path: Path) -> tuple[dict[str, str], Path]
     Parse the [CustomOptions] section from a SampleSheet.csv.
 
     Handles messy CSV formatting from Excel edits, trailing commas, etc.
+    The sample sheet is parsed once by inputs.sample_sheet() and served from
+    its cache until the file changes.
 
     Parsing strategy:
-        - Scan lines until '[CustomOptions]' (case-insensitive)
-        - Read subsequent lines until EOF or another '[Section]'
-        - Split each line by comma and take only first two fields
+        - Split the sheet into its '[Section]' blocks
+        - Take the first two fields of every row of [CustomOptions] (case-insensitive)
         - Ignore empty or malformed rows
 
     Parameters
@@ -448,29 +443,5 @@ def parse_custom_options(sample_sheet_path: Path) -> tuple[dict[str, str], Path]
     (dict, Path)
         Dictionary of key-value pairs and the same Path for reference.
     """
-    custom_opts: dict[str, str] = {}
-    in_custom_section = False
-    section_pattern = re.compile(r"^\s*\[.*\]\s*$")
-
-    with sample_sheet_path.open(newline="", encoding="utf-8-sig") as fh:
-        reader = csv.reader(fh)
-        for row in reader:
-            if not row:
-                continue
-            line = ",".join(row).strip()
-            if not in_custom_section:
-                if re.match(r"^\s*\[CustomOptions\]\s*$", line, flags=re.IGNORECASE):
-                    in_custom_section = True
-                continue
-
-            # Exit when encountering another section header
-            if section_pattern.match(line) and not line.lower().startswith("[customoptions]"):
-                break
-
-            # Parse first two columns if present
-            key = (row[0] or "").strip()
-            value = (row[1] if len(row) > 1 else "").strip()
-            if key:
-                custom_opts[key] = value
-
-    return custom_opts, sample_sheet_path
+    sheet = _lazy("bcl2fastq_pipeline.inputs").sample_sheet(sample_sheet_path)
+    return dict(sheet.custom), sample_sheet_path
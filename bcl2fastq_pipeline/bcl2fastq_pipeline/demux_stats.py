@@ -0,0 +1,148 @@
+"""
+Read counts from the demultiplexing statistics.
+
+Two formats are supported:
+
+    • ``Stats/DemultiplexingStats.xml`` from bcl2fastq, read with
+      ``iterparse`` so only the element being parsed is kept in memory
+    • ``Demultiplex_Stats.csv`` from bcl-convert (in ``Reports/``, or in
+      ``Stats/`` on older runs), aggregated with pandas
+
+Both are reduced to the same per-sample, per-lane counts, for any number of
+lanes.
+"""
+
+from __future__ import annotations
+
+import logging
+import xml.etree.ElementTree as ET
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+CSV_CANDIDATES = (
+    Path("Reports") / "Demultiplex_Stats.csv",
+    Path("Stats") / "Demultiplex_Stats.csv",
+)
+XML_PATH = Path("Stats") / "DemultiplexingStats.xml"
+
+
+@dataclass
+class DemuxStats:
+    """
+    Reads per sample and lane as reported by the demultiplexer.
+
+    Attributes
+    ----------
+    samples : dict[tuple[str, str, int], int]
+        Reads keyed by (project, sample, lane), without the undetermined reads.
+    undetermined : dict[int, int]
+        Undetermined reads per lane.
+    totals : dict[int, int]
+        All clusters passing filter per lane, undetermined included.
+    """
+
+    samples: dict[tuple[str, str, int], int] = field(default_factory=dict)
+    undetermined: dict[int, int] = field(default_factory=dict)
+    totals: dict[int, int] = field(default_factory=dict)
+
+    def lanes(self) -> list[int]:
+        return sorted(self.totals)
+
+    def sample_counts(self) -> dict[tuple[str, str], int]:
+        """Reads per (project, sample), summed over the lanes."""
+        counts: dict[tuple[str, str], int] = {}
+        for (project, sample, _), n in self.samples.items():
+            counts[(project, sample)] = counts.get((project, sample), 0) + n
+        return counts
+
+    def undetermined_table(self) -> pd.DataFrame:
+        """Percentage of undetermined reads per lane, as shown in the emails."""
+        lanes = [lane for lane in self.lanes() if self.totals[lane]]
+        undeter = [100 * self.undetermined.get(lane, 0) / self.totals[lane] for lane in lanes]
+        return pd.DataFrame.from_dict({"Lane": lanes, "% Undetermined": undeter}).round(2)
+
+
+def read_xml(path: Path) -> DemuxStats:
+    """
+    Stream a bcl2fastq DemultiplexingStats.xml.
+
+    Only the BarcodeCount of the "all" barcode of each sample is used. The
+    "all" sample of the "default" project holds the undetermined reads and the
+    "all" sample of the "all" project the lane totals.
+    """
+    stats = DemuxStats()
+    project = sample = barcode = None
+    lane = 0
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        tag = elem.tag
+        if event == "start":
+            if tag == "Project":
+                project = elem.get("name")
+            elif tag == "Sample":
+                sample = elem.get("name")
+            elif tag == "Barcode":
+                barcode = elem.get("name")
+            elif tag == "Lane":
+                lane = int(elem.get("number"))
+            continue
+
+        if tag == "BarcodeCount" and barcode == "all":
+            n = int(elem.text)
+            if project == "all":
+                if sample == "all":
+                    stats.totals[lane] = stats.totals.get(lane, 0) + n
+            elif project == "default":
+                if sample == "all":
+                    stats.undetermined[lane] = stats.undetermined.get(lane, 0) + n
+            elif sample != "all":
+                key = (project, sample, lane)
+                stats.samples[key] = stats.samples.get(key, 0) + n
+        elif tag in ("Lane", "Barcode", "Sample", "Project"):
+            elem.clear()
+    return stats
+
+
+def read_csv(path: Path) -> DemuxStats:
+    """Aggregate a bcl-convert Demultiplex_Stats.csv."""
+    df = pd.read_csv(
+        path,
+        usecols=lambda c: c in ("Lane", "SampleID", "Sample_Project", "# Reads"),
+        dtype={"SampleID": str, "Sample_Project": str},
+    )
+    if "Sample_Project" not in df:
+        df["Sample_Project"] = ""
+    df["Sample_Project"] = df["Sample_Project"].fillna("")
+    df["# Reads"] = df["# Reads"].astype("int64")
+
+    is_undetermined = df["SampleID"] == "Undetermined"
+    samples = df[~is_undetermined].groupby(["Sample_Project", "SampleID", "Lane"])["# Reads"].sum()
+    undetermined = df[is_undetermined].groupby("Lane")["# Reads"].sum()
+    totals = df.groupby("Lane")["# Reads"].sum()
+    return DemuxStats(
+        samples={(p, s, int(lane)): int(n) for (p, s, lane), n in samples.items()},
+        undetermined={int(lane): int(n) for lane, n in undetermined.items()},
+        totals={int(lane): int(n) for lane, n in totals.items()},
+    )
+
+
+def load(output_path: Path) -> DemuxStats:
+    """
+    Read the demultiplexing statistics of a run, preferring the bcl-convert CSV.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the run has neither statistics file.
+    """
+    output_path = Path(output_path)
+    for rel in CSV_CANDIDATES:
+        if (output_path / rel).exists():
+            return read_csv(output_path / rel)
+    if (output_path / XML_PATH).exists():
+        return read_xml(output_path / XML_PATH)
+    raise FileNotFoundError(f"No demultiplexing statistics in {output_path}")
@@ -13,9 +13,8 @@ from pathlib import Path
 
 import flowcell_manager.flowcell_manager as fm
 
-import bcl2fastq_pipeline.afterFastq as af
-
 from bcl2fastq_pipeline.config import PipelineConfig, parse_custom_options
+from bcl2fastq_pipeline.manifest import get_manifest
 
 log = logging.getLogger(__name__)
 
@@ -146,8 +145,7 @@ def copy_sample_sub_form(instrument_path, output_path):
 def markFinished():
     cfg = PipelineConfig.get()
     (cfg.output_path / "fastq.made").write_text("")
-    project_dirs = af.get_project_dirs(cfg)
-    project_names = af.get_project_names(project_dirs)
+    project_names = get_manifest(cfg).project_names()
     now = dt.datetime.now()
     for gcf in project_names:
         fm.add_flowcell(
@@ -0,0 +1,324 @@
+"""
+Harvesting of analysis output from TMPDIR into the run output directory.
+
+Files are transferred with the cheapest method that works:
+
+    1. rename           – only when move=True and both paths are on the same filesystem
+    2. reflink          – copy-on-write clone (FICLONE), on btrfs/XFS and friends
+    3. hardlink         – same filesystem without reflink support, unless link=False
+    4. copy             – across devices; large files are copied in parallel chunks
+
+Symlinks in the source are dereferenced, like ``shutil.copytree(symlinks=False)``:
+their target is transferred but never renamed or removed, with move=True
+only the link itself goes.
+What was harvested, and how, can be recorded in the run manifest.
+
+A StreamingMover moves the files of a tree that is still being written, in a
+thread, as soon as they are complete: when no process has them open and they
+have not changed for a while.
+"""
+
+from __future__ import annotations
+
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+
+from collections import Counter
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+FICLONE = 0x40049409
+CHUNK_SIZE = 64 * 1024 * 1024
+THREADS = 8
+
+
+@dataclass
+class HarvestReport:
+    """Summary of one harvest, suitable for RunManifest.record()."""
+
+    src: str
+    dst: str
+    files: int = 0
+    bytes: int = 0
+    methods: Counter = field(default_factory=Counter)
+
+    def add(self, method: str, size: int) -> None:
+        self.files += 1
+        self.bytes += size
+        self.methods[method] += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "src": self.src,
+            "dst": self.dst,
+            "files": self.files,
+            "bytes": self.bytes,
+            "methods": dict(self.methods),
+        }
+
+
+def _reflink(src: Path, dst: Path) -> None:
+    with src.open("rb") as fin, dst.open("wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except OSError:
+            fout.close()
+            dst.unlink()
+            raise
+    shutil.copystat(src, dst)
+
+
+def _copy_chunk(src: Path, dst: Path, offset: int, length: int) -> None:
+    fin = os.open(src, os.O_RDONLY)
+    fout = os.open(dst, os.O_WRONLY)
+    try:
+        end = offset + length
+        while offset < end:
+            buf = os.pread(fin, min(8 * 1024 * 1024, end - offset), offset)
+            if not buf:
+                break
+            offset += os.pwrite(fout, buf, offset)
+    finally:
+        os.close(fin)
+        os.close(fout)
+
+
+def _chunked_copy(src: Path, dst: Path, size: int, pool: ThreadPoolExecutor | None) -> None:
+    if pool is None or size <= CHUNK_SIZE:
+        shutil.copy2(src, dst)
+        return
+    with dst.open("wb") as fh:
+        fh.truncate(size)
+    chunks = [(off, min(CHUNK_SIZE, size - off)) for off in range(0, size, CHUNK_SIZE)]
+    for fut in [pool.submit(_copy_chunk, src, dst, off, n) for off, n in chunks]:
+        fut.result()
+    shutil.copystat(src, dst)
+
+
+def harvest_file(
+    src: Path,
+    dst: Path,
+    move: bool = False,
+    pool: ThreadPoolExecutor | None = None,
+    link: bool = True,
+) -> str:
+    """
+    Transfer one file and return the method used.
+
+    An existing dst is replaced. pool is used for chunked copies of large files.
+    With link=False src and dst never share an inode, so that rewriting one in
+    place cannot change the other.
+    """
+    src = Path(src)
+    dst = Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+
+    # the content comes from the target of a symlink, only src itself is renamed or removed
+    data = src.resolve()
+    st = data.stat()
+    method = None
+    if st.st_dev == dst.parent.stat().st_dev:
+        if move and not src.is_symlink():
+            try:
+                os.replace(src, dst)
+                return "rename"
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        try:
+            _reflink(data, dst)
+            method = "reflink"
+        except OSError:
+            pass
+        if method is None and link:
+            try:
+                os.link(data, dst)
+                method = "hardlink"
+            except OSError:
+                pass
+
+    if method is None:
+        _chunked_copy(data, dst, st.st_size, pool)
+        method = "copy"
+    if move:
+        # the link itself when src is a symlink
+        src.unlink()
+    return method
+
+
+def harvest_tree(src_dir: Path, dst_dir: Path, move: bool = False) -> HarvestReport:
+    """Transfer all files below src_dir into dst_dir, keeping the relative layout."""
+    src_dir = Path(src_dir)
+    dst_dir = Path(dst_dir)
+    report = HarvestReport(src=str(src_dir), dst=str(dst_dir))
+    files = [p for p in src_dir.rglob("*") if p.is_file()]
+    with ThreadPoolExecutor(THREADS) as chunk_pool, ThreadPoolExecutor(THREADS) as file_pool:
+        futs = {
+            file_pool.submit(harvest_file, f, dst_dir / f.relative_to(src_dir), move, chunk_pool): f
+            for f in files
+        }
+        for fut, f in futs.items():
+            report.add(fut.result(), (dst_dir / f.relative_to(src_dir)).stat().st_size)
+    log.info(
+        f"[harvest] {report.files} files ({report.bytes / 1024**3:.2f} GiB) "
+        f"{src_dir} → {dst_dir}: {dict(report.methods)}"
+    )
+    return report
+
+
+def harvest_files(
+    pairs: list[tuple[Path, Path]], move: bool = False, link: bool = True
+) -> HarvestReport:
+    """Transfer individual (src, dst) pairs, see harvest_file()."""
+    report = HarvestReport(src="", dst="")
+    with ThreadPoolExecutor(THREADS) as chunk_pool:
+        for src, dst in pairs:
+            method = harvest_file(src, dst, move, chunk_pool, link)
+            report.add(method, Path(dst).stat().st_size)
+    return report
+
+
+def open_files(below: Path) -> set[Path]:
+    """The files below a directory that any process has open, from /proc/<pid>/fd."""
+    prefix = f"{below}{os.sep}"
+    found = set()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            fds = os.scandir(f"/proc/{pid}/fd")
+        except OSError:
+            continue
+        with fds:
+            for fd in fds:
+                try:
+                    target = os.readlink(fd.path)
+                except OSError:
+                    continue
+                if target.startswith(prefix):
+                    found.add(Path(target))
+    return found
+
+
+def _same_path(rel: Path) -> Path:
+    return rel
+
+
+class StreamingMover:
+    """
+    Move the files of src_dir to dst_dir while they are still being written.
+
+    A file is moved when no process has it open and it has not changed for
+    settle seconds; stop() then moves whatever is left. rename maps the path
+    of a file relative to src_dir to its path relative to dst_dir.
+
+    Files that disappear before they are moved (temporary files of the writer)
+    are skipped. A file that cannot be moved is logged and tried again on the
+    next pass; those still left after stop() are in failed, and src_dir is
+    then kept.
+    """
+
+    def __init__(
+        self,
+        src_dir: Path,
+        dst_dir: Path,
+        rename: Callable[[Path], Path] = _same_path,
+        settle: float = 10.0,
+        interval: float = 5.0,
+    ) -> None:
+        self.src_dir = Path(src_dir)
+        self.dst_dir = Path(dst_dir)
+        self.rename = rename
+        self.settle = settle
+        self.interval = interval
+        self.report = HarvestReport(src=str(src_dir), dst=str(dst_dir))
+        self.moved_early = 0
+        # file -> error, of the files stop() could not move
+        self.failed: dict[Path, str] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="mover", daemon=True)
+
+    def start(self) -> StreamingMover:
+        self._thread.start()
+        return self
+
+    def _move(self, files: list[Path]) -> dict[Path, str]:
+        """Move files, returning those that could not be moved and why."""
+        failed = {}
+        with ThreadPoolExecutor(THREADS) as chunk_pool, ThreadPoolExecutor(THREADS) as file_pool:
+            futs = {}
+            for f in files:
+                dst = self.dst_dir / self.rename(f.relative_to(self.src_dir))
+                futs[file_pool.submit(harvest_file, f, dst, True, chunk_pool)] = (f, dst)
+            for fut, (src, dst) in futs.items():
+                try:
+                    self.report.add(fut.result(), dst.stat().st_size)
+                except FileNotFoundError:
+                    if src.exists():
+                        failed[src] = f"{dst} disappeared"
+                    else:
+                        log.debug(f"[harvest] {src} disappeared before it was moved")
+                except Exception as e:
+                    failed[src] = f"{type(e).__name__}: {e}"
+        for src, error in failed.items():
+            log.warning(f"[harvest] Could not move {src}: {error}")
+        return failed
+
+    def _complete(self) -> list[Path]:
+        busy = open_files(self.src_dir)
+        cutoff = time.time() - self.settle
+        files = []
+        for p in self.src_dir.rglob("*"):
+            try:
+                if p.is_file() and p not in busy and p.stat().st_mtime < cutoff:
+                    files.append(p)
+            except FileNotFoundError:
+                # deleted or renamed by the writer meanwhile
+                continue
+        return files
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                files = self._complete()
+                failed = self._move(files)
+                self.moved_early += len(files) - len(failed)
+            except Exception:
+                # the files are moved by stop() at the latest
+                log.exception(f"[harvest] Moving the files of {self.src_dir} failed")
+
+    def stop(self) -> HarvestReport:
+        """
+        Stop watching, move the remaining files and remove src_dir.
+
+        Never raises, it runs while the writer's own error may be propagating;
+        check failed afterwards.
+        """
+        self._stop.set()
+        self._thread.join()
+        try:
+            self.failed = self._move([p for p in self.src_dir.rglob("*") if p.is_file()])
+        except Exception as e:
+            self.failed = {self.src_dir: f"{type(e).__name__}: {e}"}
+            log.exception(f"[harvest] Moving the files of {self.src_dir} failed")
+        if self.failed:
+            log.error(f"[harvest] {len(self.failed)} files were not moved, kept in {self.src_dir}")
+        else:
+            shutil.rmtree(self.src_dir, ignore_errors=True)
+        log.info(
+            f"[harvest] Streamed {self.report.files} files "
+            f"({self.report.bytes / 1024**3:.2f} GiB) {self.src_dir} → {self.dst_dir}, "
+            f"{self.moved_early} while they were being written: {dict(self.report.methods)}"
+        )
+        return self.report
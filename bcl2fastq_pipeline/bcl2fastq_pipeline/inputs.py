@@ -0,0 +1,202 @@
+"""
+Parse-once cache of the per-run input files.
+
+The sample sheet and the sample submission form of a run are read by several
+modules (findFlowCells, config, misc) on every loop of bfq.py. Both are
+parsed once and kept in memory, keyed by path, size and mtime, so a file is
+only parsed again when it changes:
+
+    • sample_sheet()     – a SampleSheet with all sections, the [CustomOptions]
+                           and the [Data] table
+    • project_samples()  – the samples of one project, as configmaker selects
+                           them from the sample sheet
+    • submission_form()  – the table from configmaker's submission form parser,
+                           also pickled under ``$TMPDIR/.bfq-inputs`` so the
+                           slow openpyxl parse survives restarts
+
+Example
+-------
+>>> sheet = sample_sheet(cfg.run.sample_sheet)
+>>> sheet.custom["Libprep"]
+'Lexogen SENSE mRNA-Seq Library Prep Kit V2 SE'
+>>> len(project_samples(cfg.run.sample_sheet, "GCF-2024-001"))
+48
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+import importlib
+import logging
+import os
+import pickle
+import re
+import threading
+import uuid
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+SECTION = re.compile(r"^\s*\[(?P<name>[^\]]+)\]\s*$")
+DATA_SECTIONS = ("Data", "BCLConvert_Data")
+
+# (kind, resolved path) -> ((size, mtime_ns), parsed value)
+_cache: dict[tuple[str, Path], tuple[tuple[int, int], object]] = {}
+_cache_lock = threading.Lock()
+
+
+def _cached(kind: str, path: Path, loader):
+    path = Path(path).resolve()
+    st = path.stat()
+    stamp = (st.st_size, st.st_mtime_ns)
+    with _cache_lock:
+        hit = _cache.get((kind, path))
+    if hit is not None and hit[0] == stamp:
+        return hit[1]
+    value = loader(path, stamp)
+    with _cache_lock:
+        _cache[(kind, path)] = (stamp, value)
+    return value
+
+
+# --------------------------------------------------------------------------- #
+# Sample sheet
+# --------------------------------------------------------------------------- #
+@dataclass
+class SampleSheet:
+    """
+    A parsed SampleSheet.csv.
+
+    Attributes
+    ----------
+    path : Path
+        The sample sheet.
+    sections : dict[str, list[list[str]]]
+        Raw rows of every ``[Section]``, trailing empty cells removed.
+    custom : dict[str, str]
+        The [CustomOptions] key/value pairs.
+    data : pd.DataFrame
+        The [Data] (or [BCLConvert_Data]) table, all values as strings.
+    """
+
+    path: Path
+    sections: dict[str, list[list[str]]] = field(default_factory=dict)
+    custom: dict[str, str] = field(default_factory=dict)
+    data: pd.DataFrame = field(default_factory=pd.DataFrame)
+
+    @classmethod
+    def parse(cls, path: Path) -> SampleSheet:
+        sheet = cls(path=Path(path))
+        rows: list[list[str]] | None = None
+        with sheet.path.open(newline="", encoding="utf-8-sig") as fh:
+            for row in csv.reader(fh):
+                while row and not row[-1].strip():
+                    row.pop()
+                if not row:
+                    continue
+                m = SECTION.match(row[0]) if len(row) == 1 else None
+                if m:
+                    rows = sheet.sections.setdefault(m["name"].strip(), [])
+                elif rows is not None:
+                    rows.append(row)
+
+        for name, rows in sheet.sections.items():
+            if name.lower() == "customoptions":
+                for row in rows:
+                    key = row[0].strip()
+                    if key:
+                        sheet.custom[key] = (row[1] if len(row) > 1 else "").strip()
+
+        for name in DATA_SECTIONS:
+            rows = sheet.sections.get(name)
+            if rows:
+                header = [c.strip() for c in rows[0]]
+                body = [r + [""] * (len(header) - len(r)) for r in rows[1:]]
+                sheet.data = pd.DataFrame([r[: len(header)] for r in body], columns=header)
+                break
+        return sheet
+
+    def key_values(self, section: str) -> dict[str, str]:
+        """A key/value section such as [Header] or [Settings]."""
+        return {
+            r[0].strip(): (r[1].strip() if len(r) > 1 else "")
+            for r in self.sections.get(section, [])
+        }
+
+    @property
+    def reads(self) -> list[int]:
+        """Cycles per read from the [Reads] section."""
+        return [int(r[0]) for r in self.sections.get("Reads", []) if r[0].strip().isdigit()]
+
+    def projects(self) -> list[str]:
+        if "Sample_Project" not in self.data:
+            return []
+        return sorted(p for p in self.data["Sample_Project"].unique() if p)
+
+
+def sample_sheet(path: Path) -> SampleSheet:
+    """Return the parsed sample sheet, parsing it only if it is new or changed."""
+    return _cached("sample_sheet", path, lambda p, _: SampleSheet.parse(p))
+
+
+def _load_project_samples(path: Path, project: str) -> pd.DataFrame:
+    cm = importlib.import_module("configmaker.configmaker")
+    args = argparse.Namespace(samplesheet=[path], project_id=[project])
+    return cm.get_project_samples_from_samplesheet(args)[0]
+
+
+def project_samples(path: Path, project: str) -> pd.DataFrame:
+    """
+    Return ``configmaker.get_project_samples_from_samplesheet()`` for one project.
+
+    The samples are those configmaker writes to the project's config, so the
+    counts in the emails match the analysis. Selected once per sheet version.
+    """
+    return _cached(
+        f"project_samples:{project}", path, lambda p, _: _load_project_samples(p, project)
+    )
+
+
+# --------------------------------------------------------------------------- #
+# Sample submission form
+# --------------------------------------------------------------------------- #
+def _pickle_path(path: Path, stamp: tuple[int, int]) -> Path:
+    key = hashlib.sha256(f"{path}\0{stamp[0]}\0{stamp[1]}".encode()).hexdigest()
+    return Path(os.environ.get("TMPDIR", "/tmp")) / ".bfq-inputs" / f"{key}.pkl"
+
+
+def _load_submission_form(path: Path, stamp: tuple[int, int]) -> tuple[pd.DataFrame, object]:
+    pkl = _pickle_path(path, stamp)
+    try:
+        with pkl.open("rb") as fh:
+            return pickle.load(fh)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+
+    # imported here so that config, which uses this module, does not pull in configmaker
+    cm = importlib.import_module("configmaker.configmaker")
+    parsed = cm.sample_submission_form_parser(path)
+    try:
+        pkl.parent.mkdir(parents=True, exist_ok=True)
+        tmp = pkl.with_name(f".{pkl.name}.{uuid.uuid4().hex}")
+        with tmp.open("wb") as fh:
+            pickle.dump(parsed, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, pkl)
+    except OSError as e:
+        log.warning(f"[inputs] Could not cache {path}: {e}")
+    return parsed
+
+
+def submission_form(path: Path) -> tuple[pd.DataFrame, object]:
+    """
+    Return ``configmaker.sample_submission_form_parser(path)``, parsed once per file version.
+
+    configmaker is only imported when the form has to be parsed.
+    """
+    return _cached("submission_form", path, _load_submission_form)
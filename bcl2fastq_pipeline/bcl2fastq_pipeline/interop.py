@@ -0,0 +1,454 @@
+"""
+Native reader for the Illumina InterOp binary metric files.
+
+Replaces the ``interop_summary`` / ``interop_index-summary`` round trip: the
+``.bin`` files in ``<run>/InterOp`` are memory-mapped straight into NumPy
+structured arrays and aggregated with pandas. Supported formats:
+
+    • TileMetricsOut.bin   v2, v3
+    • QMetricsOut.bin      v4, v5, v6, v7
+    • IndexMetricsOut.bin  v1, v2
+
+From these the lane and read metrics of the summary email are computed
+(density, % PF, reads, % PhiX aligned, %>=Q30), and the CSV files that the
+multiqc interop module expects can be written. Unsupported versions raise
+InterOpFormatError, so callers can fall back to the Illumina tools.
+
+Example
+-------
+>>> summary = RunSummary.from_run(cfg.output_path)
+>>> summary.lane_table()
+   Lane  Density   Total Reads (M)  % Cluster PF  % PhiX  R1 %>=Q30  R2 %>=Q30
+0     1  2461.12           1662.39         80.87    0.91      93.79      91.32
+>>> write_summary_csv(cfg.output_path, cfg.output_path / "Stats" / "interop_summary.csv")
+"""
+
+from __future__ import annotations
+
+import struct
+import xml.etree.ElementTree as ET
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+SUMMARY_COLUMNS = [
+    "Lane",
+    "Surface",
+    "Tiles",
+    "Density",
+    "Cluster PF",
+    "Legacy Phasing/Prephasing Rate",
+    "Phasing slope/offset",
+    "Prephasing slope/offset",
+    "Reads",
+    "Reads PF",
+    "%>=Q30",
+    "Yield",
+    "Cycles Error",
+    "Aligned",
+    "Error",
+    "Error (35)",
+    "Error (75)",
+    "Error (100)",
+    "Intensity C1",
+]
+
+
+class InterOpFormatError(ValueError):
+    """Raised for missing, truncated or unsupported InterOp files."""
+
+
+@dataclass(frozen=True)
+class ReadInfo:
+    number: int
+    cycles: int
+    is_index: bool
+    first_cycle: int
+
+    @property
+    def last_cycle(self) -> int:
+        return self.first_cycle + self.cycles - 1
+
+
+def read_run_info(run_dir: Path) -> list[ReadInfo]:
+    """Reads of the run, in sequencing order, from RunInfo.xml."""
+    root = ET.parse(Path(run_dir) / "RunInfo.xml").getroot()
+    reads = []
+    first = 1
+    for r in sorted(root.iter("Read"), key=lambda r: int(r.get("Number"))):
+        cycles = int(r.get("NumCycles"))
+        reads.append(
+            ReadInfo(
+                number=int(r.get("Number")),
+                cycles=cycles,
+                is_index=r.get("IsIndexedRead", "N").upper() == "Y",
+                first_cycle=first,
+            )
+        )
+        first += cycles
+    return reads
+
+
+# --------------------------------------------------------------------------- #
+# Binary readers
+# --------------------------------------------------------------------------- #
+def _map_records(path: Path, dtype: np.dtype, offset: int) -> np.ndarray:
+    """Memory-map the fixed-size records that follow a header of offset bytes."""
+    size = path.stat().st_size - offset
+    if size < 0 or size % dtype.itemsize:
+        raise InterOpFormatError(f"{path}: size does not match record size {dtype.itemsize}")
+    if size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(size // dtype.itemsize,))
+
+
+def _header(path: Path, n: int) -> bytes:
+    if not path.exists():
+        raise InterOpFormatError(f"{path} not found")
+    with path.open("rb") as fh:
+        head = fh.read(n)
+    if len(head) < n:
+        raise InterOpFormatError(f"{path}: truncated header")
+    return head
+
+
+def read_tile_metrics(path: Path) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Per-tile cluster metrics and per-tile, per-read % aligned to PhiX.
+
+    Returns
+    -------
+    tiles : DataFrame
+        lane, tile, density (K/mm²), clusters, clusters_pf
+    aligned : DataFrame
+        lane, tile, read, aligned (%)
+    """
+    path = Path(path)
+    version, record_size = _header(path, 2)
+    if version == 2:
+        dt = np.dtype([("lane", "<u2"), ("tile", "<u2"), ("code", "<u2"), ("value", "<f4")])
+        if record_size != dt.itemsize:
+            raise InterOpFormatError(f"{path}: unexpected record size {record_size}")
+        rec = pd.DataFrame(_map_records(path, dt, 2))
+        wide = rec[rec["code"] < 200].pivot_table(
+            index=["lane", "tile"], columns="code", values="value", aggfunc="last"
+        )
+        tiles = pd.DataFrame(
+            {
+                "density": wide.get(100, np.nan) / 1000,
+                "clusters": wide.get(102, np.nan),
+                "clusters_pf": wide.get(103, np.nan),
+            }
+        ).reset_index()
+        al = rec[(rec["code"] >= 300) & (rec["code"] < 400)]
+        aligned = pd.DataFrame(
+            {
+                "lane": al["lane"],
+                "tile": al["tile"],
+                "read": al["code"] - 299,
+                "aligned": al["value"],
+            }
+        )
+    elif version == 3:
+        (area,) = struct.unpack("<f", _header(path, 6)[2:])
+        dt = np.dtype(
+            [("lane", "<u2"), ("tile", "<u4"), ("code", "u1"), ("v1", "<f4"), ("v2", "<f4")]
+        )
+        if record_size != dt.itemsize:
+            raise InterOpFormatError(f"{path}: unexpected record size {record_size}")
+        rec = _map_records(path, dt, 6)
+        t = rec[rec["code"] == ord("t")]
+        tiles = (
+            pd.DataFrame(
+                {
+                    "lane": t["lane"],
+                    "tile": t["tile"],
+                    "clusters": t["v1"],
+                    "clusters_pf": t["v2"],
+                }
+            )
+            .groupby(["lane", "tile"], as_index=False)
+            .last()
+        )
+        tiles["density"] = tiles["clusters"] / area / 1000 if area > 0 else np.nan
+        r = rec[rec["code"] == ord("r")]
+        aligned = pd.DataFrame(
+            {
+                "lane": r["lane"],
+                "tile": r["tile"],
+                # the read number is stored as uint32 in the first value slot
+                "read": r["v1"].view("<u4"),
+                "aligned": r["v2"],
+            }
+        )
+    else:
+        raise InterOpFormatError(f"{path}: unsupported TileMetrics version {version}")
+
+    return tiles, aligned.reset_index(drop=True)
+
+
+def read_q_metrics(path: Path) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Q-score histograms per lane, tile and cycle.
+
+    Returns
+    -------
+    keys : ndarray
+        Structured array with lane, tile and cycle.
+    hist : ndarray
+        2D array (records x bins) of cluster counts.
+    qscores : ndarray
+        The Q-score represented by each histogram bin.
+    """
+    path = Path(path)
+    version, record_size = _header(path, 2)
+    offset = 2
+    qscores = np.arange(1, 51)
+    if version not in (4, 5, 6, 7):
+        raise InterOpFormatError(f"{path}: unsupported QMetrics version {version}")
+    if version >= 5:
+        has_bins = _header(path, 3)[2]
+        offset = 3
+        if has_bins:
+            nbins = _header(path, 4)[3]
+            bins = np.frombuffer(_header(path, 4 + 3 * nbins)[4:], dtype="u1").reshape(3, nbins)
+            offset = 4 + 3 * nbins
+            if version >= 6:
+                # v6+ records hold one count per bin, labelled by the remapped Q-score
+                qscores = bins[2].astype(int)
+    tile_t = "<u4" if version == 7 else "<u2"
+    nvals = len(qscores)
+    dt = np.dtype([("lane", "<u2"), ("tile", tile_t), ("cycle", "<u2"), ("hist", "<u4", nvals)])
+    if record_size != dt.itemsize:
+        raise InterOpFormatError(f"{path}: unexpected record size {record_size}")
+    rec = _map_records(path, dt, offset)
+    return rec[["lane", "tile", "cycle"]], rec["hist"], qscores
+
+
+@dataclass
+class IndexCount:
+    lane: int
+    tile: int
+    read: int
+    index: str
+    count: int
+    sample: str
+    project: str
+
+
+def read_index_metrics(path: Path) -> list[IndexCount]:
+    """Per-tile cluster counts of every index, from IndexMetricsOut.bin (variable-length records)."""
+    path = Path(path)
+    data = memoryview(path.read_bytes()) if path.exists() else memoryview(b"")
+    if not data:
+        raise InterOpFormatError(f"{path} not found or empty")
+    version = data[0]
+    if version not in (1, 2):
+        raise InterOpFormatError(f"{path}: unsupported IndexMetrics version {version}")
+    head = struct.Struct("<HHH" if version == 1 else "<HIH")
+    u16 = struct.Struct("<H")
+    u32 = struct.Struct("<I")
+    out = []
+    pos = 1
+    try:
+        while pos < len(data):
+            lane, tile, read = head.unpack_from(data, pos)
+            pos += head.size
+            strings = []
+            for _ in range(3):
+                (n,) = u16.unpack_from(data, pos)
+                strings.append(bytes(data[pos + 2 : pos + 2 + n]).decode())
+                pos += 2 + n
+                if len(strings) == 1:
+                    (count,) = u32.unpack_from(data, pos)
+                    pos += 4
+            out.append(IndexCount(lane, tile, read, strings[0], count, strings[1], strings[2]))
+    except struct.error as e:
+        raise InterOpFormatError(f"{path}: truncated record at byte {pos}") from e
+    return out
+
+
+# --------------------------------------------------------------------------- #
+# Summaries
+# --------------------------------------------------------------------------- #
+def _mean_sd(values: pd.Series) -> tuple[float, float]:
+    values = values.dropna()
+    if values.empty:
+        return np.nan, np.nan
+    return float(values.mean()), float(values.std(ddof=0))
+
+
+@dataclass
+class RunSummary:
+    """Lane and read level metrics of a run, as reported by interop_summary."""
+
+    reads: list[ReadInfo]
+    tiles: pd.DataFrame
+    aligned: pd.DataFrame
+    q30: pd.DataFrame
+    lanes: list[int] = field(default_factory=list)
+
+    @classmethod
+    def from_run(cls, run_dir: Path) -> RunSummary:
+        run_dir = Path(run_dir)
+        interop = run_dir / "InterOp"
+        reads = read_run_info(run_dir)
+        tiles, aligned = read_tile_metrics(interop / "TileMetricsOut.bin")
+        keys, hist, qscores = read_q_metrics(interop / "QMetricsOut.bin")
+
+        # Q30 over usable cycles: the last cycle of every read is excluded, like interop_summary
+        cycle = keys["cycle"]
+        read_of_cycle = np.zeros(int(cycle.max(initial=0)) + 1, dtype=int)
+        for r in reads:
+            read_of_cycle[r.first_cycle : r.last_cycle] = r.number
+        rnum = read_of_cycle[np.minimum(cycle, len(read_of_cycle) - 1)]
+        # column by column, so the histogram is never copied as a whole
+        n_q30 = np.zeros(len(cycle), dtype=np.int64)
+        n_total = np.zeros(len(cycle), dtype=np.int64)
+        for i, q in enumerate(qscores):
+            n_total += hist[:, i]
+            if q >= 30:
+                n_q30 += hist[:, i]
+        q30 = pd.DataFrame({"lane": keys["lane"], "read": rnum, "q30": n_q30, "total": n_total})
+        q30 = q30[q30["read"] > 0].groupby(["lane", "read"], as_index=False).sum()
+        lanes = sorted(int(x) for x in tiles["lane"].unique())
+        return cls(reads=reads, tiles=tiles, aligned=aligned, q30=q30, lanes=lanes)
+
+    def lane_read_metrics(self, read: ReadInfo) -> pd.DataFrame:
+        """One row per lane with the metrics interop_summary prints for this read."""
+        rows = []
+        for lane in self.lanes:
+            t = self.tiles[self.tiles["lane"] == lane]
+            pf_pct = 100 * t["clusters_pf"] / t["clusters"]
+            al = self.aligned[
+                (self.aligned["lane"] == lane) & (self.aligned["read"] == read.number)
+            ]
+            q = self.q30[(self.q30["lane"] == lane) & (self.q30["read"] == read.number)]
+            q30 = 100 * q["q30"].sum() / q["total"].sum() if q["total"].sum() else np.nan
+            density = _mean_sd(t["density"])
+            cluster_pf = _mean_sd(pf_pct)
+            aligned = _mean_sd(al["aligned"])
+            rows.append(
+                {
+                    "Lane": lane,
+                    "Tiles": len(t),
+                    "Density": density,
+                    "Cluster PF": cluster_pf,
+                    "Reads": t["clusters"].sum() / 1e6,
+                    "Reads PF": t["clusters_pf"].sum() / 1e6,
+                    "%>=Q30": q30,
+                    "Yield": t["clusters_pf"].sum() * read.cycles / 1e9,
+                    "Aligned": aligned,
+                }
+            )
+        return pd.DataFrame(rows)
+
+    def lane_table(self) -> pd.DataFrame:
+        """The flowcell metrics table of the summary email."""
+        data_reads = [r for r in self.reads if not r.is_index]
+        first = self.lane_read_metrics(data_reads[0])
+        df = pd.DataFrame(
+            {
+                "Lane": first["Lane"],
+                "Density": [v[0] for v in first["Density"]],
+                " Total Reads (M)": first["Reads"],
+                "% Cluster PF": [v[0] for v in first["Cluster PF"]],
+                "% PhiX": [v[0] for v in first["Aligned"]],
+                "%>=Q30": first["%>=Q30"],
+            }
+        )
+        if len(data_reads) > 1:
+            df["R2 %>=Q30"] = self.lane_read_metrics(data_reads[1])["%>=Q30"]
+            df = df.rename(columns={"%>=Q30": "R1 %>=Q30"})
+        return df.round(2)
+
+
+# --------------------------------------------------------------------------- #
+# CSV writers (interop_summary --csv=1 / interop_index-summary --csv=1 layout)
+# --------------------------------------------------------------------------- #
+def _fmt(v) -> str:
+    if isinstance(v, tuple):
+        return f"{_fmt(v[0])} +/- {_fmt(v[1])}"
+    if isinstance(v, float):
+        return "nan" if np.isnan(v) else f"{v:.2f}"
+    return str(v)
+
+
+def write_summary_csv(run_dir: Path, out_f: Path, summary: RunSummary | None = None) -> None:
+    """Write an interop_summary compatible CSV for the run."""
+    run_dir = Path(run_dir)
+    summary = summary or RunSummary.from_run(run_dir)
+    nan = float("nan")
+    per_read = {r.number: summary.lane_read_metrics(r) for r in summary.reads}
+
+    lines = ["# Version: bfq-interop", run_dir.resolve().name, ""]
+    lines.append("Level,Yield,Projected Yield,Aligned,Error Rate,Intensity C1,%>=Q30")
+    for r in summary.reads:
+        m = per_read[r.number]
+        q = summary.q30[summary.q30["read"] == r.number]
+        q30 = 100 * q["q30"].sum() / q["total"].sum() if q["total"].sum() else nan
+        al = pd.Series([v[0] for v in m["Aligned"]], dtype=float).mean()
+        name = f"Read {r.number}{' (I)' if r.is_index else ''}"
+        yld = m["Yield"].sum()
+        lines.append(",".join(_fmt(v) for v in (name, yld, yld, al, nan, nan, q30)))
+    lines.append("")
+
+    for r in summary.reads:
+        lines.append(f"Read {r.number}{' (I)' if r.is_index else ''}")
+        lines.append(",".join(SUMMARY_COLUMNS))
+        for row in per_read[r.number].to_dict("records"):
+            values = {c: nan for c in SUMMARY_COLUMNS} | row
+            values["Surface"] = "-"
+            values["Cycles Error"] = "0"
+            lines.append(",".join(_fmt(values[c]) for c in SUMMARY_COLUMNS))
+    last = summary.reads[-1].last_cycle if summary.reads else 0
+    lines += [f"Extracted: {last}", f"Called: {last}", f"Scored: {last}", ""]
+    Path(out_f).write_text("\n".join(lines))
+
+
+def write_index_summary_csv(run_dir: Path, out_f: Path, summary: RunSummary | None = None) -> None:
+    """Write an interop_index-summary compatible CSV for the run."""
+    run_dir = Path(run_dir)
+    summary = summary or RunSummary.from_run(run_dir)
+    counts = pd.DataFrame(
+        [vars(c) for c in read_index_metrics(run_dir / "InterOp" / "IndexMetricsOut.bin")],
+        columns=["lane", "tile", "read", "index", "count", "sample", "project"],
+    )
+
+    lines = ["# Version: bfq-interop"]
+    for lane in summary.lanes:
+        t = summary.tiles[summary.tiles["lane"] == lane]
+        total, pf = t["clusters"].sum(), t["clusters_pf"].sum()
+        c = counts[counts["lane"] == lane]
+        per_sample = c.groupby(["sample", "project", "index"], as_index=False, sort=False)[
+            "count"
+        ].sum()
+        pct = 100 * per_sample["count"] / pf if pf else per_sample["count"] * np.nan
+        identified = 100 * per_sample["count"].sum() / pf if pf else np.nan
+        cv = pct.std(ddof=0) / pct.mean() if len(pct) and pct.mean() else np.nan
+        lines.append(f"Lane {lane}")
+        lines.append("Total Reads,PF Reads,% Read Identified (PF),CV,Min,Max")
+        lines.append(
+            ",".join(
+                _fmt(v)
+                for v in (
+                    int(total),
+                    int(pf),
+                    float(identified),
+                    float(cv),
+                    float(pct.min()) if len(pct) else np.nan,
+                    float(pct.max()) if len(pct) else np.nan,
+                )
+            )
+        )
+        lines.append(
+            "Index Number,Sample Id,Project,Index 1 (I7),Index 2 (I5),% Read Identified (PF)"
+        )
+        for i, (row, p) in enumerate(zip(per_sample.to_dict("records"), pct), 1):
+            i7, _, i5 = row["index"].replace("+", "-").partition("-")
+            lines.append(",".join([str(i), row["sample"], row["project"], i7, i5, _fmt(float(p))]))
+    lines.append("")
+    Path(out_f).write_text("\n".join(lines))
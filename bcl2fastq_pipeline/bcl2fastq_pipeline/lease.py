@@ -0,0 +1,252 @@
+"""
+Leases on shared work, so that several bfq instances can serve the same instruments.
+
+A lease is a file in [Paths]->manager_dir/leases that only one instance can
+create, opened with O_CREAT | O_EXCL:
+
+    • the file holds the owner (host:pid), a random token and the time it was taken
+    • while it is held, a heartbeat thread touches the file every ttl/4 seconds
+    • a lease that was not touched for [System]->lease_ttl seconds (default 600)
+      belongs to an instance that died, and is taken over by the next one asking
+    • takeovers go through a second O_EXCL file, <name>.takeover, so that two
+      instances never both take the same stale lease
+    • an owner whose lease was taken over notices it at its next heartbeat and
+      marks the lease lost
+
+bfq.py leases each run before it touches the run's output directory, and
+flowcell_manager holds a short lease on flowcells.processed while it writes it.
+The hosts must share manager_dir and keep their clocks in sync (NTP), as the
+age of a lease is judged from the modification time of its file.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+
+from dataclasses import dataclass
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL = 600.0
+
+
+def instance_id() -> str:
+    """host:pid of this process, the owner written to its leases."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@dataclass
+class Lease:
+    """
+    A lease held by this process.
+
+    Attributes
+    ----------
+    name : str
+        What is leased, e.g. run-240415_A01990_0345_BHXXXXXX
+    path : Path
+        The lease file
+    owner, token : str
+        Written to the file; the token tells this lease from a later one of the same name
+    acquired : float
+        Epoch seconds
+    lost : bool
+        Set by the heartbeat when another instance took the lease over
+    """
+
+    name: str
+    path: Path
+    owner: str
+    token: str
+    acquired: float
+    lost: bool = False
+
+
+class LeaseDir:
+    """The leases in one directory, with the heartbeat of those held by this process."""
+
+    def __init__(self, directory: Path, ttl: float = DEFAULT_TTL, owner: str | None = None) -> None:
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.owner = owner or instance_id()
+        self._held: dict[str, Lease] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def path(self, name: str) -> Path:
+        return self.directory / f"{name}.lease"
+
+    def read(self, name: str) -> dict | None:
+        """The content of a lease file and its age in seconds, None if nobody holds it."""
+        path = self.path(name)
+        try:
+            mtime = path.stat().st_mtime
+            text = path.read_text()
+        except FileNotFoundError:
+            return None
+        try:
+            info = json.loads(text)
+        except json.JSONDecodeError:
+            # created but not written yet
+            info = {}
+        info["age"] = time.time() - mtime
+        return info
+
+    def acquire(self, name: str) -> Lease | None:
+        """Take the lease, or take it over when stale; None when another instance holds it."""
+        with self._lock:
+            held = self._held.get(name)
+        if held and not held.lost:
+            return held
+        self.directory.mkdir(parents=True, exist_ok=True)
+        lease = self._create(name) or self._take_over(name)
+        if lease is None:
+            return None
+        with self._lock:
+            self._held[name] = lease
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._beat, name="lease", daemon=True)
+                self._thread.start()
+        log.debug(f"[lease] Acquired {name}")
+        return lease
+
+    def release(self, lease: Lease) -> None:
+        """Give up the lease; the file is left alone if another instance took it over."""
+        with self._lock:
+            if self._held.get(lease.name) is lease:
+                del self._held[lease.name]
+        if not lease.lost and self._token(lease.path) == lease.token:
+            lease.path.unlink(missing_ok=True)
+            log.debug(f"[lease] Released {lease.name}")
+
+    @contextlib.contextmanager
+    def locked(self, name: str, timeout: float = 60.0, poll: float = 0.1):
+        """Hold the lease for the duration of the block, waiting up to timeout seconds for it."""
+        deadline = time.monotonic() + timeout
+        while (lease := self.acquire(name)) is None:
+            if time.monotonic() > deadline:
+                owner = (self.read(name) or {}).get("owner", "unknown")
+                raise TimeoutError(f"{self.path(name)} is held by {owner}")
+            time.sleep(poll)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def _create(self, name: str) -> Lease | None:
+        lease = Lease(name, self.path(name), self.owner, secrets.token_hex(8), time.time())
+        try:
+            fd = os.open(lease.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return None
+        with os.fdopen(fd, "w") as fh:
+            json.dump({"owner": lease.owner, "token": lease.token, "acquired": lease.acquired}, fh)
+        return lease
+
+    def _take_over(self, name: str) -> Lease | None:
+        info = self.read(name)
+        if info is None:
+            # released in the meantime
+            return self._create(name)
+        if info["age"] < self.ttl:
+            return None
+        guard = self.directory / f"{name}.takeover"
+        try:
+            os.close(os.open(guard, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except FileExistsError:
+            # another instance is taking it over, or died while doing so
+            with contextlib.suppress(FileNotFoundError):
+                if time.time() - guard.stat().st_mtime > self.ttl:
+                    guard.unlink()
+            return None
+        try:
+            # the lease may have been taken over and released before the guard was created
+            info = self.read(name)
+            if info is not None and info["age"] < self.ttl:
+                return None
+            if info is not None:
+                log.warning(
+                    f"[lease] Taking over {name} from {info.get('owner', 'unknown')}, "
+                    f"no heartbeat for {info['age']:.0f} s"
+                )
+                self.path(name).unlink(missing_ok=True)
+            return self._create(name)
+        finally:
+            guard.unlink(missing_ok=True)
+
+    @staticmethod
+    def _token(path: Path) -> str | None:
+        try:
+            return json.loads(path.read_text()).get("token")
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _beat(self) -> None:
+        while True:
+            time.sleep(self.ttl / 4)
+            with self._lock:
+                leases = list(self._held.values())
+            for lease in leases:
+                self.heartbeat(lease)
+
+    def heartbeat(self, lease: Lease) -> bool:
+        """Touch the lease file; False, and the lease marked lost, if it is no longer ours."""
+        if self._token(lease.path) != lease.token:
+            lease.lost = True
+            with self._lock:
+                if self._held.get(lease.name) is lease:
+                    del self._held[lease.name]
+            log.error(f"[lease] Lost {lease.name}, another instance took it over")
+            return False
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(lease.path)
+        return True
+
+
+# (directory, ttl) -> LeaseDir; all instances must use the same ttl for a lease name
+_dirs: dict[tuple[Path, float], LeaseDir] = {}
+# the lease on the run being processed, under "run"
+_current: dict[str, tuple[LeaseDir, Lease]] = {}
+
+
+def lease_dir(directory: Path, ttl: float = DEFAULT_TTL) -> LeaseDir:
+    key = (Path(directory), ttl)
+    if key not in _dirs:
+        _dirs[key] = LeaseDir(*key)
+    return _dirs[key]
+
+
+def configure(cfg) -> LeaseDir:
+    """The LeaseDir of [Paths]->manager_dir/leases with the configured ttl."""
+    ttl = float(cfg.static.system.get("lease_ttl", DEFAULT_TTL))
+    return lease_dir(cfg.static.paths.manager_dir / "leases", ttl)
+
+
+def claim_run(cfg) -> bool:
+    """Lease the run of cfg.run, releasing the previous one; False if another instance has it."""
+    release_run()
+    leases = configure(cfg)
+    lease = leases.acquire(f"run-{cfg.run.run_id}")
+    if lease is None:
+        holder = leases.read(f"run-{cfg.run.run_id}") or {}
+        log.debug(f"[lease] {cfg.run.run_id} is processed by {holder.get('owner', 'unknown')}")
+        return False
+    _current["run"] = (leases, lease)
+    return True
+
+
+def run_lost() -> bool:
+    """Whether the lease on the current run was taken over by another instance."""
+    return "run" in _current and _current["run"][1].lost
+
+
+def release_run() -> None:
+    if "run" in _current:
+        leases, lease = _current.pop("run")
+        leases.release(lease)
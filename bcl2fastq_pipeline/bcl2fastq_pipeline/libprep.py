@@ -0,0 +1,173 @@
+"""
+Registry of the library preps known to the pipeline.
+
+Everything the pipeline needs to know about a libprep is looked up here
+instead of being spread over string checks in several modules:
+
+    • the libprep.config entry of gcf-workflows (workflow, reads, ...)
+    • which demultiplexer and, for 10X kits, which mkfastq command to use
+    • whether the analysis produces an extra HTML report for the email
+
+libprep.config is parsed with the C YAML loader when available, and only
+again when its mtime changes. Lookups go through a normalized index
+(case-insensitive, whitespace collapsed, optional " SE"/" PE" suffix).
+
+Example
+-------
+>>> lp = lookup("10X Genomics Chromium Single Cell 3p GEM Library & Gel Bead Kit v3")
+>>> lp.workflow, lp.demultiplexer, lp.mkfastq_command, lp.extra_html
+('singlecell', 'cellranger mkfastq', 'cellranger_mkfastq', True)
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import yaml
+
+log = logging.getLogger(__name__)
+
+LIBPREP_CONFIG = Path("/opt/gcf-workflows/libprep.config")
+
+# libprep -> key of the cellranger command in the [commands] of bcl2fastq.ini
+MKFASTQ_10X = {
+    "10X Genomics Visium Spatial Gene Expression Slide & Reagents Kit": "cellranger_spatial_mkfastq",
+    "10X Genomics Chromium Next GEM Single Cell ATAC Library & Gel Bead Kit v1.1": "cellranger_atac_mkfastq",
+    "10X Genomics Chromium Single Cell 3p GEM Library & Gel Bead Kit v3": "cellranger_mkfastq",
+}
+
+# libpreps whose analysis writes an all_samples web summary that is attached to the email
+EXTRA_HTML_PREFIXES = ("10X Genomics Chromium Single Cell", "Parse Biosciences")
+
+_Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def normalize(name: str) -> str:
+    return " ".join(str(name).split()).lower()
+
+
+@dataclass(frozen=True)
+class Libprep:
+    """
+    A library prep as named in the [CustomOptions] of the sample sheet.
+
+    Attributes
+    ----------
+    name : str
+        The libprep as given in the sample sheet.
+    key : str | None
+        The matching libprep.config entry, None if there is none.
+    entry : dict
+        That entry, empty if there is none.
+    """
+
+    name: str
+    key: str | None = None
+    entry: dict = field(default_factory=dict)
+
+    @property
+    def is_10x(self) -> bool:
+        return "10X Genomics" in self.name
+
+    @property
+    def workflow(self) -> str | None:
+        wf = self.entry.get("workflow")
+        return str(wf).strip() if wf else None
+
+    @property
+    def reads(self) -> str | None:
+        """Read layout ("SE" or "PE"), from the entry or the suffix of its key."""
+        if self.entry.get("reads"):
+            return str(self.entry["reads"]).strip().upper()
+        if self.key and self.key.strip().upper().endswith((" SE", " PE")):
+            return self.key.strip()[-2:].upper()
+        return None
+
+    @property
+    def demultiplexer(self) -> str:
+        return "cellranger mkfastq" if self.is_10x else "bcl-convert"
+
+    @property
+    def mkfastq_command(self) -> str | None:
+        """Key of the cellranger mkfastq command in the [commands] section, for 10X kits."""
+        return MKFASTQ_10X.get(self.name)
+
+    @property
+    def extra_html(self) -> bool:
+        return self.name.startswith(EXTRA_HTML_PREFIXES)
+
+
+class LibprepRegistry:
+    """The entries of one libprep.config, reloaded when the file changes."""
+
+    def __init__(self, path: Path = LIBPREP_CONFIG):
+        self.path = Path(path)
+        self._mtime_ns: int | None = None
+        self._index: dict[str, tuple[str, dict]] = {}
+        # "missing", or the mtime of a file that could not be parsed, already logged
+        self._problem: str | int | None = None
+        self._lock = threading.Lock()
+
+    def _refresh(self) -> None:
+        """
+        Reload the index when the file changed.
+
+        A missing file gives an empty index and a file that cannot be parsed
+        keeps the last good one; either is logged once, not on every lookup.
+        """
+        try:
+            mtime_ns = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            if self._problem != "missing":
+                log.warning(f"[libprep] libprep.config not found: {self.path}")
+                self._problem = "missing"
+            self._mtime_ns, self._index = None, {}
+            return
+        if mtime_ns in (self._mtime_ns, self._problem):
+            return
+        try:
+            with self.path.open(encoding="utf-8") as fh:
+                data = yaml.load(fh, Loader=_Loader) or {}
+            items = list(data.items())
+        except (OSError, yaml.YAMLError, AttributeError) as e:
+            log.error(f"[libprep] Could not read {self.path}, keeping the last good entries: {e}")
+            self._problem = mtime_ns
+            return
+        index = {}
+        for key, value in items:
+            # malformed entries are skipped
+            if isinstance(value, dict):
+                index.setdefault(normalize(key), (str(key), value))
+        self._mtime_ns, self._index, self._problem = mtime_ns, index, None
+        log.debug(f"[libprep] Loaded {len(index)} libpreps from {self.path}")
+
+    def get(self, name: str | None) -> Libprep:
+        """Look up a libprep by name, also trying the " SE" and " PE" variants."""
+        if not name:
+            return Libprep(name="")
+        with self._lock:
+            self._refresh()
+            norm = normalize(name)
+            for candidate in (norm, f"{norm} se", f"{norm} pe"):
+                if candidate in self._index:
+                    key, entry = self._index[candidate]
+                    return Libprep(name=name.strip(), key=key, entry=entry)
+        return Libprep(name=name.strip())
+
+
+_registries: dict[Path, LibprepRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def registry(path: Path = LIBPREP_CONFIG) -> LibprepRegistry:
+    with _registries_lock:
+        return _registries.setdefault(Path(path), LibprepRegistry(path))
+
+
+def lookup(name: str | None, path: Path = LIBPREP_CONFIG) -> Libprep:
+    """The Libprep for a name from the sample sheet. Unknown names get an empty entry."""
+    return registry(path).get(name)
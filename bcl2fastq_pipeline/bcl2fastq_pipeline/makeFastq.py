@@ -8,15 +8,31 @@ import re
 import shutil
 import subprocess
 
+from pathlib import Path
+
+from bcl2fastq_pipeline import harvest, staging, tracing
 from bcl2fastq_pipeline.config import PipelineConfig
 
 log = logging.getLogger(__name__)
 
-MKFASTQ_10X = {
-    "10X Genomics Visium Spatial Gene Expression Slide & Reagents Kit": "cellranger_spatial_mkfastq",
-    "10X Genomics Chromium Next GEM Single Cell ATAC Library & Gel Bead Kit v1.1": "cellranger_atac_mkfastq",
-    "10X Genomics Chromium Single Cell 3p GEM Library & Gel Bead Kit v3": "cellranger_mkfastq",
-}
+
+def fastq_name(name: str) -> str:
+    """The name rename_fastqs() gives a FASTQ file: without `_001` and `_S<number>`."""
+    new_name = name.replace("_001.fastq.gz", ".fastq.gz")
+    return re.sub(r"_S[0-9]+", "", new_name)
+
+
+def renamed(rel: Path) -> Path:
+    """Where rename_fastqs() leaves a file, from its path relative to the output directory."""
+    if len(rel.parts) in (2, 3) and rel.name.endswith("_001.fastq.gz"):
+        return rel.with_name(fastq_name(rel.name))
+    return rel
+
+
+def stream_output(cfg) -> bool:
+    """Whether bcl-convert writes to scratchDir/demux, see bcl2fq()."""
+    enabled = cfg.static.system.get("demux_to_scratch", "no").lower() in ("1", "yes", "true", "on")
+    return enabled and cfg.static.paths.scratch_dir is not None
 
 
 def rename_fastqs():
@@ -24,10 +40,13 @@ def rename_fastqs():
     Find and rename FASTQ files under cfg.output_path:
     - Removes lane suffix `_001`
     - Removes sample numbering `_S<number>`
+
+    Output moved by the StreamingMover of bcl2fq() is already renamed, so
+    for streamed runs this finds nothing to do.
     """
     cfg = PipelineConfig.get()
 
-    if "10X Genomics" in cfg.run.libprep:
+    if cfg.run.libprep_info.is_10x:
         return
 
     # Collect FASTQ files 1–2 levels deep
@@ -36,11 +55,7 @@ def rename_fastqs():
 
     for fpath in fastqs:
         if fpath.name.endswith("_001.fastq.gz"):
-            # Build new filename
-            new_name = fpath.name.replace("_001.fastq.gz", ".fastq.gz")
-            new_name = re.sub(r"_S[0-9]+", "", new_name)
-
-            fnew = fpath.with_name(new_name)
+            fnew = fpath.with_name(fastq_name(fpath.name))
             log.debug(f"[rename_fastqs] Moving {fpath} → {fnew}")
 
             # Ensure parent directory exists (should already)
@@ -48,6 +63,9 @@ def rename_fastqs():
 
             shutil.move(str(fpath), str(fnew))
 
+    if span := tracing.current():
+        span.set(files=len(fastqs))
+
 
 def bcl2fq():
     """
@@ -62,43 +80,79 @@ def bcl2fq():
         cfg.run.flowcell_path / "InterOp", cfg.output_path / "InterOp", dirs_exist_ok=True
     )
     force_bcl2fastq = os.environ.get("FORCE_BCL2FASTQ", None)
-
-    if "10X Genomics" in cfg.run.libprep:
-        cellranger_cmd = cfg.static.commands[MKFASTQ_10X[cfg.run.libprep]]
-        cellranger_options = cfg.static.commands["cellranger_mkfastq_options"]
-        cmd = f"{cellranger_cmd} --output-dir={cfg.output_path} --sample-sheet={cfg.run.sample_sheet} --run={cfg.run.flowcell_path} {cellranger_options}"
-        bcl_done = ["cellranger mkfastq", os.environ.get("CR_VERSION")]
-    elif force_bcl2fastq:
-        bcl2fastq_bin = cfg.static.commands["bcl2fastq"]
-        bcl2fastq_opts = cfg.static.commands["bcl2fastq_options"]
-        cmd = f"{bcl2fastq_bin} {bcl2fastq_opts} --sample-sheet {cfg.run.sample_sheet} -o {cfg.output_path} -R {cfg.run.flowcell_path} --interop-dir {cfg.output_path}/InterOp"
-        bcl_done = ["bcl2fastq", os.environ.get("BCL2FASTQ_VERSION")]
-    else:
-        cmd = f"bcl-convert --force --bcl-input-directory {cfg.run.flowcell_path} --output-directory {cfg.output_path} --sample-sheet {cfg.run.sample_sheet} --bcl-sampleproject-subdirectories true --no-lane-splitting true --output-legacy-stats true"
-        bcl_done = ["bcl-convert", os.environ.get("BCL_CONVERT_VERSION")]
-
-    log_pth = cfg.static.paths.log_dir / f"{cfg.run.run_id}.log"
-    try:
-        log.info(f"[convert bcl] Running: {cmd}\n")
-        with log_pth.open("w") as logOut:
-            subprocess.check_call(
-                cmd, stdout=logOut, stderr=subprocess.STDOUT, shell=True, cwd=cfg.output_path
-            )
-    except Exception:
-        if "10X Genomics" not in cfg.run.libprep and force_bcl2fastq:
+    # the local copy of the run folder, if it was prefetched, held until the demultiplexer is done
+    with staging.reading(cfg) as run_dir:
+        # bcl-convert can write to local scratch, with its output moved and renamed as it is written
+        mover = None
+        demux_dir = cfg.output_path
+        if stream_output(cfg) and not cfg.run.libprep_info.is_10x and not force_bcl2fastq:
+            demux_dir = cfg.static.paths.scratch_dir / "demux" / cfg.run.run_id
+            if demux_dir.exists():
+                shutil.rmtree(demux_dir)
+            demux_dir.mkdir(parents=True)
+            mover = harvest.StreamingMover(
+                demux_dir,
+                cfg.output_path,
+                renamed,
+                settle=float(cfg.static.system.get("demux_settle", 30)),
+            ).start()
+
+        if cfg.run.libprep_info.is_10x:
+            cellranger_cmd = cfg.static.commands[cfg.run.libprep_info.mkfastq_command]
+            cellranger_options = cfg.static.commands["cellranger_mkfastq_options"]
+            cmd = f"{cellranger_cmd} --output-dir={cfg.output_path} --sample-sheet={cfg.run.sample_sheet} --run={run_dir} {cellranger_options}"
+            bcl_done = ["cellranger mkfastq", os.environ.get("CR_VERSION")]
+        elif force_bcl2fastq:
+            bcl2fastq_bin = cfg.static.commands["bcl2fastq"]
+            bcl2fastq_opts = cfg.static.commands["bcl2fastq_options"]
+            cmd = f"{bcl2fastq_bin} {bcl2fastq_opts} --sample-sheet {cfg.run.sample_sheet} -o {cfg.output_path} -R {run_dir} --interop-dir {cfg.output_path}/InterOp"
+            bcl_done = ["bcl2fastq", os.environ.get("BCL2FASTQ_VERSION")]
+        else:
+            cmd = f"bcl-convert --force --bcl-input-directory {run_dir} --output-directory {demux_dir} --sample-sheet {cfg.run.sample_sheet} --bcl-sampleproject-subdirectories true --no-lane-splitting true --output-legacy-stats true"
+            bcl_done = ["bcl-convert", os.environ.get("BCL_CONVERT_VERSION")]
+
+        log_pth = cfg.static.paths.log_dir / f"{cfg.run.run_id}.log"
+        try:
+            log.info(f"[convert bcl] Running: {cmd}\n")
+            with log_pth.open("w") as logOut:
+                tracing.check_call(
+                    cmd,
+                    name=bcl_done[0],
+                    stdout=logOut,
+                    stderr=subprocess.STDOUT,
+                    shell=True,
+                    cwd=cfg.output_path,
+                )
+        except Exception:
+            # only bcl2fastq is run again, on barcode collisions; any other error propagates
+            if cfg.run.libprep_info.is_10x or not force_bcl2fastq:
+                raise
             with log_pth.open("r") as logIn:
                 log_content = logIn.read()
-            if "<bcl2fastq::layout::BarcodeCollisionError>" in log_content:
-                cmd += " --barcode-mismatches 0 "
-                with log_pth.open("w") as logOut:
-                    log.info(f"[bcl2fq] Retrying with --barcode-mismatches 0 : {cmd}\n")
-                    subprocess.check_call(
-                        cmd,
-                        stdout=logOut,
-                        stderr=subprocess.STDOUT,
-                        shell=True,
-                        cwd=cfg.output_path,
-                    )
+            if "<bcl2fastq::layout::BarcodeCollisionError>" not in log_content:
+                raise
+            cmd += " --barcode-mismatches 0 "
+            with log_pth.open("w") as logOut:
+                log.info(f"[bcl2fq] Retrying with --barcode-mismatches 0 : {cmd}\n")
+                tracing.check_call(
+                    cmd,
+                    name=bcl_done[0],
+                    stdout=logOut,
+                    stderr=subprocess.STDOUT,
+                    shell=True,
+                    cwd=cfg.output_path,
+                )
+        finally:
+            if mover is not None:
+                with tracing.span("flush_output") as s:
+                    report = mover.stop()
+                    s.set(files=report.files, bytes=report.bytes, moved_early=mover.moved_early)
+        # only reached when the demultiplexer succeeded, its own error propagates from above
+        if mover is not None and mover.failed:
+            raise RuntimeError(
+                f"{len(mover.failed)} files were not moved to {cfg.output_path}, "
+                f"they are left in {demux_dir}: {next(iter(mover.failed.values()))}"
+            )
 
     src = cfg.output_path / "Reports" / "legacy" / "Stats"
     if src.exists():
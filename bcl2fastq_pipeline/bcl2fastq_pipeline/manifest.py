@@ -0,0 +1,192 @@
+"""
+Persistent manifest of the FASTQ files produced for a run.
+
+The manifest is built once after the demultiplexed files have been renamed
+and is stored as ``manifest.json`` in the run output directory. It lists the
+projects, samples and files of the run together with their sizes, read
+counts and checksums, so that later stages do not have to glob the output
+tree (which is slow on network storage) to find out what the run contains.
+
+Stages that learn something new about the files (read counts from the
+validation, md5sums, harvested analysis output) record it in the manifest.
+
+Example
+-------
+>>> manifest = get_manifest(cfg)
+>>> manifest.project_names()
+['GCF-2024-001', 'GCF-2024-002']
+>>> [f.path for f in manifest.project_files("GCF-2024-001")]
+['GCF-2024-001/Sample1_R1.fastq.gz', ...]
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import threading
+
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+FASTQ_NAME = re.compile(
+    r"^(?P<sample>.+?)(?:_S\d+)?(?:_L(?P<lane>\d{3}))?_(?P<read>[RI]\d)(?:_001)?\.fastq\.gz$"
+)
+
+# Loaded manifests, keyed by output directory. Shared by all modules of the process.
+_manifests: dict[Path, RunManifest] = {}
+_manifests_lock = threading.Lock()
+
+
+@dataclass
+class FastqEntry:
+    """One FASTQ file of the run, with a path relative to the run output directory."""
+
+    path: str
+    project: str
+    sample: str
+    size: int
+    mtime_ns: int
+    reads: int | None = None
+    md5: str | None = None
+
+
+@dataclass
+class RunManifest:
+    """
+    Projects, samples and files of a demultiplexed run.
+
+    Attributes
+    ----------
+    output_path : Path
+        The run output directory, all file paths are relative to it.
+    files : dict[str, FastqEntry]
+        FASTQ files keyed by relative path.
+    extra : dict[str, dict]
+        Free-form records written by later stages.
+    """
+
+    output_path: Path
+    files: dict[str, FastqEntry] = field(default_factory=dict)
+    extra: dict[str, dict] = field(default_factory=dict)
+    _lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+
+    # --- construction ------------------------------------------------------- #
+    @classmethod
+    def build(cls, output_path: Path) -> RunManifest:
+        """Scan output_path (up to two directory levels) for FASTQ files."""
+        output_path = Path(output_path)
+        fastqs = list(output_path.glob("*.fastq.gz"))
+        fastqs += list(output_path.glob("*/*.fastq.gz"))
+        fastqs += list(output_path.glob("*/*/*.fastq.gz"))
+
+        manifest = cls(output_path=output_path)
+        for f in sorted(fastqs):
+            rel = f.relative_to(output_path)
+            st = f.stat()
+            m = FASTQ_NAME.match(f.name)
+            manifest.files[str(rel)] = FastqEntry(
+                path=str(rel),
+                project=next((c for c in rel.parts[:-1] if c.startswith("GCF-")), ""),
+                sample=m["sample"] if m else f.name.removesuffix(".fastq.gz"),
+                size=st.st_size,
+                mtime_ns=st.st_mtime_ns,
+            )
+        return manifest
+
+    @classmethod
+    def load(cls, output_path: Path) -> RunManifest:
+        output_path = Path(output_path)
+        data = json.loads((output_path / MANIFEST_NAME).read_text())
+        return cls(
+            output_path=output_path,
+            files={k: FastqEntry(**v) for k, v in data["files"].items()},
+            extra=data.get("extra", {}),
+        )
+
+    def save(self) -> None:
+        """Atomically write the manifest to output_path/manifest.json."""
+        with self._lock:
+            data = {
+                "files": {k: asdict(v) for k, v in self.files.items()},
+                "extra": self.extra,
+            }
+            tmp = self.output_path / f".{MANIFEST_NAME}.tmp"
+            tmp.write_text(json.dumps(data, indent=1))
+            os.replace(tmp, self.output_path / MANIFEST_NAME)
+
+    # --- queries ------------------------------------------------------------ #
+    def project_names(self) -> list[str]:
+        """Sorted GCF project names of the run."""
+        return sorted({f.project for f in self.files.values() if f.project})
+
+    def project_dirs(self) -> set[str]:
+        """Project directories, as returned by the legacy get_project_dirs()."""
+        return {str(self.output_path / p) for p in self.project_names()}
+
+    def project_files(self, project: str) -> list[FastqEntry]:
+        return [f for f in self.files.values() if f.project == project]
+
+    def samples(self, project: str) -> list[str]:
+        return sorted({f.sample for f in self.project_files(project)})
+
+    def project_size(self, project: str) -> int:
+        """Total size of the FASTQ files of a project, in bytes."""
+        return sum(f.size for f in self.project_files(project))
+
+    # --- updates ------------------------------------------------------------ #
+    def update_reads(self, counts: dict[str, int]) -> None:
+        """Record read counts keyed by relative path."""
+        with self._lock:
+            for path, reads in counts.items():
+                if path in self.files:
+                    self.files[path].reads = reads
+            self.save()
+
+    def update_md5(self, md5_file: Path) -> None:
+        """Record checksums from an ``md5sum`` output file with paths relative to output_path."""
+        with self._lock:
+            for line in Path(md5_file).read_text().splitlines():
+                if not line.strip():
+                    continue
+                md5, path = line.split(maxsplit=1)
+                path = path.lstrip("*").removeprefix("./")
+                if path in self.files:
+                    self.files[path].md5 = md5
+            self.save()
+
+    def record(self, key: str, value: dict) -> None:
+        """Store a free-form record from a later stage under extra[key]."""
+        with self._lock:
+            self.extra[key] = value
+            self.save()
+
+
+def build_manifest(cfg) -> RunManifest:
+    """(Re)build and save the manifest of the current run."""
+    manifest = RunManifest.build(cfg.output_path)
+    manifest.save()
+    with _manifests_lock:
+        _manifests[cfg.output_path] = manifest
+    log.info(
+        f"[manifest] {len(manifest.files)} fastq files in {len(manifest.project_names())} projects"
+    )
+    return manifest
+
+
+def get_manifest(cfg) -> RunManifest:
+    """Return the manifest of the current run, loading or building it if needed."""
+    with _manifests_lock:
+        manifest = _manifests.get(cfg.output_path)
+    if manifest is not None:
+        return manifest
+    if (cfg.output_path / MANIFEST_NAME).exists():
+        manifest = RunManifest.load(cfg.output_path)
+        with _manifests_lock:
+            return _manifests.setdefault(cfg.output_path, manifest)
+    return build_manifest(cfg)
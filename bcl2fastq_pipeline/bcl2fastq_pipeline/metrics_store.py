@@ -0,0 +1,347 @@
+"""
+Columnar history of the lane, read and sample metrics of every run.
+
+Each processed run appends its metrics to three Parquet tables under
+``manager_dir/metrics``:
+
+    • lanes    – density, reads, % PF, % PhiX and % undetermined per lane
+    • reads    – %>=Q30, % PhiX and yield per lane and read
+    • samples  – reads per project, sample and lane
+
+The tables are hive partitioned by year (``lanes/year=2024/<run_id>.parquet``)
+and every row carries the run id, run date, instrument, libprep and
+pipeline, so trend queries only read the columns and years they need. When a
+partition collects more than COMPACT_AT run files they are merged into one
+``compacted.parquet``, which keeps queries over thousands of runs fast.
+Recording a run again replaces its rows.
+
+Every file of a table is written with the table's schema in SCHEMAS, with
+nulls for metrics a run does not have (e.g. no % undetermined without demux
+stats), and is read back with it, so no column depends on which run was
+recorded first. A partition is only changed under a lease on it (see
+lease), as several bfq instances may record runs at the same time.
+
+Example
+-------
+>>> root = store_root(cfg)
+>>> df = query(root, "lanes", Selection(instruments=["A01990"], start="2024-01-01"))
+>>> trend(df, "undetermined_pct", by="libprep", freq="MS")
+"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import os
+import uuid
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from bcl2fastq_pipeline import demux_stats, interop, lease
+from bcl2fastq_pipeline.config import parse_custom_options
+
+log = logging.getLogger(__name__)
+
+TABLES = ("lanes", "reads", "samples")
+COMPACTED_NAME = "compacted.parquet"
+COMPACT_AT = 64
+LOCK_TTL = 30.0
+
+_RUN_FIELDS = [
+    ("run_id", pa.string()),
+    ("run_date", pa.timestamp("s")),
+    ("instrument", pa.string()),
+    ("libprep", pa.string()),
+    ("pipeline", pa.string()),
+]
+SCHEMAS = {
+    "lanes": pa.schema(
+        [
+            *_RUN_FIELDS,
+            ("lane", pa.int64()),
+            ("tiles", pa.int64()),
+            ("density", pa.float64()),
+            ("reads_m", pa.float64()),
+            ("reads_pf_m", pa.float64()),
+            ("cluster_pf", pa.float64()),
+            ("phix", pa.float64()),
+            ("undetermined_pct", pa.float64()),
+        ]
+    ),
+    "reads": pa.schema(
+        [
+            *_RUN_FIELDS,
+            ("lane", pa.int64()),
+            ("read", pa.int64()),
+            ("cycles", pa.int64()),
+            ("q30", pa.float64()),
+            ("phix", pa.float64()),
+            ("yield_gb", pa.float64()),
+        ]
+    ),
+    "samples": pa.schema(
+        [
+            *_RUN_FIELDS,
+            ("project", pa.string()),
+            ("sample", pa.string()),
+            ("lane", pa.int64()),
+            ("reads", pa.int64()),
+        ]
+    ),
+}
+
+
+def store_root(cfg) -> Path:
+    return cfg.static.paths.manager_dir / "metrics"
+
+
+def run_date(run_id: str) -> datetime.date:
+    """Date from the run id (yymmdd_ or yyyymmdd_ prefix)."""
+    prefix = run_id.split("_")[0]
+    fmt = "%Y%m%d" if len(prefix) == 8 else "%y%m%d"
+    return datetime.datetime.strptime(prefix, fmt).date()
+
+
+# --------------------------------------------------------------------------- #
+# Collection
+# --------------------------------------------------------------------------- #
+def collect(
+    output_path: Path, run_id: str, libprep: str | None, pipeline: str | None
+) -> dict[str, pd.DataFrame]:
+    """Metrics tables of one run. Tables whose inputs are missing are left out."""
+    run = {
+        "run_id": run_id,
+        "run_date": pd.Timestamp(run_date(run_id)),
+        "instrument": run_id.split("_")[1],
+        "libprep": libprep or "",
+        "pipeline": pipeline or "",
+    }
+    tables: dict[str, pd.DataFrame] = {}
+
+    try:
+        stats = demux_stats.load(output_path)
+    except FileNotFoundError:
+        stats = None
+    if stats is not None and stats.samples:
+        tables["samples"] = pd.DataFrame(
+            [
+                {"project": p, "sample": s, "lane": lane, "reads": n}
+                for (p, s, lane), n in stats.samples.items()
+            ]
+        )
+
+    try:
+        summary = interop.RunSummary.from_run(output_path)
+    except (interop.InterOpFormatError, OSError) as e:
+        log.warning(f"[metrics_store] No InterOp metrics for {run_id}: {e}")
+        summary = None
+    if summary is not None:
+        data_reads = [r for r in summary.reads if not r.is_index]
+        reads = []
+        for i, r in enumerate(data_reads, 1):
+            m = summary.lane_read_metrics(r)
+            reads.append(
+                pd.DataFrame(
+                    {
+                        "lane": m["Lane"],
+                        "read": i,
+                        "cycles": r.cycles,
+                        "q30": m["%>=Q30"],
+                        "phix": [v[0] for v in m["Aligned"]],
+                        "yield_gb": m["Yield"],
+                    }
+                )
+            )
+        tables["reads"] = pd.concat(reads, ignore_index=True)
+
+        m = summary.lane_read_metrics(data_reads[0])
+        lanes = pd.DataFrame(
+            {
+                "lane": m["Lane"],
+                "tiles": m["Tiles"],
+                "density": [v[0] for v in m["Density"]],
+                "reads_m": m["Reads"],
+                "reads_pf_m": m["Reads PF"],
+                "cluster_pf": [v[0] for v in m["Cluster PF"]],
+                "phix": [v[0] for v in m["Aligned"]],
+            }
+        )
+        if stats is not None:
+            undeter = stats.undetermined_table().rename(
+                columns={"Lane": "lane", "% Undetermined": "undetermined_pct"}
+            )
+            lanes = lanes.merge(undeter, on="lane", how="left")
+        tables["lanes"] = lanes
+
+    for name, df in tables.items():
+        for col, value in reversed(run.items()):
+            df.insert(0, col, value)
+        tables[name] = df
+    return tables
+
+
+# --------------------------------------------------------------------------- #
+# Storage
+# --------------------------------------------------------------------------- #
+def _write(df: pd.DataFrame, path: Path, schema: pa.Schema) -> None:
+    """Write df with all the columns of schema, null where df has none."""
+    arrays = [
+        pa.array(df[f.name], type=f.type, from_pandas=True)
+        if f.name in df
+        else pa.nulls(len(df), f.type)
+        for f in schema
+    ]
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    pq.write_table(pa.Table.from_arrays(arrays, schema=schema), tmp)
+    os.replace(tmp, path)
+
+
+def _partition_lock(root: Path, part_dir: Path):
+    """The lease on a partition, held while its files are rewritten."""
+    leases = lease.lease_dir(root / "leases", LOCK_TTL)
+    return leases.locked(f"metrics-{part_dir.parent.name}-{part_dir.name}")
+
+
+def _drop_run(part_dir: Path, run_id: str, schema: pa.Schema) -> None:
+    (part_dir / f"{run_id}.parquet").unlink(missing_ok=True)
+    compacted = part_dir / COMPACTED_NAME
+    if compacted.exists():
+        df = pd.read_parquet(compacted)
+        if (df["run_id"] == run_id).any():
+            _write(df[df["run_id"] != run_id], compacted, schema)
+
+
+def compact(part_dir: Path, schema: pa.Schema) -> None:
+    """Merge the per-run files of a partition into its compacted file, under its lease."""
+    files = sorted(part_dir.glob("*.parquet"))
+    if len(files) < 2:
+        return
+    df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+    _write(df.sort_values(["run_date", "run_id"], kind="stable"), part_dir / COMPACTED_NAME, schema)
+    for f in files:
+        if f.name != COMPACTED_NAME:
+            f.unlink()
+    log.info(f"[metrics_store] Compacted {len(files)} files in {part_dir}")
+
+
+def record(root: Path, tables: dict[str, pd.DataFrame]) -> None:
+    """Store the tables of one run, replacing earlier rows of the same run."""
+    for name, df in tables.items():
+        if df.empty:
+            continue
+        run_id = df["run_id"].iloc[0]
+        part_dir = root / name / f"year={df['run_date'].iloc[0].year}"
+        part_dir.mkdir(parents=True, exist_ok=True)
+        with _partition_lock(root, part_dir):
+            _drop_run(part_dir, run_id, SCHEMAS[name])
+            _write(df, part_dir / f"{run_id}.parquet", SCHEMAS[name])
+            runs = sum(1 for f in part_dir.glob("*.parquet") if f.name != COMPACTED_NAME)
+            if runs >= COMPACT_AT:
+                compact(part_dir, SCHEMAS[name])
+
+
+def record_run(cfg) -> None:
+    """Add the metrics of the current run to the store."""
+    tables = collect(cfg.output_path, cfg.run.run_id, cfg.run.libprep, cfg.run.pipeline)
+    record(store_root(cfg), tables)
+    log.info(f"[metrics_store] Recorded {', '.join(tables)} metrics of {cfg.run.run_id}")
+
+
+def backfill(root: Path, output_paths: list[Path]) -> int:
+    """
+    Record historic runs from their output directories. Returns the number of runs stored.
+
+    The libprep is taken from the [CustomOptions] of the SampleSheet.csv in the
+    output directory; the pipeline is unknown for historic runs.
+    """
+    n = 0
+    for output_path in map(Path, output_paths):
+        if not output_path.is_dir():
+            continue
+        libprep = None
+        if (output_path / "SampleSheet.csv").exists():
+            libprep = parse_custom_options(output_path / "SampleSheet.csv")[0].get("Libprep")
+        try:
+            tables = collect(output_path, output_path.name, libprep, None)
+        except Exception as e:
+            log.warning(f"[metrics_store] Skipping {output_path}: {e}")
+            continue
+        if tables:
+            record(root, tables)
+            n += 1
+    return n
+
+
+# --------------------------------------------------------------------------- #
+# Queries
+# --------------------------------------------------------------------------- #
+@dataclass
+class Selection:
+    """The runs a query reads. Empty fields do not filter, dates are inclusive."""
+
+    instruments: list[str] = field(default_factory=list)
+    libpreps: list[str] = field(default_factory=list)
+    start: str | datetime.date | None = None
+    end: str | datetime.date | None = None
+
+    def filters(self) -> list[tuple]:
+        """Filters for the Parquet reader, including the year partitions to read."""
+        filters = []
+        if self.instruments:
+            filters.append(("instrument", "in", list(self.instruments)))
+        if self.libpreps:
+            filters.append(("libprep", "in", list(self.libpreps)))
+        if self.start:
+            start = pd.Timestamp(self.start)
+            filters += [("year", ">=", start.year), ("run_date", ">=", start)]
+        if self.end:
+            end = pd.Timestamp(self.end)
+            filters += [("year", "<=", end.year), ("run_date", "<=", end)]
+        return filters
+
+
+def query(
+    root: Path,
+    table: str,
+    selection: Selection | None = None,
+    columns: list[str] | None = None,
+) -> pd.DataFrame:
+    """
+    Rows of a metrics table for the selected runs, sorted by run date.
+
+    Filters are pushed down to the Parquet reader, so only matching year
+    partitions and row groups are read.
+    """
+    if table not in TABLES:
+        raise ValueError(f"Unknown metrics table {table!r}, expected one of {TABLES}")
+    path = Path(root) / table
+    if not path.exists():
+        return pd.DataFrame()
+    if columns is not None:
+        columns = list(dict.fromkeys(["run_id", "run_date", *columns]))
+
+    filters = (selection or Selection()).filters()
+    # the table's schema, not that of whichever file comes first
+    schema = SCHEMAS[table].append(pa.field("year", pa.int32()))
+    df = pd.read_parquet(path, columns=columns, filters=filters or None, schema=schema)
+    return df.drop(columns=["year"], errors="ignore").sort_values(
+        ["run_date", "run_id"], kind="stable", ignore_index=True
+    )
+
+
+def trend(df: pd.DataFrame, metric: str, by: str = "instrument", freq: str = "MS") -> pd.DataFrame:
+    """Mean of metric per period (a pandas offset alias) and group."""
+    if df.empty:
+        return df
+    return (
+        df.groupby([pd.Grouper(key="run_date", freq=freq), by])[metric]
+        .mean()
+        .unstack(by)
+        .dropna(how="all")
+        .round(2)
+    )
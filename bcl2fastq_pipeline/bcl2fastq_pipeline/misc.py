@@ -2,28 +2,23 @@
 Misc. functions
 """
 
+import io
 import logging
+import re
 import shutil
-import smtplib
-import tempfile as tmp
-import xml.etree.ElementTree as ET
+import tempfile
 
-from argparse import Namespace
-from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formatdate
+from pathlib import Path
 
-import configmaker.configmaker as cm
 import pandas as pd
 
-from bcl2fastq_pipeline.afterFastq import (
-    get_project_dirs,
-    get_project_names,
-    get_read_geometry,
-    get_sequencer,
-)
+from bcl2fastq_pipeline import attachments, demux_stats, inputs, interop, outbox
+from bcl2fastq_pipeline.afterFastq import get_read_geometry, get_sequencer
 from bcl2fastq_pipeline.config import PipelineConfig
+from bcl2fastq_pipeline.manifest import get_manifest
 
 style = """
 <style>
@@ -43,6 +38,8 @@ table, th, td {
 """
 
 log = logging.getLogger(__name__)
+# "Read 2" or "Read 2 (I)" alone on a line, not a row of the read level table
+READ_HEADER = re.compile(r"^Read \d+( \(I\))?$")
 
 
 def getSampleID(sampleTuple, project, lane, sampleName):
@@ -54,37 +51,23 @@ def getSampleID(sampleTuple, project, lane, sampleName):
     return " "
 
 
-def getFCmetricsImproved():
-    cfg = PipelineConfig.get()
-    message = ""
-    try:
-        with (cfg.output_path / "Stats" / "interop_summary.csv").open() as fh:
-            header = False
-            while not header:
-                line = fh.readline()
-                if line.startswith("\n"):
-                    line = fh.readline()
-                    header = True
-            lines = fh.readlines()
-    except Exception:
-        return "Not able to generate table for flowcell metrics."
-
+def lane_table_from_csv(path):
+    """Flowcell metrics table from an interop_summary.csv written by the Illumina tools."""
+    text = path.read_text()
+    # skip the run level section, which ends with the first blank line
+    lines = text[text.index("\n\n") + 2 :].splitlines(keepends=True)
     read_start = []
     for i, line in enumerate(lines):
-        if line.startswith("Read"):
+        if READ_HEADER.match(line.rstrip()):
             read_start.append(i)
         elif line.startswith("Extracted"):
             read_start.append(i)
             break
     dfs = []
     for i in range(len(read_start) - 1):
-        if lines[read_start[i]].endswith("(I)\n"):
+        if lines[read_start[i]].rstrip().endswith("(I)"):
             continue
-        tmpfh = tmp.NamedTemporaryFile(mode="w+")
-        tmpfh.writelines(lines[read_start[i] + 1 : read_start[i + 1]])
-        tmpfh.seek(0)
-        df = pd.read_csv(tmpfh)
-        tmpfh.close()
+        df = pd.read_csv(io.StringIO("".join(lines[read_start[i] + 1 : read_start[i + 1]])))
         df = df[["Lane", "Surface", "Density", "Reads", "Cluster PF", "Aligned", "%>=Q30"]]
         df = df[df["Surface"] == "-"]
         df = df.drop(columns=["Surface"])
@@ -99,31 +82,41 @@ def getFCmetricsImproved():
         df = df.rename(columns=mapper)
         dfs.append(df)
 
-    undeter = parserDemultiplexStats(cfg)
     if len(dfs) > 1:
         dfs[0]["R2 %>=Q30"] = dfs[1]["%>=Q30"]
         dfs[0] = dfs[0].rename(columns={"%>=Q30": "R1 %>=Q30"})
-    dfs[0] = dfs[0].join(undeter.set_index("Lane"), on="Lane")
+    return dfs[0]
+
+
+def getFCmetricsImproved():
+    cfg = PipelineConfig.get()
+    message = ""
+    try:
+        df = interop.RunSummary.from_run(cfg.output_path).lane_table()
+    except Exception as e:
+        log.warning(f"[getFCmetrics] Native InterOp reader failed ({e}), using interop_summary.csv")
+        try:
+            df = lane_table_from_csv(cfg.output_path / "Stats" / "interop_summary.csv")
+        except Exception:
+            return "Not able to generate table for flowcell metrics."
+
+    undeter = parserDemultiplexStats(cfg)
+    df = df.join(undeter.set_index("Lane"), on="Lane")
     message += "\n<br><strong>Flowcell metrics </strong>\n<br>"
-    message += dfs[0].to_html(
+    message += df.to_html(
         index=False, classes="border-collapse: collapse", border=1, justify="center", col_space=12
     )
     return message
 
 
 def parseSampleSheetMetrics(cfg):
-    project_dirs = get_project_dirs(cfg)
-    project_names = get_project_names(project_dirs)
+    project_names = get_manifest(cfg).project_names()
     msg = "<strong>Sample sheet info</strong>\n"
     for pid in project_names:
-        args = Namespace(
-            samplesheet=[cfg.run.sample_sheet],
-            project_id=[pid],
-        )
-        sample_df, _, _ = cm.get_project_samples_from_samplesheet(args)
+        sample_df = inputs.project_samples(cfg.run.sample_sheet, pid)
         msg += f"<strong>{pid}</strong>: Found {len(sample_df)} samples in samplesheet.\n"
 
-    ssub_df, _ = cm.sample_submission_form_parser(cfg.run.sample_submission_form)
+    ssub_df, _ = inputs.submission_form(cfg.run.sample_submission_form)
     msg += f"\nFound {len(ssub_df.index)} samples in sample submission form.\n"
     if "Sample_Group" in ssub_df:
         if ssub_df["Sample_Group"].notnull().all():
@@ -146,49 +139,10 @@ def parseSampleSheetMetrics(cfg):
 
 def parserDemultiplexStats(cfg):
     """
-    Parse DemultiplexingStats.xml under outputDir/Stats/ to get the
-    number/percent of undetermined indices.
-
-    In particular, we extract the BarcodeCount values from Project "default"
-    Sample "all" and Project "all" Sample "all", as the former gives the total
-    undetermined and the later simply the total clusters
+    Percentage of undetermined reads per lane, from the demultiplexing statistics
+    (DemultiplexingStats.xml or bcl-convert's Demultiplex_Stats.csv).
     """
-
-    totals = [0, 0, 0, 0, 0, 0, 0, 0]
-    undetermined = [0, 0, 0, 0, 0, 0, 0, 0]
-    tree = ET.parse(cfg.output_path / "Stats" / "DemultiplexingStats.xml")
-    root = tree.getroot()
-    for child in root[0].findall("Project"):
-        if child.get("name") == "default":
-            break
-    for sample in child.findall("Sample"):
-        if sample.get("name") == "all":
-            break
-    child = sample[0]  # Get inside Barcode
-    for lane in child.findall("Lane"):
-        lnum = int(lane.get("number"))
-        undetermined[lnum - 1] += int(lane[0].text)
-
-    for child in root[0].findall("Project"):
-        if child.get("name") == "all":
-            break
-    for sample in child.findall("Sample"):
-        if sample.get("name") == "all":
-            break
-    child = sample[0]  # Get Inside Barcode
-    for lane in child.findall("Lane"):
-        lnum = int(lane.get("number"))
-        totals[lnum - 1] += int(lane[0].text)
-
-    lanes = []
-    undeter = []
-    for i in range(8):
-        if totals[i] == 0:
-            continue
-        lanes.append(i + 1)
-        undeter.append(100 * undetermined[i] / totals[i])
-        # out_d.append({"Lane": i+1, "Undetermined": 100*undetermined[i]/totals[i]})
-    return pd.DataFrame.from_dict({"Lane": lanes, "% Undetermined": undeter}).round(2)
+    return demux_stats.load(cfg.output_path).undetermined_table()
 
 
 def enoughFreeSpace():
@@ -209,9 +163,9 @@ def errorEmail(errTuple, msg):
     (cfg.static.paths.report_dir / f"{cfg.run.run_id}.error").write_text(msg)
 
 
-def finishedEmail(msg, runTime, extra_html=True):
+def finishedEmail(msg, runTime):
     cfg = PipelineConfig.get()
-    projects = get_project_names(get_project_dirs(cfg))
+    projects = get_manifest(cfg).project_names()
 
     message = f"<strong>Short summary for {', '.join(projects)}. </strong>\n\n"
     message += f"<strong>User: {cfg.run.user} </strong>\n" if cfg.run.user != "N/A" else ""
@@ -228,58 +182,50 @@ def finishedEmail(msg, runTime, extra_html=True):
     sample_sheet_metrics = parseSampleSheetMetrics(cfg)
     sample_sheet_metrics = sample_sheet_metrics.replace("\n", "\n<br>")
 
-    message = (
-        "<html>\n<body>\n<head>\n"
-        + style
-        + "\n</head>\n"
-        + message
-        + "<br>"
-        + sample_sheet_metrics
-        + "\n</body>\n</html>"
-    )
-
-    msg = MIMEMultipart()
-    msg["Subject"] = f"[bcl2fastq_pipeline] {', '.join(projects)} processed"
-    msg["From"] = cfg.static.email["from_address"]
-    msg["To"] = cfg.static.email["finished_to"]
-    msg["Date"] = formatdate(localtime=True)
-
-    msg.attach(MIMEText(message, "html"))
-
     date = cfg.run.run_id.split("_")[0]
-
+    reports = []
     for p in projects:
-        with (cfg.output_path / f"multiqc_{p}_{date}.html").open("rb") as report:
-            part = MIMEApplication(report.read(), report.name)
-        part["Content-Disposition"] = f'attachment; filename="multiqc_{p}_{date}.html"'
-        msg.attach(part)
-
-        if (
-            cfg.run.libprep.startswith(("10X Genomics Chromium Single Cell", "Parse Biosciences"))
-            and extra_html
-        ):
+        reports.append(cfg.output_path / f"multiqc_{p}_{date}.html")
+        if cfg.run.libprep_info.extra_html:
             f = cfg.output_path / f"all_samples_web_summary_{p}_{date}.html"
             if f.exists():
-                fname = f.name
-                with f.open("rb") as report:
-                    part = MIMEApplication(report.read(), report.name)
-                part["Content-Disposition"] = f'attachment; filename="{fname}"'
-                msg.attach(part)
+                reports.append(f)
     project_str = "_".join(projects)
-    with (cfg.output_path / "Stats" / f"sequencer_stats_{project_str}.html").open("rb") as report:
-        part = MIMEApplication(report.read(), report.name)
-    part["Content-Disposition"] = f'attachment; filename="sequencer_stats_{project_str}.html"'
-    msg.attach(part)
+    reports.append(cfg.output_path / "Stats" / f"sequencer_stats_{project_str}.html")
+
+    budget_mb = float(cfg.static.email.get("attachment_budget_mb", attachments.DEFAULT_BUDGET_MB))
+    with tempfile.TemporaryDirectory() as tmp:
+        plan = attachments.plan(
+            reports, int(budget_mb * 1024**2), Path(tmp), f"reports_{project_str}_{date}.zip"
+        )
+        message += plan.summary_html()
+
+        message = (
+            "<html>\n<body>\n<head>\n"
+            + style
+            + "\n</head>\n"
+            + message
+            + "<br>"
+            + sample_sheet_metrics
+            + "\n</body>\n</html>"
+        )
+
+        msg = MIMEMultipart()
+        msg["Subject"] = f"[bcl2fastq_pipeline] {', '.join(projects)} processed"
+        msg["From"] = cfg.static.email["from_address"]
+        msg["To"] = cfg.static.email["finished_to"]
+        msg["Date"] = formatdate(localtime=True)
+
+        msg.attach(MIMEText(message, "html"))
 
-    s = smtplib.SMTP(cfg.static.email["host"])
-    s.send_message(msg)
-    s.quit()
+        # the zip is copied into the spool before the directory is removed
+        outbox.send(cfg, msg, plan.attach)
 
 
 def finalizedEmail(msg, finalizeTime, runTime):
     cfg = PipelineConfig.get()
 
-    projects = get_project_names(get_project_dirs(cfg))
+    projects = get_manifest(cfg).project_names()
 
     message = f"{', '.join(projects)} has been finalized and prepared for delivery.\n\n"
     message += f"md5sum and 7zip runtime: {finalizeTime}\n"
@@ -294,6 +240,4 @@ def finalizedEmail(msg, finalizeTime, runTime):
 
     msg.attach(MIMEText(message))
 
-    s = smtplib.SMTP(cfg.static.email["host"])
-    s.send_message(msg)
-    s.quit()
+    outbox.send(cfg, msg)
@@ -0,0 +1,317 @@
+"""
+On-disk outbox for the pipeline's emails.
+
+Messages are written to a spool directory and delivered by a background
+thread, so a slow or unreachable mail server never blocks the processing of
+a run. The spool lives in ``[System]->outbox_dir`` (default
+``log_dir/outbox``):
+
+    queue/<id>.eml   – messages waiting for delivery
+    queue/<id>.json  – their delivery state: attempts, next attempt, last error
+    sent/            – delivered messages
+    failed/          – messages that could not be delivered after max_attempts
+    leases/          – a lease on each message while an instance is sending it
+    deliveries.jsonl – one line per delivery attempt
+
+Attachments passed to enqueue() are streamed from disk into the spooled
+message, base64 encoded in chunks, so large reports are never held in memory.
+
+The sender keeps its SMTP connection open while there is mail to send and for
+a short while after, and retries failed messages with exponential backoff.
+Only temporary failures are retried (connection errors, 4xx replies); a
+message the server refuses for good (5xx: refused sender or recipients,
+message too large) goes to failed/ at once.
+Messages left in the queue by a previous process are sent when the sender
+starts again.
+
+Several bfq instances may share the spool. A sender leases a message (see
+lease) before it sends it and skips messages leased by another instance, so
+each message is sent once. The lease of a sender that died is taken over
+after lease.DEFAULT_TTL seconds.
+"""
+
+from __future__ import annotations
+
+import base64
+import datetime
+import email.policy
+import json
+import logging
+import mimetypes
+import os
+import smtplib
+import threading
+import time
+import uuid
+
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass
+from email.message import Message
+from email.mime.base import MIMEBase
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+from pathlib import Path
+
+from bcl2fastq_pipeline import lease, tracing
+
+log = logging.getLogger(__name__)
+
+IDLE_TIMEOUT = 60.0
+# a multiple of 57 bytes, so every chunk encodes to whole 76 character lines
+CHUNK = 57 * 1024
+
+
+@dataclass
+class Delivery:
+    """Delivery state of one spooled message."""
+
+    id: str
+    subject: str
+    to: str
+    queued: str
+    attempts: int = 0
+    next_attempt: float = 0.0
+    status: str = "queued"
+    last_error: str | None = None
+
+
+def permanent(e: Exception) -> bool:
+    """Whether an SMTP error is a 5xx reply, which sending again will not change."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in e.recipients.values())
+    return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+
+
+def outbox_dir(cfg) -> Path:
+    return Path(cfg.static.system.get("outbox_dir", cfg.static.paths.log_dir / "outbox"))
+
+
+class Outbox:
+    """The spool directory and the thread that empties it."""
+
+    def __init__(
+        self,
+        root: Path,
+        host: str,
+        max_attempts: int = 10,
+        backoff: float = 30.0,
+        max_backoff: float = 3600.0,
+    ):
+        self.root = Path(root)
+        self.host = host
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        for d in ("queue", "sent", "failed"):
+            (self.root / d).mkdir(parents=True, exist_ok=True)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._smtp: smtplib.SMTP | None = None
+        self.claims = lease.LeaseDir(self.root / "leases")
+
+    # --- spool -------------------------------------------------------------- #
+    def enqueue(self, msg: Message, attachments: Iterable[tuple[Path, str]] = ()) -> str:
+        """
+        Write msg to the queue and wake the sender. Returns the message id.
+
+        attachments are (path, file name) pairs. They are added to msg (which
+        must be multipart) and their contents are streamed into the spool file.
+        """
+        msg_id = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+        queue = self.root / "queue"
+        delivery = Delivery(
+            id=msg_id,
+            subject=str(msg.get("Subject", "")),
+            to=str(msg.get("To", "")),
+            queued=datetime.datetime.now().isoformat(timespec="seconds"),
+        )
+        placeholders = {}
+        for path, name in attachments:
+            token = f"bfq-attachment-{uuid.uuid4().hex}"
+            ctype, _ = mimetypes.guess_type(name)
+            part = MIMEBase(*(ctype or "application/octet-stream").split("/", 1))
+            part.set_payload(token)
+            part["Content-Transfer-Encoding"] = "base64"
+            part.add_header("Content-Disposition", "attachment", filename=name)
+            msg.attach(part)
+            placeholders[token.encode()] = Path(path)
+
+        tmp = queue / f".{msg_id}.eml.tmp"
+        with (
+            tracing.span("email", subject=delivery.subject, attachments=len(placeholders)) as span,
+            tmp.open("wb") as fh,
+        ):
+            # CRLF line endings throughout, the spooled bytes go to the server as they are
+            raw = msg.as_bytes(policy=email.policy.SMTP)
+            for token, path in placeholders.items():
+                head, raw = raw.split(token, 1)
+                fh.write(head)
+                with path.open("rb") as src:
+                    while chunk := src.read(CHUNK):
+                        fh.write(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
+            fh.write(raw)
+            span.set(bytes=fh.tell())
+        self._save_state(delivery)
+        # the .eml appears last, so the sender never sees a message without its state
+        os.replace(tmp, queue / f"{msg_id}.eml")
+        log.info(f"[outbox] Queued {msg_id}: {delivery.subject}")
+        self._wake.set()
+        return msg_id
+
+    def _save_state(self, delivery: Delivery) -> None:
+        path = self.root / "queue" / f"{delivery.id}.json"
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_text(json.dumps(asdict(delivery)))
+        os.replace(tmp, path)
+
+    def _load_state(self, eml: Path) -> Delivery:
+        try:
+            return Delivery(**json.loads(eml.with_suffix(".json").read_text()))
+        except (OSError, ValueError, TypeError):
+            return Delivery(id=eml.stem, subject="", to="", queued="")
+
+    def _record(self, delivery: Delivery) -> None:
+        entry = asdict(delivery) | {"time": datetime.datetime.now().isoformat(timespec="seconds")}
+        with (self.root / "deliveries.jsonl").open("a") as fh:
+            fh.write(json.dumps(entry) + "\n")
+
+    def _finish(self, eml: Path, delivery: Delivery, where: str) -> None:
+        delivery.status = where
+        self._record(delivery)
+        os.replace(eml, self.root / where / eml.name)
+        (self.root / where / f"{delivery.id}.json").write_text(json.dumps(asdict(delivery)))
+        eml.with_suffix(".json").unlink(missing_ok=True)
+
+    def pending(self) -> list[Delivery]:
+        return [self._load_state(e) for e in sorted((self.root / "queue").glob("*.eml"))]
+
+    # --- sending ------------------------------------------------------------ #
+    def _connection(self) -> smtplib.SMTP:
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except smtplib.SMTPException:
+                pass
+            self._close()
+        self._smtp = smtplib.SMTP(self.host, timeout=60)
+        return self._smtp
+
+    def _close(self) -> None:
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self._smtp.close()
+            self._smtp = None
+
+    def _send(self, eml: Path, delivery: Delivery) -> None:
+        with eml.open("rb") as fh:
+            headers = BytesHeaderParser().parse(fh)
+        sender = headers["From"]
+        rcpts = [a for _, a in getaddresses(headers.get_all("To", []) + headers.get_all("Cc", []))]
+        delivery.attempts += 1
+        try:
+            # the spooled bytes are sent as they are, without parsing the attachments
+            with tracing.span("email.send", id=delivery.id, attempt=delivery.attempts) as span:
+                span.set(bytes=eml.stat().st_size)
+                self._connection().sendmail(sender, rcpts, eml.read_bytes())
+        except (smtplib.SMTPException, OSError) as e:
+            self._close()
+            delivery.last_error = f"{type(e).__name__}: {e}"
+            if permanent(e):
+                log.error(f"[outbox] {delivery.id} was refused by the server: {e}")
+                self._finish(eml, delivery, "failed")
+                return
+            if delivery.attempts >= self.max_attempts:
+                log.error(
+                    f"[outbox] Giving up on {delivery.id} after {delivery.attempts} attempts: {e}"
+                )
+                self._finish(eml, delivery, "failed")
+                return
+            delay = min(self.backoff * 2 ** (delivery.attempts - 1), self.max_backoff)
+            delivery.next_attempt = time.time() + delay
+            delivery.status = "retrying"
+            log.warning(f"[outbox] Sending {delivery.id} failed ({e}), retrying in {delay:.0f}s")
+            self._record(delivery)
+            self._save_state(delivery)
+            return
+        log.info(f"[outbox] Sent {delivery.id}: {delivery.subject}")
+        delivery.last_error = None
+        self._finish(eml, delivery, "sent")
+
+    def flush(self) -> float | None:
+        """Send all messages that are due. Returns the time of the next retry, if any."""
+        next_due = None
+        for eml in sorted((self.root / "queue").glob("*.eml")):
+            delivery = self._load_state(eml)
+            if delivery.next_attempt > time.time():
+                next_due = min(next_due or delivery.next_attempt, delivery.next_attempt)
+                continue
+            claim = self.claims.acquire(f"mail-{eml.stem}")
+            if claim is None:
+                # another instance is sending it
+                continue
+            try:
+                # the state on disk is the latest, unless another instance sent it in the meantime
+                if eml.exists():
+                    self._send(eml, self._load_state(eml))
+            finally:
+                self.claims.release(claim)
+            if eml.exists():
+                # still queued, the server is not accepting mail right now
+                d = self._load_state(eml)
+                next_due = min(next_due or d.next_attempt, d.next_attempt)
+        return next_due
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                next_due = self.flush()
+            except Exception:
+                log.exception("[outbox] Unexpected error in the sender")
+                next_due = time.time() + self.backoff
+            timeout = IDLE_TIMEOUT if next_due is None else max(0.0, next_due - time.time())
+            if not self._wake.wait(timeout=min(timeout, IDLE_TIMEOUT)):
+                # nothing new within the idle timeout, release the connection
+                self._close()
+            self._wake.clear()
+        self._close()
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+_outboxes: dict[Path, Outbox] = {}
+_outboxes_lock = threading.Lock()
+
+
+def get_outbox(cfg) -> Outbox:
+    """The running outbox of this process, started on first use."""
+    root = outbox_dir(cfg)
+    with _outboxes_lock:
+        if root not in _outboxes:
+            _outboxes[root] = Outbox(
+                root,
+                cfg.static.email["host"],
+                max_attempts=int(cfg.static.system.get("email_max_attempts", 10)),
+                backoff=float(cfg.static.system.get("email_retry_seconds", 30)),
+            )
+        box = _outboxes[root]
+    box.start()
+    return box
+
+
+def send(cfg, msg: Message, attachments: Iterable[tuple[Path, str]] = ()) -> str:
+    """Queue msg (with attachments, see Outbox.enqueue) for delivery and return immediately."""
+    return get_outbox(cfg).enqueue(msg, attachments)
@@ -0,0 +1,334 @@
+"""
+Resource use of the external commands of a run, sampled from /proc.
+
+The heavy lifting of a run happens in child processes (bcl-convert,
+cellranger, snakemake and its containers, 7za, md5sum, pigz). Every command
+started through tracing.check_call() is watched by a sampler thread, which
+walks the process tree of the command every ``[System]->procmon_interval``
+seconds (default 5, 0 switches it off) and records:
+
+    • CPU use of the whole tree, in % of one core
+    • resident memory (RSS) of the whole tree
+    • bytes read and written since the previous sample
+    • the number of processes and threads
+
+The samples are appended to ``log_dir/<run_id>.procmon.tsv``. When a command
+ends, its peak and average use are added to its span in the trace; when a
+stage ends, the same is done for the stage (all its commands together) and a
+line is appended to ``log_dir/<run_id>.procmon.summary.tsv``.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from bcl2fastq_pipeline import tracing
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 5.0
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+COLUMNS = (
+    "time",
+    "stage",
+    "command",
+    "span_id",
+    "procs",
+    "threads",
+    "cpu_pct",
+    "rss_mb",
+    "read_mb",
+    "write_mb",
+)
+SUMMARY_COLUMNS = (
+    "stage",
+    "span_id",
+    "seconds",
+    "samples",
+    "cpu_avg_pct",
+    "cpu_peak_pct",
+    "rss_avg_mb",
+    "rss_peak_mb",
+    "read_mb",
+    "write_mb",
+    "threads_peak",
+)
+
+
+@dataclass
+class ProcStat:
+    """The fields of /proc/<pid>/stat and /proc/<pid>/io that are sampled."""
+
+    ppid: int
+    cpu_ticks: int
+    threads: int
+    rss: int
+    read_bytes: int = 0
+    write_bytes: int = 0
+
+
+def read_stat(pid: int) -> ProcStat | None:
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as fh:
+            data = fh.read()
+    except OSError:
+        return None
+    # the command name may contain spaces and parentheses
+    f = data[data.rfind(b")") + 2 :].split()
+    return ProcStat(
+        ppid=int(f[1]),
+        cpu_ticks=int(f[11]) + int(f[12]),
+        threads=int(f[17]),
+        rss=int(f[21]) * PAGE_SIZE,
+    )
+
+
+def read_io(pid: int, stat: ProcStat) -> None:
+    try:
+        with open(f"/proc/{pid}/io", "rb") as fh:
+            for line in fh:
+                key, _, value = line.partition(b":")
+                if key == b"read_bytes":
+                    stat.read_bytes = int(value)
+                elif key == b"write_bytes":
+                    stat.write_bytes = int(value)
+    except OSError:
+        # processes of other users (setuid, containers) do not expose their io
+        pass
+
+
+def children_map() -> dict[int, list[int]]:
+    """ppid -> pids of all processes."""
+    children: dict[int, list[int]] = {}
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        stat = read_stat(int(entry.name))
+        if stat is not None:
+            children.setdefault(stat.ppid, []).append(int(entry.name))
+    return children
+
+
+def process_tree(root: int, children: dict[int, list[int]]) -> list[int]:
+    tree, todo = [], [root]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, ()))
+    return tree
+
+
+@dataclass
+class Usage:
+    """Running totals of the samples of a command or stage."""
+
+    samples: int = 0
+    cpu_sum: float = 0.0
+    cpu_peak: float = 0.0
+    rss_sum: float = 0.0
+    rss_peak: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    threads_peak: int = 0
+
+    def add(self, cpu: float, rss: int, read: int, write: int, threads: int) -> None:
+        self.samples += 1
+        self.cpu_sum += cpu
+        self.cpu_peak = max(self.cpu_peak, cpu)
+        self.rss_sum += rss
+        self.rss_peak = max(self.rss_peak, rss)
+        self.read_bytes += read
+        self.write_bytes += write
+        self.threads_peak = max(self.threads_peak, threads)
+
+    def as_attrs(self) -> dict:
+        n = self.samples or 1
+        return {
+            "cpu_avg_pct": round(self.cpu_sum / n, 1),
+            "cpu_peak_pct": round(self.cpu_peak, 1),
+            "rss_avg_mb": round(self.rss_sum / n / 1024**2, 1),
+            "rss_peak_mb": round(self.rss_peak / 1024**2, 1),
+            "read_mb": round(self.read_bytes / 1024**2, 1),
+            "write_mb": round(self.write_bytes / 1024**2, 1),
+            "threads_peak": self.threads_peak,
+        }
+
+
+@dataclass
+class Watched:
+    """A command being sampled."""
+
+    span: tracing.Span
+    stage: str | None
+    usage: Usage = field(default_factory=Usage)
+    # pid -> (cpu ticks, read bytes, write bytes) at the previous sample
+    last: dict[int, tuple[int, int, int]] = field(default_factory=dict)
+    last_time: float = field(default_factory=time.monotonic)
+
+
+class ProcessMonitor:
+    """Samples the process trees of the running commands from a background thread."""
+
+    def __init__(self) -> None:
+        self.interval = DEFAULT_INTERVAL
+        self.log_dir: Path | None = None
+        self._watched: dict[str, Watched] = {}
+        # span id -> (stage span id, stage name), for spans that are open
+        self._stage_of: dict[str, tuple[str, str]] = {}
+        self._stages: dict[str, Usage] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def configure(self, cfg) -> None:
+        self.log_dir = Path(cfg.static.paths.log_dir)
+        self.interval = float(cfg.static.system.get("procmon_interval", DEFAULT_INTERVAL))
+        if self.interval > 0:
+            tracing.add_listener(self.on_span)
+        else:
+            tracing.remove_listener(self.on_span)
+
+    # --- span events -------------------------------------------------------- #
+    def on_span(self, event: str, span: tracing.Span) -> None:
+        with self._lock:
+            if event == "start":
+                run = tracing.root()
+                if span is run:
+                    return
+                if span.parent_id in self._stage_of:
+                    self._stage_of[span.span_id] = self._stage_of[span.parent_id]
+                else:
+                    self._stage_of[span.span_id] = (span.span_id, span.name)
+                    self._stages[span.span_id] = Usage()
+            elif event == "process":
+                stage = self._stage_of.get(span.span_id)
+                self._watched[span.span_id] = Watched(span, stage[1] if stage else None)
+                self._start()
+            elif event == "end":
+                watched = self._watched.pop(span.span_id, None)
+                if watched is not None and watched.usage.samples:
+                    span.set(**watched.usage.as_attrs())
+                self._stage_of.pop(span.span_id, None)
+                usage = self._stages.pop(span.span_id, None)
+                if usage is not None and usage.samples:
+                    span.set(**usage.as_attrs())
+                    self._write_summary(span, usage)
+
+    # --- sampling ----------------------------------------------------------- #
+    def _start(self) -> None:
+        self._wake.set()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="procmon", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                idle = not self._watched
+            if idle:
+                # sleep until the next command starts
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception:
+                log.exception("[procmon] Sampling failed")
+
+    def sample(self) -> None:
+        children = children_map()
+        now = time.monotonic()
+        rows = []
+        with self._lock:
+            watched = list(self._watched.values())
+            stage_totals: dict[str, list] = {}
+            for w in watched:
+                pid = w.span.attrs.get("pid")
+                if pid is None:
+                    continue
+                elapsed = max(now - w.last_time, 1e-6)
+                procs = threads = rss = ticks = read = write = 0
+                current = {}
+                for p in process_tree(pid, children):
+                    stat = read_stat(p)
+                    if stat is None:
+                        continue
+                    read_io(p, stat)
+                    # a process not seen before started after the previous sample
+                    prev = w.last.get(p, (0, 0, 0))
+                    current[p] = (stat.cpu_ticks, stat.read_bytes, stat.write_bytes)
+                    procs += 1
+                    threads += stat.threads
+                    rss += stat.rss
+                    ticks += stat.cpu_ticks - prev[0]
+                    read += stat.read_bytes - prev[1]
+                    write += stat.write_bytes - prev[2]
+                w.last, w.last_time = current, now
+                cpu = 100.0 * ticks / CLK_TCK / elapsed
+                w.usage.add(cpu, rss, read, write, threads)
+                stage_id = self._stage_of.get(w.span.span_id, (None,))[0]
+                if stage_id in self._stages:
+                    t = stage_totals.setdefault(stage_id, [0.0, 0, 0, 0, 0])
+                    for i, v in enumerate((cpu, rss, read, write, threads)):
+                        t[i] += v
+                rows.append(
+                    (
+                        f"{time.time():.0f}",
+                        w.stage or "",
+                        w.span.name,
+                        w.span.span_id,
+                        procs,
+                        threads,
+                        f"{cpu:.1f}",
+                        f"{rss / 1024**2:.1f}",
+                        f"{read / 1024**2:.2f}",
+                        f"{write / 1024**2:.2f}",
+                    )
+                )
+            for stage_id, t in stage_totals.items():
+                self._stages[stage_id].add(*t)
+        if rows and watched:
+            self._append(watched[0].span.run_id, "procmon.tsv", COLUMNS, rows)
+
+    # --- output ------------------------------------------------------------- #
+    def _append(self, run_id: str | None, suffix: str, columns: tuple, rows: list) -> None:
+        if self.log_dir is None or not run_id:
+            return
+        path = self.log_dir / f"{run_id}.{suffix}"
+        try:
+            new = not path.exists()
+            with path.open("a") as fh:
+                if new:
+                    fh.write("\t".join(columns) + "\n")
+                for row in rows:
+                    fh.write("\t".join(map(str, row)) + "\n")
+        except OSError as e:
+            log.warning(f"[procmon] Could not write {path}: {e}")
+
+    def _write_summary(self, span: tracing.Span, usage: Usage) -> None:
+        attrs = usage.as_attrs()
+        row = (span.name, span.span_id, f"{span.duration:.0f}", usage.samples) + tuple(
+            attrs[c] for c in SUMMARY_COLUMNS[4:]
+        )
+        self._append(span.run_id, "procmon.summary.tsv", SUMMARY_COLUMNS, [row])
+        log.info(
+            f"[procmon] {span.name}: CPU avg {attrs['cpu_avg_pct']}% peak {attrs['cpu_peak_pct']}%, "
+            f"RSS peak {attrs['rss_peak_mb']} MB, read {attrs['read_mb']} MB, "
+            f"written {attrs['write_mb']} MB"
+        )
+
+
+_monitor = ProcessMonitor()
+
+
+def configure(cfg) -> None:
+    """Sample the commands of the runs of cfg, unless [System]->procmon_interval is 0."""
+    _monitor.configure(cfg)
@@ -0,0 +1,301 @@
+"""
+On-demand profiling of the stages of bfq.py.
+
+Profiling is off by default and then costs nothing: no profiler runs and no
+tracing listener is registered. It is switched on with an environment
+variable or, in a running bfq.py, with a signal:
+
+    BFQ_PROFILE=cprofile,memory bfq.py   # profile every stage
+    kill -USR1 <pid>                     # toggle profiling of the next stages
+
+BFQ_PROFILE is a comma-separated list of profilers (SIGUSR1 uses
+``cprofile`` if it is not set):
+
+    • cprofile – deterministic cProfile of the thread running the stage
+    • sample   – samples the stacks of all threads (including the analysis
+                 threads of full_align) every BFQ_PROFILE_INTERVAL seconds
+    • memory   – tracemalloc snapshot of the allocations made by the stage
+
+Every top-level span (the stages of a run and the work outside of runs, see
+tracing) is profiled on its own. The output is written next to the run log,
+to ``log_dir/<run_id>.profile/`` (``log_dir/profile/`` outside of runs):
+
+    <stage>.prof        – cProfile data, for pstats or snakeviz
+    <stage>.txt         – the BFQ_PROFILE_TOP (default 30) most expensive functions
+    <stage>.stacks      – sampled stacks in collapsed format, for flamegraph.pl
+    <stage>.memory.txt  – the lines that allocated the most memory
+"""
+
+from __future__ import annotations
+
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import tracemalloc
+
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+
+from bcl2fastq_pipeline import tracing
+
+log = logging.getLogger(__name__)
+
+PROFILERS = ("cprofile", "sample", "memory")
+DEFAULT_TOP = 30
+DEFAULT_INTERVAL = 0.01
+
+
+def _modes(value: str | None) -> tuple[str, ...]:
+    modes = tuple(m.strip().lower() for m in (value or "").split(",") if m.strip())
+    if modes in (("1",), ("true",), ("yes",)):
+        return ("cprofile",)
+    unknown = set(modes) - set(PROFILERS)
+    if unknown:
+        log.warning(f"[profiling] Unknown profilers ignored: {', '.join(sorted(unknown))}")
+    return tuple(m for m in modes if m in PROFILERS)
+
+
+class StackSampler:
+    """Counts the stacks of all threads, sampled from a background thread."""
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.own: Counter[str] = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _sample(self) -> None:
+        me = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            f = frame
+            while f is not None:
+                code = f.f_code
+                stack.append(
+                    f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+                )
+                f = f.f_back
+            if not stack:
+                continue
+            self.own[stack[0]] += 1
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def summary(self, top: int) -> str:
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f} ms, own time:"]
+        total = sum(self.own.values()) or 1
+        for func, n in self.own.most_common(top):
+            lines.append(f"{100 * n / total:6.1f}%  {n:7d}  {func}")
+        return "\n".join(lines) + "\n"
+
+
+@dataclass
+class Session:
+    """The profilers running for one span."""
+
+    span: tracing.Span
+    modes: tuple[str, ...]
+    profile: cProfile.Profile | None = None
+    sampler: StackSampler | None = None
+    started_tracemalloc: bool = False
+    snapshot: tracemalloc.Snapshot | None = None
+
+    def start(self, interval: float) -> None:
+        if "memory" in self.modes:
+            self.started_tracemalloc = not tracemalloc.is_tracing()
+            if self.started_tracemalloc:
+                tracemalloc.start(10)
+            self.snapshot = tracemalloc.take_snapshot()
+        if "sample" in self.modes:
+            self.sampler = StackSampler(interval)
+            self.sampler.start()
+        if "cprofile" in self.modes:
+            self.profile = cProfile.Profile()
+            try:
+                self.profile.enable()
+            except ValueError as e:
+                # another profiler is active in this process
+                log.warning(f"[profiling] cProfile not started for {self.span.name}: {e}")
+                self.profile = None
+
+    def stop(self, out_dir: Path, top: int) -> list[Path]:
+        written = []
+        stem = re.sub(r"[^\w.-]+", "_", self.span.name)
+        if self.span.attrs.get("project"):
+            stem += f"_{self.span.attrs['project']}"
+        out_dir.mkdir(parents=True, exist_ok=True)
+        header = (
+            f"{self.span.name} {self.span.attrs} "
+            f"{datetime.datetime.fromtimestamp(self.span.start):%Y-%m-%d %H:%M:%S}, "
+            f"{self.span.duration:.1f} s, status {self.span.status}\n\n"
+        )
+
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile.dump_stats(out_dir / f"{stem}.prof")
+            buf = io.StringIO()
+            stats = pstats.Stats(self.profile, stream=buf)
+            stats.sort_stats("cumulative").print_stats(top)
+            stats.sort_stats("tottime").print_stats(top)
+            (out_dir / f"{stem}.txt").write_text(header + buf.getvalue())
+            written += [out_dir / f"{stem}.prof", out_dir / f"{stem}.txt"]
+
+        if self.sampler is not None:
+            self.sampler.stop()
+            (out_dir / f"{stem}.stacks").write_text(self.sampler.collapsed())
+            with (out_dir / f"{stem}.txt").open("a" if self.profile else "w") as fh:
+                if self.profile is None:
+                    fh.write(header)
+                fh.write("\nSampled stacks\n" + self.sampler.summary(top))
+            written.append(out_dir / f"{stem}.stacks")
+
+        if self.snapshot is not None:
+            after = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+            lines = [header.rstrip(), f"peak traced memory: {peak / 1024**2:.1f} MiB", ""]
+            for stat in after.compare_to(self.snapshot, "lineno")[:top]:
+                lines.append(str(stat))
+            (out_dir / f"{stem}.memory.txt").write_text("\n".join(lines) + "\n")
+            written.append(out_dir / f"{stem}.memory.txt")
+        return written
+
+
+class Profiler:
+    """Starts a Session for each top-level span while profiling is enabled."""
+
+    def __init__(self) -> None:
+        self.modes: tuple[str, ...] = ()
+        self.log_dir: Path | None = None
+        self.top = int(os.environ.get("BFQ_PROFILE_TOP", DEFAULT_TOP))
+        self.interval = float(os.environ.get("BFQ_PROFILE_INTERVAL", DEFAULT_INTERVAL))
+        self._sessions: dict[str, Session] = {}
+        self._lock = threading.Lock()
+        self._env_applied = False
+        # set by the SIGUSR1 handler, applied at the next span or configure()
+        self.toggle_pending = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.modes)
+
+    def enable(self, modes: tuple[str, ...]) -> None:
+        self.modes = modes
+        if modes:
+            tracing.add_listener(self.on_span)
+            log.info(f"[profiling] Profiling stages with {', '.join(modes)}")
+
+    def disable(self) -> None:
+        self.modes = ()
+        with self._lock:
+            if not self._sessions:
+                # otherwise the listener is removed once the running stage ends
+                tracing.remove_listener(self.on_span)
+        log.info("[profiling] Profiling switched off")
+
+    def _top_level(self, span: tracing.Span) -> bool:
+        run = tracing.root()
+        if span is run:
+            return False
+        return span.parent_id is None or (run is not None and span.parent_id == run.span_id)
+
+    def _out_dir(self, span: tracing.Span) -> Path:
+        log_dir = self.log_dir or Path.cwd()
+        return log_dir / (f"{span.run_id}.profile" if span.run_id else "profile")
+
+    def apply_toggle(self) -> None:
+        """Switch profiling on (BFQ_PROFILE or cprofile) or off, if a toggle was requested."""
+        if not self.toggle_pending:
+            return
+        self.toggle_pending = False
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable(_modes(os.environ.get("BFQ_PROFILE")) or ("cprofile",))
+
+    def on_span(self, event: str, span: tracing.Span) -> None:
+        if event == "start":
+            self.apply_toggle()
+            if not self.enabled:
+                with self._lock:
+                    idle = not self._sessions
+                if idle:
+                    # switched off, or a toggle taken back before it was applied
+                    tracing.remove_listener(self.on_span)
+                return
+        if event == "start" and self._top_level(span):
+            with self._lock:
+                if self._sessions:
+                    # one stage at a time, the profilers are process wide
+                    return
+                session = Session(span, self.modes)
+                self._sessions[span.span_id] = session
+            session.start(self.interval)
+        elif event == "end":
+            with self._lock:
+                session = self._sessions.pop(span.span_id, None)
+            if session is None:
+                return
+            try:
+                written = session.stop(self._out_dir(span), self.top)
+                log.info(f"[profiling] {span.name}: {', '.join(str(p) for p in written)}")
+            except OSError as e:
+                log.warning(f"[profiling] Could not write the profile of {span.name}: {e}")
+            if not self.enabled:
+                tracing.remove_listener(self.on_span)
+
+
+_profiler = Profiler()
+
+
+def configure(cfg) -> None:
+    """Write profiles to the log_dir of cfg, and enable profiling once if BFQ_PROFILE is set."""
+    _profiler.log_dir = Path(cfg.static.paths.log_dir)
+    _profiler.apply_toggle()
+    if not _profiler._env_applied:
+        _profiler._env_applied = True
+        modes = _modes(os.environ.get("BFQ_PROFILE"))
+        if modes:
+            _profiler.enable(modes)
+
+
+def toggle(signo=None, _frame=None) -> None:
+    """
+    Signal handler: switch profiling on or off from the next stage.
+
+    The handler runs between two bytecodes of the main thread, which may hold
+    the profiler's lock or be logging, so it takes no lock and only requests
+    the toggle; the listener (a lock-free list append) applies it at the next span.
+    """
+    _profiler.toggle_pending = not _profiler.toggle_pending
+    tracing.add_listener(_profiler.on_span)
@@ -0,0 +1,157 @@
+"""
+Cross-run cache of the per-sample QC output of the analysis workflows.
+
+When full_align() has to redo a project (after a crash or a manual rerun),
+most samples usually have byte-identical FASTQ files. The per-sample files
+in ``data/tmp/{pipeline}/bfq`` are cached under a key made of
+
+    • the md5sums of the sample's FASTQ files (from the run manifest)
+    • the content digest of the gcf-workflows snapshot
+    • the libprep, its libprep.config entry and the pipeline name
+
+and restored before snakemake starts, so snakemake only computes what is
+missing. Entries are reflinked where the filesystem allows and copied
+otherwise, never hardlinked: a rule rewriting its output in place would
+change the cached file as well. Files that do not belong to a single sample
+(the multiqc report, summaries) are never cached.
+
+A file belongs to a sample if a component of its path relative to the bfq
+directory is the sample name, or starts with it followed by ``_``, ``.`` or
+``-``. The longest matching sample name wins, so ``S1`` never claims the
+files of ``S1_2``.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from pathlib import Path
+
+from bcl2fastq_pipeline import harvest, workspace
+from bcl2fastq_pipeline.manifest import get_manifest
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = "files.json"
+
+
+def cache_root(cfg) -> Path:
+    """[System]->qc_cache_dir, by default $TMPDIR/.bfq-qc-cache."""
+    root = cfg.static.system.get("qc_cache_dir")
+    if root is None:
+        return Path(os.environ.get("TMPDIR", "/tmp")) / ".bfq-qc-cache"
+    return Path(root)
+
+
+def sample_keys(cfg, project: str) -> dict[str, str]:
+    """Cache key of every sample in project whose FASTQ files all have an md5sum."""
+    manifest = get_manifest(cfg)
+    common = json.dumps(
+        {
+            "workflows": workspace.tree_digest(),
+            "libprep": cfg.run.libprep,
+            "libprep_config": cfg.run.libprep_info.entry,
+            "pipeline": cfg.run.pipeline,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    md5s: dict[str, list[str | None]] = {}
+    for f in manifest.project_files(project):
+        md5s.setdefault(f.sample, []).append(f.md5)
+
+    keys = {}
+    for sample, sums in md5s.items():
+        if None in sums:
+            continue
+        h = hashlib.sha256(common.encode())
+        h.update("\0".join(sorted(sums)).encode())
+        keys[sample] = h.hexdigest()
+    return keys
+
+
+def _owner(rel: Path, samples: list[str]) -> str | None:
+    # samples sorted longest first
+    for part in rel.parts:
+        for s in samples:
+            if part == s or (part.startswith(s) and part[len(s)] in "_.-"):
+                return s
+    return None
+
+
+def sample_files(bfq_dir: Path, samples: list[str]) -> dict[str, list[Path]]:
+    """Files below bfq_dir grouped by the sample they belong to, as relative paths."""
+    samples = sorted(samples, key=len, reverse=True)
+    owned: dict[str, list[Path]] = {}
+    for f in sorted(p for p in bfq_dir.rglob("*") if p.is_file()):
+        rel = f.relative_to(bfq_dir)
+        s = _owner(rel, samples)
+        if s:
+            owned.setdefault(s, []).append(rel)
+    return owned
+
+
+def _entry_dir(root: Path, key: str) -> Path:
+    return root / key[:2] / key
+
+
+def restore(cfg, project: str, analysis_dir: Path) -> int:
+    """Restore cached per-sample output into the bfq directory. Returns the number of samples."""
+    root = cache_root(cfg)
+    bfq_dir = analysis_dir / "data" / "tmp" / cfg.run.pipeline / "bfq"
+    restored = 0
+    now = time.time()
+    for sample, key in sample_keys(cfg, project).items():
+        entry = _entry_dir(root, key)
+        if not (entry / INDEX_NAME).exists():
+            continue
+        for rel in json.loads((entry / INDEX_NAME).read_text()):
+            dst = bfq_dir / rel
+            if dst.exists():
+                continue
+            # reflink or copy, a hardlink would let a rule rewriting dst corrupt the entry
+            harvest.harvest_file(entry / rel, dst, link=False)
+            # newer than the inputs, so snakemake considers it up to date
+            os.utime(dst, (now, now))
+        os.utime(entry, (now, now))
+        restored += 1
+    log.info(f"[qc_cache] Restored cached QC output for {restored} samples of {project}")
+    return restored
+
+
+def store(cfg, project: str, analysis_dir: Path) -> int:
+    """Add the per-sample output of a finished analysis to the cache. Returns the number of samples."""
+    root = cache_root(cfg)
+    bfq_dir = analysis_dir / "data" / "tmp" / cfg.run.pipeline / "bfq"
+    keys = sample_keys(cfg, project)
+    stored = 0
+    for sample, files in sample_files(bfq_dir, list(keys)).items():
+        entry = _entry_dir(root, keys[sample])
+        if entry.exists():
+            continue
+        tmp = entry.parent / f".tmp-{uuid.uuid4().hex}"
+        tmp.mkdir(parents=True)
+        harvest.harvest_files([(bfq_dir / rel, tmp / rel) for rel in files], link=False)
+        (tmp / INDEX_NAME).write_text(json.dumps([str(r) for r in files]))
+        try:
+            tmp.rename(entry)
+            stored += 1
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+    log.info(f"[qc_cache] Cached QC output for {stored} new samples of {project}")
+    prune(root, float(cfg.static.system.get("qc_cache_days", 90)))
+    return stored
+
+
+def prune(root: Path, max_age_days: float) -> None:
+    """Remove cache entries that have not been used for max_age_days."""
+    cutoff = time.time() - max_age_days * 24 * 3600
+    for entry in root.glob("*/*"):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff:
+            shutil.rmtree(entry, ignore_errors=True)
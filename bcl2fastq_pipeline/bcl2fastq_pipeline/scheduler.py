@@ -0,0 +1,243 @@
+"""
+The order in which bfq.py processes the completed runs.
+
+Every run waiting to be processed gets a score, and the run with the highest
+score goes first:
+
+    score = priority
+          + queue_sensitive_bonus      if SensitiveData is set     (default 20)
+          + queue_aging_per_hour     × hours since completion      (default 2)
+          − queue_runtime_weight     × estimated hours to process  (default 5)
+          − queue_user_penalty       × runs of the same user ahead (default 10)
+
+The priority is the Priority key of [CustomOptions] in the sample sheet, one of
+PRIORITIES or a number; operators can override it per run with
+``flowcell_manager.py reprioritize``, which also holds runs back ("hold").
+The weights are read from [System]. Aging makes every run reach the front
+eventually, the user penalty interleaves the runs of different users. The
+processing time is estimated from the lanes and cycles in RunInfo.xml and the
+instrument type.
+
+Runs already demultiplexed (fastq.made in the output directory) are not scored
+and come last, in path order, as before.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+
+from collections import Counter
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from bcl2fastq_pipeline.config import parse_custom_options
+
+log = logging.getLogger(__name__)
+
+COMPLETION_FILES = {
+    "SN7001334": "ImageAnalysis_Netcopy_complete.txt",
+    "NB501038": "RunCompletionStatus.xml",
+    "M026575": "ImageAnalysis_Netcopy_complete.txt",
+    "M03942": "ImageAnalysis_Netcopy_complete.txt",
+    "M05617": "ImageAnalysis_Netcopy_complete.txt",
+    "M71102": "ImageAnalysis_Netcopy_complete.txt",
+    "K00251": "SequencingComplete.txt",
+    "A01990": "CopyComplete.txt",
+    "MN00686": "CopyComplete.txt",
+}
+PRIORITIES = {"urgent": 100.0, "high": 50.0, "normal": 0.0, "low": -50.0}
+HOLD = "hold"
+# rough hours of demultiplexing and analysis per lane and cycle, by instrument id prefix
+HOURS_PER_LANE_CYCLE = {"A": 0.004, "SN": 0.002, "K": 0.002, "NB": 0.001, "MN": 0.0005, "M": 0.0005}
+OVERRIDES = "queue_priorities.json"
+
+
+def completed_runs(cfg) -> list[Path]:
+    """The completion files of the runs on the instrument mounts."""
+    dirs = list()
+    for pth in [cfg.static.paths.nova_base_dir, cfg.static.paths.ekista_base_dir]:
+        for machine, fin_file in COMPLETION_FILES.items():
+            dirs += list(pth.glob(f"*_{machine}_*/{fin_file}"))
+    return dirs
+
+
+def parse_priority(value: str) -> float | str:
+    """A priority name or number as points, or HOLD."""
+    value = value.strip().lower()
+    if value == HOLD:
+        return HOLD
+    if value in PRIORITIES:
+        return PRIORITIES[value]
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(
+            f"Unknown priority {value!r}, use {', '.join(PRIORITIES)}, hold or a number"
+        )
+
+
+def overrides_path(cfg) -> Path:
+    return cfg.static.paths.manager_dir / OVERRIDES
+
+
+def read_overrides(cfg) -> dict[str, str]:
+    """run id -> priority set with flowcell_manager.py reprioritize."""
+    try:
+        return json.loads(overrides_path(cfg).read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def write_overrides(cfg, overrides: dict[str, str]) -> None:
+    path = overrides_path(cfg)
+    tmp = path.with_name(f"{path.name}.tmp")
+    tmp.write_text(json.dumps(overrides, indent=2, sort_keys=True))
+    os.replace(tmp, path)
+
+
+def estimate_hours(run_dir: Path) -> float:
+    """Processing time from the lanes and cycles in RunInfo.xml, 0 if it cannot be read."""
+    try:
+        root = ET.parse(run_dir / "RunInfo.xml").getroot()
+    except (OSError, ET.ParseError):
+        return 0.0
+    cycles = sum(int(r.get("NumCycles", 0)) for r in root.iter("Read"))
+    layout = root.find(".//FlowcellLayout")
+    lanes = int(layout.get("LaneCount", 1)) if layout is not None else 1
+    instrument = run_dir.name.split("_")[1] if "_" in run_dir.name else ""
+    rate = next(
+        (r for prefix, r in HOURS_PER_LANE_CYCLE.items() if instrument.startswith(prefix)), 0.002
+    )
+    return lanes * cycles * rate
+
+
+def _custom_options(cfg, run_dir: Path) -> dict[str, str]:
+    """[CustomOptions] of the sample sheet newFlowCell() would use."""
+    out = cfg.static.paths.output_dir / run_dir.name
+    sheets = [out / "SampleSheet.csv"] if (out / "SampleSheet.csv").exists() else []
+    sheets += sorted(run_dir.glob("SampleSheet*.csv"))
+    for sheet in sheets:
+        try:
+            opts, _ = parse_custom_options(sheet)
+        except Exception as e:
+            log.debug(f"[scheduler] Could not read {sheet}: {e}")
+            continue
+        if opts:
+            return opts
+    return {}
+
+
+@dataclass
+class QueuedRun:
+    """A completed run and the parts of its score."""
+
+    completion_file: Path
+    run_id: str
+    done: bool = False
+    held: bool = False
+    user: str = ""
+    priority: float = 0.0
+    sensitive: bool = False
+    age_hours: float = 0.0
+    est_hours: float = 0.0
+    base: float = 0.0
+    score: float = 0.0
+    reasons: list[str] = field(default_factory=list)
+
+
+def score_run(
+    cfg, completion_file: Path, overrides: dict[str, str], now: float
+) -> QueuedRun | None:
+    """The score of a run, None if its folder was removed or renamed since it was discovered."""
+    run_dir = completion_file.parent
+    run = QueuedRun(completion_file, run_dir.name)
+    try:
+        completed = completion_file.stat().st_mtime
+    except FileNotFoundError:
+        log.info(f"[scheduler] {run.run_id} is gone, leaving it out")
+        return None
+    if (cfg.static.paths.output_dir / run.run_id / "fastq.made").exists():
+        run.done = True
+        return run
+    system = cfg.static.system
+    opts = _custom_options(cfg, run_dir)
+    run.user = opts.get("User", "").strip()
+    run.sensitive = opts.get("SensitiveData", "").strip().lower() in ("true", "1", "yes")
+    priority: float | str = 0.0
+    try:
+        if run.run_id in overrides:
+            priority = parse_priority(str(overrides[run.run_id]))
+            run.reasons.append(f"reprioritized {overrides[run.run_id]}")
+        elif opts.get("Priority"):
+            priority = parse_priority(opts["Priority"])
+            run.reasons.append(f"Priority {opts['Priority']}")
+    except ValueError as e:
+        log.warning(f"[scheduler] {run.run_id}: {e}")
+    if priority == HOLD:
+        run.held = True
+        return run
+    run.priority = priority
+    run.age_hours = max(0.0, (now - completed) / 3600)
+    run.est_hours = estimate_hours(run_dir)
+    run.base = (
+        run.priority
+        + run.sensitive * float(system.get("queue_sensitive_bonus", 20))
+        + run.age_hours * float(system.get("queue_aging_per_hour", 2))
+        - run.est_hours * float(system.get("queue_runtime_weight", 5))
+    )
+    return run
+
+
+def rank(cfg, completion_files: list[Path]) -> list[QueuedRun]:
+    """
+    The runs in processing order: waiting runs by score, then held and done runs.
+
+    The user penalty is applied while the order is built, a user's n-th run
+    loses n times queue_user_penalty.
+    """
+    overrides = read_overrides(cfg)
+    now = time.time()
+    scored = (score_run(cfg, f, overrides, now) for f in sorted(completion_files))
+    runs = [r for r in scored if r is not None]
+    penalty = float(cfg.static.system.get("queue_user_penalty", 10))
+    waiting = [r for r in runs if not (r.done or r.held)]
+    ahead: Counter = Counter()
+    ordered = []
+    while waiting:
+        for r in waiting:
+            r.score = r.base - penalty * ahead[r.user] if r.user else r.base
+        best = max(waiting, key=lambda r: r.score)
+        ordered.append(best)
+        waiting.remove(best)
+        ahead[best.user] += 1
+    return ordered + [r for r in runs if r.held] + [r for r in runs if r.done]
+
+
+def queue(cfg, discover: Callable[[object], list[Path]]) -> Iterator[Path]:
+    """
+    The completion files to process, best first.
+
+    The runs are discovered and ranked again after every run that was waiting,
+    so that a run completing while another one is processed takes its turn;
+    held runs are left out, and every run comes up once per call.
+    """
+    seen: set[str] = set()
+    pending: list[QueuedRun] = []
+    stale = True
+    while True:
+        # runs that are already done take no time, no need to look again after them
+        if stale:
+            pending = [r for r in rank(cfg, discover(cfg)) if not r.held and r.run_id not in seen]
+        if not pending:
+            return
+        run = pending.pop(0)
+        seen.add(run.run_id)
+        stale = not run.done
+        if not run.done:
+            log.debug(f"[scheduler] Next: {run.run_id} (score {run.score:.1f})")
+        yield run.completion_file
@@ -0,0 +1,370 @@
+"""
+Prefetch of run folders from the instrument mounts to local scratch.
+
+With [Paths]->scratchDir set, the demultiplexer reads the BCL files from a local
+copy of the run folder in scratchDir/prefetch instead of from the NAS:
+
+    • a watcher thread looks for completed runs every [System]->prefetch_poll
+      seconds (default 60) and copies them while bfq.py is busy or asleep, up
+      to [System]->prefetch_runs copies at a time (default 2: the run being
+      demultiplexed and the next one)
+    • files are copied in [System]->prefetch_streams parallel streams (default
+      16), large files in chunks of CHUNK_SIZE
+    • the CRC32 of every chunk is taken as it is read from the mount and checked
+      again on the copy; a source file whose size or mtime changed during the
+      copy fails the prefetch
+    • bcl2fq() waits for the copy of its run and passes it as the input
+      directory; without a usable copy (no space, a failed check), or when the
+      copy has not started yet and would wait for the copies of other runs, it
+      reads from the mount as before
+    • the copy is removed once bcl.done is written, and copies of runs that are
+      no longer waiting to be demultiplexed are removed by the watcher
+
+Thumbnail_Images and Images are not copied, the demultiplexers do not read them.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import zlib
+
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from bcl2fastq_pipeline import lease, tracing
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024 * 1024
+BUFFER_SIZE = 8 * 1024 * 1024
+DONE = ".prefetch.done"
+EXCLUDE = {"Thumbnail_Images", "Images"}
+DEFAULT_STREAMS = 16
+DEFAULT_RUNS = 2
+DEFAULT_POLL = 60.0
+
+
+class PrefetchError(RuntimeError):
+    """Raised when a copy does not match its source."""
+
+
+class PrefetchCancelled(Exception):
+    """Raised in the copy threads when the prefetch of a run is dropped."""
+
+
+@dataclass
+class Prefetch:
+    """The copy of one run folder, made in the background."""
+
+    run_dir: Path
+    copy: Path
+    files: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    error: str | None = None
+    # set by the runner when the copy begins
+    started: bool = False
+    cancel: threading.Event = field(default_factory=threading.Event, repr=False)
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+
+
+def scratch_dir(cfg) -> Path | None:
+    """scratchDir/prefetch, or None when prefetching is switched off."""
+    if cfg.static.paths.scratch_dir is None:
+        return None
+    return cfg.static.paths.scratch_dir / "prefetch"
+
+
+def _plan(run_dir: Path) -> list[tuple[Path, int, int]]:
+    """(file, size, mtime_ns) of every file to copy."""
+    files = []
+    for root, dirs, names in os.walk(run_dir):
+        dirs[:] = sorted(d for d in dirs if d not in EXCLUDE)
+        for name in names:
+            path = Path(root) / name
+            st = path.stat()
+            files.append((path, st.st_size, st.st_mtime_ns))
+    return files
+
+
+def _copy_chunk(src: Path, dst: Path, offset: int, length: int, cancel: threading.Event) -> int:
+    """Copy length bytes at offset and return their CRC32."""
+    crc = 0
+    fin = os.open(src, os.O_RDONLY)
+    fout = os.open(dst, os.O_WRONLY)
+    try:
+        end = offset + length
+        while offset < end:
+            if cancel.is_set():
+                raise PrefetchCancelled
+            buf = os.pread(fin, min(BUFFER_SIZE, end - offset), offset)
+            if not buf:
+                raise PrefetchError(f"{src} was truncated during the prefetch")
+            written = os.pwrite(fout, buf, offset)
+            crc = zlib.crc32(memoryview(buf)[:written], crc)
+            offset += written
+    finally:
+        os.close(fin)
+        os.close(fout)
+    return crc
+
+
+def _crc_chunk(path: Path, offset: int, length: int) -> int:
+    crc = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        end = offset + length
+        while offset < end:
+            buf = os.pread(fd, min(BUFFER_SIZE, end - offset), offset)
+            if not buf:
+                break
+            crc = zlib.crc32(buf, crc)
+            offset += len(buf)
+    finally:
+        os.close(fd)
+    return crc
+
+
+def copy_run(job: Prefetch, streams: int = DEFAULT_STREAMS) -> None:
+    """
+    Copy job.run_dir to job.copy and verify it.
+
+    A copy that was completed earlier, with the same number of files and bytes,
+    is reused.
+    """
+    t0 = time.monotonic()
+    plan = _plan(job.run_dir)
+    summary = {"files": len(plan), "bytes": sum(size for _, size, _ in plan)}
+    marker = job.copy / DONE
+    if marker.exists() and json.loads(marker.read_text()) == summary:
+        job.files, job.bytes = summary["files"], summary["bytes"]
+        log.info(f"[staging] Reusing the copy of {job.run_dir.name} in {job.copy}")
+        return
+    if job.copy.exists():
+        shutil.rmtree(job.copy)
+    job.copy.mkdir(parents=True)
+    free = shutil.disk_usage(job.copy).free
+    if summary["bytes"] > free:
+        raise PrefetchError(
+            f"{job.run_dir.name} needs {summary['bytes'] / 1024**3:.1f} GiB, "
+            f"{free / 1024**3:.1f} GiB free in {job.copy.parent}"
+        )
+
+    chunks = []
+    for src, size, _ in plan:
+        dst = job.copy / src.relative_to(job.run_dir)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with dst.open("wb") as fh:
+            fh.truncate(size)
+        chunks += [
+            (src, dst, off, min(CHUNK_SIZE, size - off)) for off in range(0, size, CHUNK_SIZE)
+        ]
+
+    def copy(chunk):
+        return _copy_chunk(*chunk, job.cancel)
+
+    def verify(chunk):
+        return _crc_chunk(*chunk[1:])
+
+    with ThreadPoolExecutor(streams, thread_name_prefix="prefetch") as pool:
+        copied = list(pool.map(copy, chunks))
+        for src, size, mtime_ns in plan:
+            st = src.stat()
+            if (st.st_size, st.st_mtime_ns) != (size, mtime_ns):
+                raise PrefetchError(f"{src} changed during the prefetch")
+        checked = list(pool.map(verify, chunks))
+    bad = [chunk[1] for chunk, a, b in zip(chunks, copied, checked, strict=True) if a != b]
+    if bad:
+        raise PrefetchError(f"Checksum mismatch in {len(bad)} chunks, the first in {bad[0]}")
+    for src, _, _ in plan:
+        shutil.copystat(src, job.copy / src.relative_to(job.run_dir))
+
+    marker.write_text(json.dumps(summary))
+    job.files, job.bytes = summary["files"], summary["bytes"]
+    job.seconds = time.monotonic() - t0
+    log.info(
+        f"[staging] Prefetched {job.run_dir.name}: {job.files} files, "
+        f"{job.bytes / 1024**3:.2f} GiB in {job.seconds:.0f} s "
+        f"({job.bytes / 1024**2 / max(job.seconds, 1e-3):.0f} MiB/s)"
+    )
+
+
+def _wanted(cfg, run_dir: Path) -> bool:
+    """Whether the run is waiting to be demultiplexed by this instance."""
+    out = cfg.static.paths.output_dir / run_dir.name
+    if (out / "bcl.done").exists() or (out / "fastq.made").exists():
+        return False
+    # newFlowCell() skips runs without a sample sheet
+    if not any(run_dir.glob("SampleSheet*.csv")) and not (out / "SampleSheet.csv").exists():
+        return False
+    leases = lease.configure(cfg)
+    holder = leases.read(f"run-{run_dir.name}")
+    return holder is None or holder.get("owner") == leases.owner
+
+
+class Stager:
+    """The prefetches of this process and the thread that starts them."""
+
+    def __init__(self) -> None:
+        self.cfg = None
+        self.discover: Callable[[object], list[Path]] | None = None
+        self.jobs: dict[str, Prefetch] = {}
+        # the run being demultiplexed, the watcher leaves its copy alone
+        self.current: str | None = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._runner: ThreadPoolExecutor | None = None
+
+    def watch(self, cfg, discover: Callable[[object], list[Path]]) -> None:
+        """Start the watcher, or wake it up; discover(cfg) returns the completed run folders."""
+        self.cfg = cfg
+        self.discover = discover
+        if self._thread is None:
+            self._runner = ThreadPoolExecutor(1, thread_name_prefix="prefetch-run")
+            self._thread = threading.Thread(target=self._watch, name="prefetch", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _watch(self) -> None:
+        while True:
+            self._wake.wait(float(self.cfg.static.system.get("prefetch_poll", DEFAULT_POLL)))
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception:
+                log.exception("[staging] Prefetch watcher failed")
+
+    def poll(self) -> None:
+        """Drop the copies no longer needed and start those of the next runs."""
+        cfg = self.cfg
+        root = scratch_dir(cfg)
+        if root is None:
+            return
+        wanted = [d for d in self.discover(cfg) if _wanted(cfg, d)]
+        names = {d.name for d in wanted}
+        with self._lock:
+            for name in [n for n in self.jobs if n not in names and n != self.current]:
+                self._drop(name)
+        if root.exists():
+            for stale in [p for p in root.iterdir() if p.name not in self.jobs]:
+                log.info(f"[staging] Removing the stale copy {stale}")
+                shutil.rmtree(stale, ignore_errors=True)
+        limit = int(cfg.static.system.get("prefetch_runs", DEFAULT_RUNS))
+        for run_dir in wanted:
+            with self._lock:
+                if len(self.jobs) >= limit:
+                    break
+                # without a copy the current run is read from the mount
+                if run_dir.name != self.current:
+                    self._start(run_dir)
+
+    def _start(self, run_dir: Path) -> Prefetch:
+        if run_dir.name in self.jobs:
+            return self.jobs[run_dir.name]
+        job = Prefetch(run_dir, scratch_dir(self.cfg) / run_dir.name)
+        self.jobs[run_dir.name] = job
+        streams = int(self.cfg.static.system.get("prefetch_streams", DEFAULT_STREAMS))
+        self._runner.submit(self._run, job, streams)
+        log.info(f"[staging] Prefetching {run_dir} to {job.copy}")
+        return job
+
+    @staticmethod
+    def _run(job: Prefetch, streams: int) -> None:
+        job.started = True
+        try:
+            if not job.cancel.is_set():
+                copy_run(job, streams)
+        except PrefetchCancelled:
+            shutil.rmtree(job.copy, ignore_errors=True)
+        except Exception as e:
+            job.error = str(e)
+            log.warning(f"[staging] Prefetch of {job.run_dir.name} failed: {e}")
+            shutil.rmtree(job.copy, ignore_errors=True)
+        finally:
+            job.done.set()
+
+    def _drop(self, name: str) -> None:
+        job = self.jobs.pop(name)
+        job.cancel.set()
+        if job.done.is_set():
+            shutil.rmtree(job.copy, ignore_errors=True)
+        # a running copy removes itself, one still waiting never starts
+
+    def input_dir(self, cfg) -> Path:
+        """The copy of the current run once verified, or the run folder on the mount."""
+        if scratch_dir(cfg) is None:
+            return cfg.run.flowcell_path
+        if self._runner is None:
+            self._runner = ThreadPoolExecutor(1, thread_name_prefix="prefetch-run")
+        self.cfg = cfg
+        run_id = cfg.run.run_id
+        with self._lock:
+            self.current = run_id
+            job = self.jobs.get(run_id)
+            if job and job.error:
+                # try once more, the watcher does not retry
+                del self.jobs[run_id]
+                job = None
+            ahead = [n for n, j in self.jobs.items() if n != run_id and not j.done.is_set()]
+            if (job is None or not job.started) and ahead:
+                # the copy runner is busy with other runs, do not wait for them
+                if job is not None:
+                    self._drop(run_id)
+                log.info(
+                    f"[staging] Reading {run_id} from the mount, "
+                    f"the prefetch of {', '.join(ahead)} comes first"
+                )
+                return cfg.run.flowcell_path
+            job = self._start(cfg.run.flowcell_path)
+        with tracing.span("prefetch_wait") as s:
+            job.done.wait()
+            s.set(bytes=job.bytes, files=job.files, seconds=round(job.seconds, 1))
+        if job.error:
+            log.warning(f"[staging] Reading {cfg.run.flowcell_path} from the mount: {job.error}")
+            return cfg.run.flowcell_path
+        return job.copy
+
+    def done_reading(self, run_id: str) -> None:
+        """The demultiplexer is done with the run, the watcher may drop its copy again."""
+        with self._lock:
+            if self.current == run_id:
+                self.current = None
+
+    def release(self, run_id: str) -> None:
+        """Remove the copy of a run, once it has been demultiplexed."""
+        with self._lock:
+            if run_id in self.jobs:
+                self._drop(run_id)
+                log.info(f"[staging] Removed the copy of {run_id}")
+
+
+_stager = Stager()
+
+
+def watch(cfg, discover: Callable[[object], list[Path]]) -> None:
+    """Prefetch the runs returned by discover(cfg), if [Paths]->scratchDir is set."""
+    if scratch_dir(cfg) is not None:
+        _stager.watch(cfg, discover)
+
+
+@contextlib.contextmanager
+def reading(cfg):
+    """The directory the demultiplexer should read the current run from, while it does."""
+    try:
+        yield _stager.input_dir(cfg)
+    finally:
+        # also when the demultiplexer failed, so a copy left behind is not kept forever
+        _stager.done_reading(cfg.run.run_id)
+
+
+def release(run_id: str) -> None:
+    _stager.release(run_id)
@@ -0,0 +1,308 @@
+"""
+Incremental extraction of the parts of ``Stats/Stats.json`` the pipeline uses.
+
+bcl2fastq writes the conversion results of every sample in every lane to
+Stats.json, which makes the file hundreds of MB on large runs. Instead of
+``json.load`` on the whole document, the file is scanned in chunks and only
+the requested values are decoded:
+
+    • ``ReadInfosForLanes``                     – the read geometry
+    • ``ConversionResults[*]`` lane totals      – the per-sample ``DemuxResults`` are skipped
+    • ``UnknownBarcodes``                       – only the most frequent barcodes are kept
+
+The extracted summary is cached in ``stats_summary.json`` in the run output
+directory (and in memory), keyed by the size and mtime of Stats.json.
+"""
+
+from __future__ import annotations
+
+import heapq
+import json
+import logging
+import os
+import re
+
+from dataclasses import asdict, dataclass, field
+from itertools import accumulate
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+CACHE_NAME = "stats_summary.json"
+CHUNK_SIZE = 1024 * 1024
+TOP_UNKNOWN = 20
+
+_WS = re.compile(r"[ \t\n\r]*")
+# A complete string or a bracket. A lone quote means the string continues past the buffer.
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[\[\]{}"]')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+_NOT_BRACKET = re.compile(r"[^\[\]{}]+")
+# characters that can continue a number, "12" "." "5e" "-3" split over chunks
+_NUMBER_CHARS = frozenset("0123456789.eE+-")
+_decoder = json.JSONDecoder()
+
+# (path, size, mtime_ns) -> summary
+_summaries: dict[tuple[str, int, int], StatsSummary] = {}
+
+
+class _Scanner:
+    """Pull parser over a JSON file that only ever holds a window of it in memory."""
+
+    def __init__(self, fh, chunk_size: int = CHUNK_SIZE):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        if self.pos > len(self.buf) // 2:
+            self.buf = self.buf[self.pos :]
+            self.pos = 0
+        chunk = self.fh.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def peek(self) -> str:
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, ch: str) -> None:
+        if self.peek() != ch:
+            raise ValueError(f"Expected {ch!r} at offset {self.pos}, got {self.buf[self.pos]!r}")
+        self.pos += 1
+
+    def read_value(self):
+        """Decode the next value. Meant for small values."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number may continue in the next chunk: raw_decode stops before a
+            # trailing "." or "e" that has no digits after it yet
+            number = type(value) in (int, float)
+            cut = end == len(self.buf) or self.buf[end] in _NUMBER_CHARS
+            if number and cut and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip_value(self) -> None:
+        """Skip the next value without decoding it."""
+        if self.peek() not in "[{":
+            self.read_value()
+            return
+        depth = 0
+        while True:
+            # Fast path: JSON strings cannot contain raw newlines, so up to the last
+            # newline in the buffer the brackets can be counted with the strings removed.
+            cut = self.buf.rfind("\n", self.pos)
+            if cut > self.pos:
+                brackets = _NOT_BRACKET.sub("", _STRING.sub("", self.buf[self.pos : cut]))
+                levels = list(accumulate((1 if b in "[{" else -1 for b in brackets), initial=depth))
+                if min(levels[1:], default=depth) > 0:
+                    depth = levels[-1]
+                    self.pos = cut
+                    if not self._fill():
+                        raise ValueError("Unexpected end of JSON document")
+                    continue
+
+            # Slow path: token by token, up to the end of the value or of the buffer
+            while True:
+                m = _TOKEN.search(self.buf, self.pos)
+                if m is None or m.group() == '"':
+                    self.pos = m.start() if m is not None else len(self.buf)
+                    if not self._fill():
+                        raise ValueError("Unexpected end of JSON document")
+                    break
+                self.pos = m.end()
+                tok = m.group()
+                if tok in "[{":
+                    depth += 1
+                elif tok in "]}":
+                    depth -= 1
+                    if depth == 0:
+                        return
+
+    def _separator(self, close: str) -> bool:
+        ch = self.peek()
+        self.pos += 1
+        if ch == ",":
+            return True
+        if ch == close:
+            return False
+        raise ValueError(f"Expected ',' or {close!r} at offset {self.pos - 1}, got {ch!r}")
+
+    def iter_object(self):
+        """Yield the keys of the next object. The caller must consume each value."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(":")
+            yield key
+            if not self._separator("}"):
+                return
+
+    def iter_array(self):
+        """Yield once per element of the next array. The caller must consume each element."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if not self._separator("]"):
+                return
+
+
+@dataclass
+class LaneTotals:
+    lane: int
+    clusters_raw: int = 0
+    clusters_pf: int = 0
+    yield_bp: int = 0
+    undetermined: int = 0
+
+
+@dataclass
+class StatsSummary:
+    """
+    The parts of Stats.json used by the emails and metrics.
+
+    Attributes
+    ----------
+    read_infos : list[dict]
+        ``ReadInfosForLanes``, one entry per lane.
+    lanes : list[LaneTotals]
+        Cluster, yield and undetermined totals per lane.
+    unknown_barcodes : dict[int, list[tuple[str, int]]]
+        The most frequent unknown barcodes per lane, most frequent first.
+    """
+
+    flowcell: str = ""
+    run_id: str = ""
+    read_infos: list[dict] = field(default_factory=list)
+    lanes: list[LaneTotals] = field(default_factory=list)
+    unknown_barcodes: dict[int, list[tuple[str, int]]] = field(default_factory=dict)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> StatsSummary:
+        return cls(
+            flowcell=data["flowcell"],
+            run_id=data["run_id"],
+            read_infos=data["read_infos"],
+            lanes=[LaneTotals(**d) for d in data["lanes"]],
+            unknown_barcodes={
+                int(k): [tuple(b) for b in v] for k, v in data["unknown_barcodes"].items()
+            },
+        )
+
+
+def _lane_totals(sc: _Scanner) -> LaneTotals:
+    lane = LaneTotals(lane=0)
+    for key in sc.iter_object():
+        if key == "LaneNumber":
+            lane.lane = int(sc.read_value())
+        elif key == "TotalClustersRaw":
+            lane.clusters_raw = int(sc.read_value())
+        elif key == "TotalClustersPF":
+            lane.clusters_pf = int(sc.read_value())
+        elif key == "Yield":
+            lane.yield_bp = int(sc.read_value())
+        elif key == "Undetermined":
+            lane.undetermined = int(sc.read_value().get("NumberReads", 0))
+        else:
+            sc.skip_value()
+    return lane
+
+
+def _top_barcodes(sc: _Scanner, n: int) -> list[tuple[str, int]]:
+    heap: list[tuple[int, str]] = []
+    for barcode in sc.iter_object():
+        count = int(sc.read_value())
+        if len(heap) < n:
+            heapq.heappush(heap, (count, barcode))
+        elif count > heap[0][0]:
+            heapq.heapreplace(heap, (count, barcode))
+    return [(b, c) for c, b in sorted(heap, reverse=True)]
+
+
+def parse(path: Path, top_unknown: int = TOP_UNKNOWN) -> StatsSummary:
+    """Extract a StatsSummary from a Stats.json file."""
+    summary = StatsSummary()
+    with Path(path).open(encoding="utf-8") as fh:
+        sc = _Scanner(fh, CHUNK_SIZE)
+        for key in sc.iter_object():
+            if key == "Flowcell":
+                summary.flowcell = sc.read_value()
+            elif key == "RunId":
+                summary.run_id = sc.read_value()
+            elif key == "ReadInfosForLanes":
+                summary.read_infos = sc.read_value()
+            elif key == "ConversionResults":
+                for _ in sc.iter_array():
+                    summary.lanes.append(_lane_totals(sc))
+            elif key == "UnknownBarcodes":
+                for _ in sc.iter_array():
+                    lane = 0
+                    for k in sc.iter_object():
+                        if k == "Lane":
+                            lane = int(sc.read_value())
+                        elif k == "Barcodes":
+                            summary.unknown_barcodes[lane] = _top_barcodes(sc, top_unknown)
+                        else:
+                            sc.skip_value()
+            else:
+                sc.skip_value()
+    return summary
+
+
+def load(run_dir: Path) -> StatsSummary:
+    """
+    Return the summary of run_dir/Stats/Stats.json, from the cache if it is current.
+
+    The summary is cached in memory and in run_dir/stats_summary.json.
+    """
+    run_dir = Path(run_dir)
+    stats = run_dir / "Stats" / "Stats.json"
+    st = stats.stat()
+    key = (str(stats), st.st_size, st.st_mtime_ns)
+    if key in _summaries:
+        return _summaries[key]
+
+    cache = run_dir / CACHE_NAME
+    try:
+        data = json.loads(cache.read_text())
+        if (data["size"], data["mtime_ns"]) == key[1:]:
+            _summaries[key] = StatsSummary.from_dict(data["summary"])
+            return _summaries[key]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    summary = parse(stats)
+    _summaries[key] = summary
+    try:
+        tmp = run_dir / f".{CACHE_NAME}.tmp"
+        tmp.write_text(
+            json.dumps({"size": st.st_size, "mtime_ns": st.st_mtime_ns, "summary": asdict(summary)})
+        )
+        os.replace(tmp, cache)
+    except OSError as e:
+        log.warning(f"[stats_json] Could not write {cache}: {e}")
+    return summary
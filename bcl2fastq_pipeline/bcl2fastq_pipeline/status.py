@@ -0,0 +1,294 @@
+"""
+HTTP status endpoint of the bfq daemon.
+
+A small HTTP server thread in bfq.py serves what the daemon is doing on
+``[System]->status_port`` (default 5000, 0 switches it off), on the address
+``[System]->status_bind`` (default 127.0.0.1, only local clients; 0.0.0.0 for
+all interfaces):
+
+    • /status   – JSON: the queue of discovered runs, the current stage of the
+                  active run, the durations of the stages of the recent runs,
+                  bytes processed and free disk space
+    • /metrics  – the same in the Prometheus text format
+
+The state is kept up to date from the tracing spans. Every update builds a
+new snapshot and replaces the old one, so the server only ever reads a
+finished snapshot and never takes a lock the processing loop could wait for.
+Free disk space is measured by the server thread when a page is requested.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import shutil
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from bcl2fastq_pipeline import tracing
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 5000
+DEFAULT_BIND = "127.0.0.1"
+KEEP_RUNS = 10
+
+
+class StatusBoard:
+    """The daemon state, published as immutable snapshots."""
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.disk_paths: dict[str, Path] = {}
+        # only the writers (the processing loop and its worker threads) take the lock
+        self._lock = threading.Lock()
+        self._queue: list[str] = []
+        self._runs: dict[str, dict] = {}
+        self._bytes: dict[str, int] = {}
+        self._runs_total: dict[str, int] = {}
+        self.snapshot: dict = self._build()
+
+    def _build(self) -> dict:
+        return {
+            "started": self.started,
+            "queue": list(self._queue),
+            "runs": {
+                run_id: run | {"stages": [dict(s) for s in run["stages"]]}
+                for run_id, run in self._runs.items()
+            },
+            "bytes": dict(self._bytes),
+            "runs_total": dict(self._runs_total),
+        }
+
+    def _publish(self) -> None:
+        self.snapshot = self._build()
+
+    def set_queue(self, run_dirs: list[str]) -> None:
+        with self._lock:
+            self._queue = list(run_dirs)
+            self._publish()
+
+    def on_span(self, event: str, span: tracing.Span) -> None:
+        if event not in ("start", "end"):
+            return
+        with self._lock:
+            if span.name == "run" and span.parent_id is None:
+                self._on_run(event, span)
+            elif span.run_id in self._runs:
+                run = self._runs[span.run_id]
+                if span.parent_id == run["span_id"]:
+                    self._on_stage(event, span, run)
+                if event == "end" and isinstance(span.attrs.get("bytes"), int):
+                    self._bytes[span.name] = self._bytes.get(span.name, 0) + span.attrs["bytes"]
+            else:
+                return
+            self._publish()
+
+    def _on_run(self, event: str, span: tracing.Span) -> None:
+        if event == "start":
+            self._runs[span.run_id] = {
+                "span_id": span.span_id,
+                "libprep": span.attrs.get("libprep"),
+                "started": span.start,
+                "ended": None,
+                "status": "running",
+                "stage": None,
+                "stages": [],
+            }
+            while len(self._runs) > KEEP_RUNS:
+                self._runs.pop(next(iter(self._runs)))
+        elif span.run_id in self._runs:
+            run = self._runs[span.run_id]
+            run.update(ended=span.end, status=span.status, stage=None)
+            self._runs_total[span.status] = self._runs_total.get(span.status, 0) + 1
+
+    def _on_stage(self, event: str, span: tracing.Span, run: dict) -> None:
+        if event == "start":
+            run["stage"] = span.name
+            run["stages"].append(
+                {"name": span.name, "started": span.start, "duration": None, "status": "running"}
+            )
+            return
+        for stage in reversed(run["stages"]):
+            if stage["name"] == span.name and stage["duration"] is None:
+                stage.update(duration=round(span.duration, 3), status=span.status)
+                break
+        if run["stage"] == span.name:
+            run["stage"] = None
+
+    # --- rendering ---------------------------------------------------------- #
+    def disk(self) -> dict[str, dict[str, int]]:
+        usage = {}
+        for name, path in self.disk_paths.items():
+            try:
+                du = shutil.disk_usage(path)
+            except OSError:
+                continue
+            usage[name] = {"path": str(path), "total": du.total, "free": du.free}
+        return usage
+
+    def as_json(self) -> dict:
+        snap = self.snapshot
+        now = time.time()
+        runs = {}
+        for run_id, run in snap["runs"].items():
+            view = {k: v for k, v in run.items() if k != "span_id"}
+            if run["stage"] is not None:
+                view["stage_elapsed"] = round(now - run["stages"][-1]["started"], 1)
+            runs[run_id] = view
+        return {
+            "uptime": round(now - snap["started"], 1),
+            "queue": snap["queue"],
+            "runs": runs,
+            "bytes_processed": snap["bytes"],
+            "runs_total": snap["runs_total"],
+            "disk": self.disk(),
+        }
+
+    def as_prometheus(self) -> str:
+        snap = self.snapshot
+        now = time.time()
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append(f"# HELP bfq_{name} {help_text}")
+            out.append(f"# TYPE bfq_{name} {kind}")
+            for labels, value in samples:
+                lbl = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                out.append(f"bfq_{name}{{{lbl}}} {value}" if lbl else f"bfq_{name} {value}")
+
+        metric(
+            "uptime_seconds",
+            "gauge",
+            "Seconds since bfq.py started.",
+            [({}, now - snap["started"])],
+        )
+        metric(
+            "queue_length",
+            "gauge",
+            "Run directories found at the last discovery.",
+            [({}, len(snap["queue"]))],
+        )
+        active = [(r, run) for r, run in snap["runs"].items() if run["stage"] is not None]
+        metric(
+            "stage_active",
+            "gauge",
+            "1 for the stage a run is in.",
+            [({"run": r, "stage": run["stage"]}, 1) for r, run in active],
+        )
+        metric(
+            "stage_elapsed_seconds",
+            "gauge",
+            "Time spent in the current stage.",
+            [
+                ({"run": r, "stage": run["stage"]}, now - run["stages"][-1]["started"])
+                for r, run in active
+            ],
+        )
+        metric(
+            "stage_duration_seconds",
+            "gauge",
+            "Duration of the finished stages of the recent runs.",
+            [
+                ({"run": r, "stage": s["name"], "status": s["status"]}, s["duration"])
+                for r, run in snap["runs"].items()
+                for s in run["stages"]
+                if s["duration"] is not None
+            ],
+        )
+        metric(
+            "processed_bytes_total",
+            "counter",
+            "Bytes processed, by span.",
+            [({"span": k}, v) for k, v in snap["bytes"].items()],
+        )
+        metric(
+            "runs_total",
+            "counter",
+            "Runs processed, by status.",
+            [({"status": k}, v) for k, v in snap["runs_total"].items()],
+        )
+        disk = self.disk()
+        metric(
+            "disk_free_bytes",
+            "gauge",
+            "Free disk space.",
+            [({"name": k, "path": d["path"]}, d["free"]) for k, d in disk.items()],
+        )
+        metric(
+            "disk_total_bytes",
+            "gauge",
+            "Disk size.",
+            [({"name": k, "path": d["path"]}, d["total"]) for k, d in disk.items()],
+        )
+        return "\n".join(out) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    board: StatusBoard
+
+    def do_GET(self) -> None:
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path in ("", "/status"):
+            body = json.dumps(self.board.as_json(), indent=2, default=str).encode()
+            ctype = "application/json"
+        elif path == "/metrics":
+            body = self.board.as_prometheus().encode()
+            ctype = "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        log.debug(f"[status] {self.address_string()} {format % args}")
+
+
+_board = StatusBoard()
+_servers: dict[int, ThreadingHTTPServer] = {}
+
+
+def board() -> StatusBoard:
+    return _board
+
+
+def set_queue(run_dirs: list[str]) -> None:
+    """Publish the run directories found by the last discovery."""
+    _board.set_queue(run_dirs)
+
+
+def serve(cfg) -> None:
+    """Start the status server on [System]->status_port, once per process."""
+    _board.disk_paths = {
+        "output": Path(cfg.static.paths.output_dir),
+        "nova": Path(cfg.static.paths.nova_base_dir),
+        "ekista": Path(cfg.static.paths.ekista_base_dir),
+    }
+    if cfg.static.paths.scratch_dir is not None:
+        _board.disk_paths["scratch"] = Path(cfg.static.paths.scratch_dir)
+    tracing.add_listener(_board.on_span)
+    port = int(cfg.static.system.get("status_port", DEFAULT_PORT))
+    if port == 0 or port in _servers:
+        return
+    bind = cfg.static.system.get("status_bind", DEFAULT_BIND)
+    handler = type("Handler", (_Handler,), {"board": _board})
+    try:
+        server = ThreadingHTTPServer((bind, port), handler)
+    except OSError as e:
+        log.warning(f"[status] Could not listen on {bind}:{port}: {e}")
+        return
+    server.daemon_threads = True
+    _servers[port] = server
+    threading.Thread(target=server.serve_forever, name="status", daemon=True).start()
+    log.info(f"[status] Serving /status and /metrics on {bind}:{port}")
@@ -0,0 +1,290 @@
+"""
+Timing spans for the stages of a run, written as JSON lines.
+
+Every stage of bfq.py, the per-project work inside the stages and every
+external command is timed as a span. A span has a name, a parent, start and
+end time, a status and attributes such as the number of files or bytes it
+processed. Finished spans are appended to:
+
+    • ``log_dir/<run_id>.trace.jsonl``  – all spans of one run
+    • ``log_dir/trace.jsonl``           – all spans of all runs, rotated to
+                                          ``trace.jsonl.1`` at ``[System]->trace_max_mb``
+
+The current span is kept in a context variable, so spans opened in a thread
+(see propagate()) or further down the call stack get the right parent.
+Listeners registered with add_listener() are told when spans start and end.
+
+Example
+-------
+>>> with tracing.span("md5sum", project=p) as s:
+...     tracing.check_call(cmd, shell=True, cwd=cfg.output_path)
+...     s.set(files=len(files), bytes=manifest.project_size(p))
+"""
+
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import datetime
+import functools
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+import uuid
+
+from collections.abc import Callable, Iterator
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_MB = 50
+
+_current: contextvars.ContextVar[Span | None] = contextvars.ContextVar("span", default=None)
+
+
+@dataclass
+class Span:
+    """
+    One timed piece of work.
+
+    Attributes
+    ----------
+    name : str
+        The stage, e.g. "bcl2fq" or "command".
+    run_id : str | None
+        The run the span belongs to, None outside of a run.
+    span_id, parent_id : str, str | None
+        Ids linking the span to the span it was opened in.
+    start, end : float
+        Unix time; end is 0.0 while the span is open.
+    status : str
+        "ok" or "error".
+    attrs : dict
+        Free-form attributes (project, files, bytes, cmd, ...).
+    """
+
+    name: str
+    run_id: str | None = None
+    span_id: str = field(default_factory=lambda: uuid.uuid4().hex[:16])
+    parent_id: str | None = None
+    start: float = field(default_factory=time.time)
+    end: float = 0.0
+    status: str = "ok"
+    error: str | None = None
+    attrs: dict = field(default_factory=dict)
+    thread: str = field(default_factory=lambda: threading.current_thread().name)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def as_dict(self) -> dict:
+        d = asdict(self)
+        d["duration"] = round(self.duration, 3)
+        d["started"] = datetime.datetime.fromtimestamp(self.start).isoformat(timespec="seconds")
+        return d
+
+
+class Tracer:
+    """Writes finished spans to the trace files of the current run."""
+
+    def __init__(self) -> None:
+        self.log_dir: Path | None = None
+        self.max_bytes = DEFAULT_MAX_MB * 1024**2
+        self.run: Span | None = None
+        self.listeners: list[Callable[[str, Span], None]] = []
+        self._lock = threading.Lock()
+
+    def configure(self, cfg) -> None:
+        self.log_dir = Path(cfg.static.paths.log_dir)
+        self.max_bytes = int(float(cfg.static.system.get("trace_max_mb", DEFAULT_MAX_MB)) * 1024**2)
+
+    def _append(self, path: Path, line: bytes) -> None:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def write(self, span: Span) -> None:
+        if self.log_dir is None:
+            return
+        line = (json.dumps(span.as_dict(), default=str) + "\n").encode()
+        with self._lock:
+            try:
+                rolling = self.log_dir / "trace.jsonl"
+                if rolling.exists() and rolling.stat().st_size + len(line) > self.max_bytes:
+                    os.replace(rolling, rolling.with_name("trace.jsonl.1"))
+                self._append(rolling, line)
+                if span.run_id:
+                    self._append(self.log_dir / f"{span.run_id}.trace.jsonl", line)
+            except OSError as e:
+                log.warning(f"[tracing] Could not write span {span.name}: {e}")
+
+    def notify(self, event: str, span: Span) -> None:
+        for listener in list(self.listeners):
+            try:
+                listener(event, span)
+            except Exception:
+                log.exception(f"[tracing] Listener failed on {event} of {span.name}")
+
+
+_tracer = Tracer()
+
+
+def add_listener(listener: Callable[[str, Span], None]) -> None:
+    """
+    Call listener(event, span) for every span. Registering twice is a no-op.
+
+    event is "start" or "end", or "process" once check_call() has started the
+    process of a command span.
+    """
+    if listener not in _tracer.listeners:
+        _tracer.listeners.append(listener)
+
+
+def remove_listener(listener: Callable[[str, Span], None]) -> None:
+    if listener in _tracer.listeners:
+        _tracer.listeners.remove(listener)
+
+
+def configure(cfg) -> None:
+    """Write spans to the log directory of cfg."""
+    _tracer.configure(cfg)
+
+
+def current() -> Span | None:
+    return _current.get()
+
+
+def root() -> Span | None:
+    """The span of the run being processed, if any."""
+    return _tracer.run
+
+
+def _open(name: str, attrs: dict) -> Span:
+    parent = _current.get()
+    run_id = parent.run_id if parent else None
+    s = Span(name=name, run_id=run_id, parent_id=parent.span_id if parent else None, attrs=attrs)
+    _tracer.notify("start", s)
+    return s
+
+
+def _close(s: Span, exc: BaseException | None = None) -> None:
+    s.end = time.time()
+    if exc is not None:
+        s.status = "error"
+        s.error = f"{type(exc).__name__}: {exc}"
+    _tracer.notify("end", s)
+    _tracer.write(s)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs) -> Iterator[Span]:
+    """Time the enclosed block as a child of the current span."""
+    s = _open(name, attrs)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        _close(s, e)
+        raise
+    else:
+        _close(s)
+    finally:
+        _current.reset(token)
+
+
+def traced(name: str | None = None):
+    """Decorator form of span(), named after the function by default."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def propagate(func: Callable) -> Callable:
+    """Bind func to the current context, for spans opened in pool threads."""
+    ctx = contextvars.copy_context()
+    return functools.partial(ctx.run, func)
+
+
+# --------------------------------------------------------------------------- #
+# Runs
+# --------------------------------------------------------------------------- #
+def begin_run(cfg) -> Span:
+    """
+    Open the root span of the current run of cfg.
+
+    A run that is still open (its processing stopped at an error) is closed
+    first, with the status of its last stage.
+    """
+    end_run()
+    configure(cfg)
+    s = Span(name="run", run_id=cfg.run.run_id, attrs={"libprep": cfg.run.libprep})
+    _tracer.run = s
+    _current.set(s)
+    _tracer.notify("start", s)
+    return s
+
+
+def end_run() -> None:
+    """Close the root span of the current run, if one is open."""
+    s = _tracer.run
+    if s is None:
+        return
+    _tracer.run = None
+    _current.set(None)
+    s.status = s.attrs.pop("_last_status", "ok")
+    _close(s)
+
+
+def _record_stage_status(event: str, s: Span) -> None:
+    run = _tracer.run
+    if event == "end" and run is not None and s.parent_id == run.span_id:
+        run.attrs["_last_status"] = s.status
+
+
+add_listener(_record_stage_status)
+
+
+# --------------------------------------------------------------------------- #
+# External commands
+# --------------------------------------------------------------------------- #
+def _describe(cmd) -> str:
+    return cmd if isinstance(cmd, str) else " ".join(map(str, cmd))
+
+
+def check_call(cmd, name: str = "command", **kwargs) -> int:
+    """
+    subprocess.check_call() in a span with the command, its pid and return code.
+
+    The span is open while the process runs, so listeners can find the
+    process by span.attrs["pid"].
+    """
+    with span(name, cmd=_describe(cmd)) as s:
+        with subprocess.Popen(cmd, **kwargs) as proc:
+            s.set(pid=proc.pid)
+            _tracer.notify("process", s)
+            try:
+                returncode = proc.wait()
+            except BaseException:
+                proc.kill()
+                raise
+        s.set(returncode=returncode)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd)
+    return 0
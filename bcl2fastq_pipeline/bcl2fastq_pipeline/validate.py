@@ -0,0 +1,227 @@
+"""
+Integrity validation of the demultiplexed FASTQ files.
+
+Every ``*.fastq.gz`` in the run output directory is inflated in a pool of
+threads (zlib releases the GIL while decompressing), the CRC32 and length
+trailer of every gzip member is verified and the FASTQ records are counted.
+The counts are then reconciled against the demultiplexer's own statistics
+(``Demultiplex_Stats.csv`` from bcl-convert or ``DemultiplexingStats.xml``
+from bcl2fastq), so a truncated or corrupt file fails the run before it is
+archived and delivered.
+
+Results are cached in ``fastq_validation.json`` in the run output directory,
+keyed by file size and mtime, so restarts can skip files that were already
+checked. The read counts are also recorded in the run manifest for later
+stages.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from bcl2fastq_pipeline import demux_stats
+from bcl2fastq_pipeline.manifest import FASTQ_NAME, get_manifest
+
+log = logging.getLogger(__name__)
+
+CACHE_NAME = "fastq_validation.json"
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class FastqValidationError(RuntimeError):
+    """Raised when FASTQ files are corrupt or do not match the demultiplexing stats."""
+
+
+@dataclass
+class FastqCheck:
+    """Result of validating a single FASTQ file."""
+
+    path: str
+    size: int
+    mtime_ns: int
+    reads: int | None = None
+    error: str | None = None
+
+
+def count_fastq_records(path: Path, chunk_size: int = CHUNK_SIZE) -> FastqCheck:
+    """
+    Decompress a (possibly multi-member) gzip file and count FASTQ records.
+
+    zlib verifies the CRC32 and ISIZE trailer of every member, a missing
+    trailer means the file is truncated.
+    """
+    st = path.stat()
+    check = FastqCheck(path=str(path), size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+    lines = 0
+    last = b"\n"
+    d = None
+    try:
+        with path.open("rb") as fh:
+            while chunk := fh.read(chunk_size):
+                while chunk:
+                    if d is None:
+                        d = zlib.decompressobj(wbits=31)
+                    data = d.decompress(chunk)
+                    if data:
+                        lines += data.count(b"\n")
+                        last = data[-1:]
+                    if not d.eof:
+                        break
+                    # next gzip member (bgzf and concatenated streams)
+                    chunk = d.unused_data
+                    d = None
+        if d is not None:
+            raise zlib.error("unexpected end of file, gzip stream is truncated")
+        if check.size == 0:
+            raise zlib.error("empty file")
+    except (OSError, zlib.error) as e:
+        check.error = f"{type(e).__name__}: {e}"
+        return check
+
+    if last != b"\n":
+        lines += 1
+    if lines % 4:
+        check.error = f"{lines} lines is not a multiple of 4, incomplete FASTQ record"
+        return check
+    check.reads = lines // 4
+    return check
+
+
+def expected_read_counts(output_path: Path) -> dict[tuple[str, str, int | None], int]:
+    """
+    Read counts reported by the demultiplexer.
+
+    Keys are (project, sample, lane) with lane=None holding the sum over all
+    lanes. Undetermined reads are stored under project "".
+    """
+    try:
+        stats = demux_stats.load(output_path)
+    except FileNotFoundError:
+        return {}
+    counts: dict[tuple[str, str, int | None], int] = {}
+    for (project, sample, lane), n in stats.samples.items():
+        _add_count(counts, project, sample, lane, n)
+    for lane, n in stats.undetermined.items():
+        _add_count(counts, "", "Undetermined", lane, n)
+    return counts
+
+
+def _add_count(counts, project, sample, lane, n):
+    counts[(project, sample, lane)] = counts.get((project, sample, lane), 0) + n
+    counts[(project, sample, None)] = counts.get((project, sample, None), 0) + n
+
+
+def _sample_key(output_path: Path, fastq: Path) -> tuple[str, str, int | None, str] | None:
+    m = FASTQ_NAME.match(fastq.name)
+    if not m:
+        return None
+    rel = fastq.relative_to(output_path)
+    project = rel.parts[0] if len(rel.parts) > 1 else ""
+    lane = int(m["lane"]) if m["lane"] else None
+    return project, m["sample"], lane, m["read"]
+
+
+def _load_cache(cache_path: Path) -> dict[str, FastqCheck]:
+    if not cache_path.exists():
+        return {}
+    try:
+        data = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        log.warning(f"[validate] Ignoring unreadable cache {cache_path}")
+        return {}
+    return {k: FastqCheck(**v) for k, v in data.items()}
+
+
+def _save_cache(cache_path: Path, checks: dict[str, FastqCheck]) -> None:
+    tmp = cache_path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({k: asdict(v) for k, v in checks.items()}, indent=1))
+    os.replace(tmp, cache_path)
+
+
+def validate_fastqs(cfg) -> dict[str, FastqCheck]:
+    """
+    Verify all FASTQ files of the current run and reconcile read counts.
+
+    Raises
+    ------
+    FastqValidationError
+        If any file is corrupt or truncated, if the reads of one sample do not
+        have the same number of records, or if a count disagrees with the
+        demultiplexing stats.
+    """
+    output_path = cfg.output_path
+    cache_path = output_path / CACHE_NAME
+    cached = _load_cache(cache_path)
+    threads = int(cfg.static.system.get("validation_threads", os.cpu_count() or 4))
+
+    manifest = get_manifest(cfg)
+    checks: dict[str, FastqCheck] = {}
+    todo = []
+    for rel, entry in manifest.files.items():
+        prev = cached.get(rel)
+        if (
+            prev
+            and prev.error is None
+            and (prev.size, prev.mtime_ns) == (entry.size, entry.mtime_ns)
+        ):
+            checks[rel] = prev
+        else:
+            todo.append(output_path / rel)
+
+    log.info(
+        f"[validate] Checking {len(todo)} fastq files ({len(checks)} cached) on {threads} threads"
+    )
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for fq, check in zip(todo, pool.map(count_fastq_records, todo)):
+            rel = str(fq.relative_to(output_path))
+            check.path = rel
+            checks[rel] = check
+    _save_cache(cache_path, checks)
+    manifest.update_reads({rel: c.reads for rel, c in checks.items() if c.reads is not None})
+
+    problems = [f"{rel}: {c.error}" for rel, c in checks.items() if c.error]
+
+    # all reads (R1, R2, I1, ...) of a sample must have the same number of records
+    observed: dict[tuple[str, str, int | None], dict[str, int]] = {}
+    for rel, c in checks.items():
+        key = _sample_key(output_path, output_path / rel)
+        if key is None or c.reads is None:
+            continue
+        observed.setdefault(key[:3], {})[rel] = c.reads
+    for key, files in observed.items():
+        if len(set(files.values())) > 1:
+            problems.append(f"{key[1]}: unequal read counts {files}")
+
+    expected = expected_read_counts(output_path)
+    if expected:
+        for (project, sample, lane), files in observed.items():
+            n = next(iter(files.values()))
+            exp = expected.get((project, sample, lane))
+            if exp is None and project:
+                # bcl2fastq nests samples in a sub directory, try without project dir match
+                matches = [v for (p, s, la), v in expected.items() if s == sample and la == lane]
+                exp = matches[0] if len(matches) == 1 else None
+            if exp is None:
+                log.warning(f"[validate] No demultiplexing stats for {project}/{sample}")
+                continue
+            if exp != n:
+                problems.append(
+                    f"{project}/{sample}: {n} reads in fastq, {exp} in demultiplexing stats"
+                )
+    else:
+        log.warning(f"[validate] No demultiplexing stats found in {output_path}")
+
+    if problems:
+        raise FastqValidationError(
+            f"{len(problems)} problem(s) with fastq files in {output_path}:\n" + "\n".join(problems)
+        )
+    log.info(f"[validate] {len(checks)} fastq files validated")
+    return checks
@@ -0,0 +1,240 @@
+"""
+Provisioning of the per-project analysis workspaces used by full_align().
+
+Instead of copying the whole gcf-workflows tree into every analysis
+directory, one immutable snapshot per content hash is kept under
+``$TMPDIR/.gcf-workflows/<digest>`` and ``src/gcf-workflows`` in each
+analysis directory is a symlink to it. A new snapshot is only made when the
+workflow sources actually change. The snapshots last used are kept, and
+so are older ones that an analysis directory in $TMPDIR still links to.
+
+configmaker writes its output to the working directory. It runs in a single
+worker process (``python -m bcl2fastq_pipeline.workspace``) that is started on
+first use and imports configmaker once; for every project the worker changes
+to the analysis directory and runs the configmaker command line there. The
+threads of bfq.py never see a changed cwd, and no interpreter is started per
+project.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import importlib
+import json
+import logging
+import os
+import runpy
+import shutil
+import stat
+import subprocess
+import sys
+import threading
+import traceback
+import uuid
+import warnings
+
+from pathlib import Path
+
+from bcl2fastq_pipeline import tracing
+
+log = logging.getLogger(__name__)
+
+WORKFLOWS_SRC = Path("/opt/gcf-workflows")
+KEEP_SNAPSHOTS = 3
+
+_snapshot_lock = threading.Lock()
+_configmaker_lock = threading.Lock()
+# the configmaker worker, under "configmaker"
+_workers: dict[str, subprocess.Popen] = {}
+
+# stat fingerprint -> content digest, so unchanged trees are not re-hashed
+_digests: dict[str, str] = {}
+
+
+def _tree_files(src: Path) -> list[Path]:
+    files = []
+    for root, dirs, fnames in os.walk(src):
+        dirs[:] = sorted(d for d in dirs if d not in (".git", "__pycache__", ".snakemake"))
+        files += [Path(root) / f for f in sorted(fnames)]
+    return files
+
+
+def tree_digest(src: Path = WORKFLOWS_SRC) -> str:
+    """SHA-256 over the relative paths, modes and contents of all files in src."""
+    files = _tree_files(src)
+    fingerprint = hashlib.sha256()
+    for f in files:
+        st = f.lstat()
+        fingerprint.update(f"{f.relative_to(src)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    key = f"{src}:{fingerprint.hexdigest()}"
+    if key in _digests:
+        return _digests[key]
+
+    h = hashlib.sha256()
+    for f in files:
+        st = f.lstat()
+        h.update(f"{f.relative_to(src)}\0{stat.S_IMODE(st.st_mode) & 0o111}\0".encode())
+        if f.is_symlink():
+            h.update(os.readlink(f).encode())
+        else:
+            with f.open("rb") as fh:
+                while chunk := fh.read(1 << 20):
+                    h.update(chunk)
+        h.update(b"\n")
+    _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def _make_read_only(root: Path) -> None:
+    # Directories stay writable so python can still drop __pycache__ in them
+    for f in _tree_files(root):
+        if not f.is_symlink():
+            f.chmod(f.stat().st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+
+def _linked_snapshots(root: Path) -> set[Path]:
+    """The snapshots in root that the analysis directories next to it link to."""
+    linked = set()
+    for link in root.parent.glob("*/src/gcf-workflows"):
+        if link.is_symlink():
+            linked.add(Path(os.path.normpath(link.parent / link.readlink())))
+    return linked
+
+
+def _prune_snapshots(root: Path, current: Path, keep: int = KEEP_SNAPSHOTS) -> None:
+    """
+    Remove all but the keep snapshots used last, never current or a linked one.
+
+    snapshot() sets the mtime of a snapshot whenever it returns it, copytree()
+    leaves that of the source on it.
+    """
+    snaps = sorted(
+        (d for d in root.iterdir() if d.is_dir() and not d.name.startswith(".")),
+        key=lambda d: (d.stat().st_mtime_ns, d.name),
+        reverse=True,
+    )
+    protected = _linked_snapshots(root) | {current}
+    for d in snaps[keep:]:
+        if d in protected:
+            continue
+        log.info(f"[workspace] Removing old workflow snapshot {d}")
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def snapshot(src: Path = WORKFLOWS_SRC, root: Path | None = None) -> Path:
+    """
+    Return the immutable snapshot of src, creating it if this content is new.
+
+    Snapshots are written to a temporary directory and renamed into place, so
+    concurrent callers never see a half-copied tree.
+    """
+    root = Path(root or Path(os.environ["TMPDIR"]) / ".gcf-workflows")
+    with _snapshot_lock:
+        digest = tree_digest(src)
+        snap = root / digest[:16]
+        if snap.exists():
+            os.utime(snap)
+            return snap
+
+        root.mkdir(parents=True, exist_ok=True)
+        tmp = root / f".tmp-{uuid.uuid4().hex}"
+        log.info(f"[workspace] Creating workflow snapshot {snap} from {src}")
+        shutil.copytree(src, tmp, symlinks=True, ignore=shutil.ignore_patterns(".git"))
+        _make_read_only(tmp)
+        try:
+            tmp.rename(snap)
+        except OSError:
+            # made by another process in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        os.utime(snap)
+        _prune_snapshots(root, snap)
+        return snap
+
+
+def provision(analysis_dir: Path, src: Path = WORKFLOWS_SRC) -> Path:
+    """Point analysis_dir/src/gcf-workflows at the current workflow snapshot."""
+    snap = snapshot(src)
+    dst = Path(analysis_dir) / "src" / "gcf-workflows"
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.is_symlink():
+        if dst.readlink() == snap:
+            return dst
+        dst.unlink()
+    elif dst.exists():
+        # copy made by an earlier version of the pipeline
+        shutil.rmtree(dst)
+    dst.symlink_to(snap, target_is_directory=True)
+    log.debug(f"[workspace] {dst} -> {snap}")
+    return dst
+
+
+def _configmaker_worker() -> subprocess.Popen:
+    worker = _workers.get("configmaker")
+    if worker is None or worker.poll() is not None:
+        worker = subprocess.Popen(
+            [sys.executable, "-m", "bcl2fastq_pipeline.workspace"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        _workers["configmaker"] = worker
+        log.debug(f"[workspace] Started the configmaker worker, pid {worker.pid}")
+    return worker
+
+
+def run_configmaker(analysis_dir: Path, argv: list[str]) -> None:
+    """Run ``configmaker.py <argv>`` in analysis_dir, in the configmaker worker."""
+    request = json.dumps({"cwd": str(Path(analysis_dir).resolve()), "argv": argv})
+    with (
+        _configmaker_lock,
+        tracing.span("configmaker", cmd=" ".join(["configmaker.py", *argv])) as span,
+    ):
+        worker = _configmaker_worker()
+        span.set(pid=worker.pid)
+        try:
+            worker.stdin.write(request + "\n")
+            worker.stdin.flush()
+            reply = worker.stdout.readline()
+        except BrokenPipeError:
+            reply = ""
+        if not reply:
+            _workers.pop("configmaker", None)
+            raise RuntimeError(f"The configmaker worker exited with code {worker.wait()}")
+        returncode = json.loads(reply)["returncode"]
+        span.set(returncode=returncode)
+    if returncode:
+        raise RuntimeError(f"configmaker failed with exit code {returncode}: {argv}")
+
+
+def _serve_configmaker() -> None:
+    """The configmaker worker: one JSON request per line of stdin, one reply per request."""
+    replies = os.fdopen(os.dup(1), "w")
+    # whatever configmaker prints goes to stderr, stdout carries the replies
+    os.dup2(2, 1)
+    importlib.import_module("configmaker.configmaker")
+    for line in sys.stdin:
+        request = json.loads(line)
+        sys.argv = ["configmaker.py", *request["argv"]]
+        returncode = 0
+        with contextlib.chdir(request["cwd"]), warnings.catch_warnings():
+            # runpy warns when re-executing a module that is already imported
+            warnings.simplefilter("ignore", RuntimeWarning)
+            try:
+                runpy.run_module("configmaker.configmaker", run_name="__main__")
+            except SystemExit as e:
+                if isinstance(e.code, int):
+                    returncode = e.code
+                elif e.code is not None:
+                    print(e.code, file=sys.stderr)
+                    returncode = 1
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+        sys.stdout.flush()
+        replies.write(json.dumps({"returncode": returncode}) + "\n")
+        replies.flush()
+
+
+if __name__ == "__main__":
+    _serve_configmaker()
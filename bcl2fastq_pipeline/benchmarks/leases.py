@@ -0,0 +1,166 @@
+"""
+Several bfq-like workers sharing one manager_dir, to check the leases.
+
+Starts --workers processes on a temporary directory. Each one goes through the
+same --runs runs in its own random order, leases a run the way bfq.py does,
+"processes" it for --work seconds, then adds it to flowcells.processed and
+rewrites the file to mark it archived, both under the inventory lock of
+flowcell_manager. The first --crashers workers die without releasing their
+first lease, which the others then have to take over once it is --ttl
+seconds old.
+
+    python -m benchmarks.leases --workers 6 --runs 40 --crashers 2
+
+At the end it checks that every run was completed exactly once, that no two
+workers processed a run at the same time, and that flowcells.processed has
+one archived row per run; it exits with 1 if not.
+"""
+
+from __future__ import annotations
+
+import argparse
+import collections
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+from bcl2fastq_pipeline.lease import LeaseDir
+
+
+def worker(work: Path, index: int, args: argparse.Namespace) -> int:
+    os.environ["BFQ_CONFIG"] = str(work / "bcl2fastq.ini")
+    fm = importlib.import_module("flowcell_manager.flowcell_manager")
+    leases = LeaseDir(work / "manager" / "leases", args.ttl, owner=f"worker{index}")
+    rng = random.Random(index)
+    crash = index < args.crashers
+    runs = [f"run{i:04d}" for i in range(args.runs)]
+    events = (work / "events" / f"worker{index}.jsonl").open("a", buffering=1)
+
+    def event(run: str, what: str) -> None:
+        events.write(json.dumps({"run": run, "event": what, "time": time.time()}) + "\n")
+
+    while pending := [r for r in runs if not (work / "done" / r).exists()]:
+        rng.shuffle(pending)
+        for run in pending:
+            lease = leases.acquire(run)
+            if lease is None:
+                continue
+            if (work / "done" / run).exists():
+                leases.release(lease)
+                continue
+            event(run, "start")
+            if crash:
+                os._exit(1)
+            time.sleep(args.work)
+            if lease.lost:
+                event(run, "lost")
+                continue
+            path = f"/mnt/output/{run}"
+            fm.add_flowcell(project="GCF-2024-001", path=path, timestamp="2024-04-15 12:00:00")
+
+            def mark_archived(df, path=path):
+                df.loc[df["flowcell_path"] == path, "archived"] = 1
+                return df
+
+            fm.write_inventory(mark_archived)
+            (work / "done" / run).write_text(f"worker{index}")
+            event(run, "end")
+            leases.release(lease)
+        time.sleep(0.05)
+    return 0
+
+
+def check(work: Path, runs: int, crashers: int) -> list[str]:
+    """The problems found in the events and the inventory."""
+    events = collections.defaultdict(list)
+    for path in (work / "events").glob("*.jsonl"):
+        for line in path.read_text().splitlines():
+            e = json.loads(line)
+            events[e["run"]].append((e["time"], e["event"], path.stem))
+
+    problems = []
+    for i in range(runs):
+        run = f"run{i:04d}"
+        ends = [e for e in events[run] if e[1] == "end"]
+        if len(ends) != 1:
+            problems.append(f"{run} completed {len(ends)} times")
+        # a run is processed by one worker at a time: each start follows the end
+        # or the loss of the previous one, or the death of a crasher
+        active = None
+        for _, what, who in sorted(events[run]):
+            if what == "start":
+                if active:
+                    problems.append(f"{run} started by {who} while {active} had it")
+                active = None if int(who.removeprefix("worker")) < crashers else who
+            else:
+                active = None
+
+    rows = [
+        line.split(",")
+        for line in (work / "manager" / "flowcells.processed").read_text().splitlines()[1:]
+    ]
+    paths = collections.Counter(r[1] for r in rows)
+    if len(paths) != runs or any(n != 1 for n in paths.values()):
+        problems.append(f"flowcells.processed has {len(rows)} rows for {len(paths)} of {runs} runs")
+    if any(r[3] != "1" for r in rows):
+        problems.append("flowcells.processed has rows that lost their archived mark")
+    return problems
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--workers", type=int, default=6)
+    ap.add_argument("--runs", type=int, default=40)
+    ap.add_argument("--crashers", type=int, default=2, help="workers that die holding a lease")
+    ap.add_argument("--work", type=float, default=0.2, help="seconds to process a run")
+    ap.add_argument("--ttl", type=float, default=2.0, help="seconds before a lease is stale")
+    ap.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    ap.add_argument("--dir", type=Path, help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+    if args.worker is not None:
+        return worker(args.dir, args.worker, args)
+
+    with tempfile.TemporaryDirectory(prefix="bfq-leases-") as tmp:
+        work = Path(tmp)
+        for d in ("manager", "done", "events"):
+            (work / d).mkdir()
+        (work / "bcl2fastq.ini").write_text(f"[Paths]\nmanager_dir = {work / 'manager'}\n")
+        (work / "manager" / "flowcells.processed").write_text(
+            "project,flowcell_path,timestamp,archived\n"
+        )
+        t0 = time.perf_counter()
+        procs = [
+            subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.leases", *(argv or sys.argv[1:])]
+                + ["--worker", str(i), "--dir", str(work)]
+            )
+            for i in range(args.workers)
+        ]
+        for p in procs:
+            p.wait()
+        elapsed = time.perf_counter() - t0
+
+        problems = check(work, args.runs, args.crashers)
+        done = collections.Counter(p.read_text() for p in (work / "done").iterdir())
+        print(f"{args.runs} runs by {args.workers} workers in {elapsed:.1f} s")
+        crashed = sum(
+            1 for i in range(args.crashers) if (work / "events" / f"worker{i}.jsonl").read_text()
+        )
+        print(f"leases taken over from crashed workers: {crashed}")
+        print("completed per worker: " + ", ".join(f"{w}={n}" for w, n in sorted(done.items())))
+        for problem in problems:
+            print(f"FAIL: {problem}")
+        if not problems:
+            print("OK: every run completed once, never by two workers at a time")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
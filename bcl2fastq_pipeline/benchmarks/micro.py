@@ -0,0 +1,401 @@
+"""
+Micro-benchmarks of the parsing code of the pipeline.
+
+Each benchmark calls one function on a generated fixture of three sizes:
+
+    • small     – 1 lane, 12 samples, 500 inventory rows (a MiSeq run)
+    • novaseq   – 4 lanes, 384 samples, 20 000 inventory rows (a NovaSeq S4 run)
+    • novaseqx  – 8 lanes, 1536 samples, 100 000 inventory rows (a NovaSeq X 25B run)
+
+and reports, in milliseconds, the first call after all caches are cleared
+(``cold``, what a new run costs) and the best of the repeated calls
+(``warm``, what every further call costs), and the peak memory of a cold call
+in KiB (from tracemalloc, so only Python allocations count).
+
+    python -m benchmarks.micro                      # all sizes, compared with baseline.json
+    python -m benchmarks.micro -s novaseq -k fm.    # one size, the flowcell_manager functions
+    python -m benchmarks.micro --save               # make the results the new baseline
+
+benchmarks/baseline.json holds the results the comparison is made against. A
+benchmark more than --threshold times slower (or larger) than its baseline is
+reported as a regression, and with --check the exit status is then 1. The
+fixtures are written to --work once and reused.
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+import tracemalloc
+
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+
+from bcl2fastq_pipeline.config import PipelineConfig, parse_custom_options
+
+from bcl2fastq_pipeline import inputs, libprep, stats_json
+from benchmarks import synthetic
+
+BASELINE = Path(__file__).resolve().parent / "baseline.json"
+DEFAULT_THRESHOLD = 1.5
+MIN_REPEAT_SECONDS = 0.2
+MAX_REPEATS = 50
+
+
+@dataclass
+class Size:
+    """A fixture size: the run and the inventory."""
+
+    spec: synthetic.FlowcellSpec
+    history: int
+    libpreps: int = 150
+
+
+SIZES = {
+    "small": Size(
+        synthetic.FlowcellSpec(
+            instrument="M05617",
+            lanes=1,
+            tiles_per_lane=14,
+            cycles=(151, 8, 8, 151),
+            projects=1,
+            samples_per_project=12,
+            reads_per_sample=10,
+        ),
+        history=500,
+    ),
+    "novaseq": Size(
+        synthetic.FlowcellSpec(
+            lanes=4,
+            tiles_per_lane=88,
+            cycles=(151, 10, 10, 151),
+            projects=8,
+            samples_per_project=48,
+            reads_per_sample=10,
+        ),
+        history=20_000,
+    ),
+    "novaseqx": Size(
+        synthetic.FlowcellSpec(
+            flowcell="22BENCHLT3",
+            lanes=8,
+            tiles_per_lane=128,
+            cycles=(151, 10, 10, 151),
+            projects=16,
+            samples_per_project=96,
+            reads_per_sample=10,
+        ),
+        history=100_000,
+    ),
+}
+
+
+@dataclass
+class Fixture:
+    """A generated run, its demultiplexed output and an inventory, with a loaded config."""
+
+    name: str
+    root: Path
+    size: Size
+    cfg: PipelineConfig = field(init=False)
+
+    @property
+    def run_dir(self) -> Path:
+        return self.root / "seq" / "nova" / self.size.spec.run_id
+
+    @property
+    def output_path(self) -> Path:
+        return self.root / "output" / self.size.spec.run_id
+
+    @property
+    def libprep_config(self) -> Path:
+        return self.root / "libprep.config"
+
+    def build(self) -> None:
+        done = self.root / "fixture.done"
+        if not done.exists():
+            shutil.rmtree(self.root, ignore_errors=True)
+            self._write()
+            done.write_text("")
+        ini = self.root / "bcl2fastq.ini"
+        self.cfg = PipelineConfig.load(ini)
+        self.cfg.run.reset()
+        self.cfg.run.begin(self.run_dir, self.cfg.static.paths)
+        opts, sheet = parse_custom_options(self.run_dir / "SampleSheet.csv")
+        self.cfg.run.apply_custom(opts, sheet, self.run_dir / "Sample-Submission-Form.xlsx")
+
+    def _write(self) -> None:
+        spec = self.size.spec
+        for d in ("seq/nova", "seq/ekista", "output", "logs", "manager"):
+            (self.root / d).mkdir(parents=True)
+        synthetic.make_flowcell(self.root / "seq" / "nova", spec)
+        synthetic.write_demux_output(
+            self.run_dir, self.output_path, self.run_dir / "SampleSheet.csv", spec.reads_per_sample
+        )
+        shutil.copytree(self.run_dir / "InterOp", self.output_path / "InterOp")
+        shutil.copy2(self.run_dir / "RunInfo.xml", self.output_path / "RunInfo.xml")
+        (self.output_path / "Stats").symlink_to(
+            self.output_path / "Reports" / "legacy" / "Stats", target_is_directory=True
+        )
+        self._write_inventory()
+        entries = {
+            f"Bench Library Prep Kit {i} {'PE' if i % 2 else 'SE'}": {"workflow": "rnaseq"}
+            for i in range(self.size.libpreps - 1)
+        }
+        entries[spec.libprep] = {"workflow": "rnaseq", "reads": "PE"}
+        self.libprep_config.write_text(
+            "".join(f"{k}:\n  workflow: {v['workflow']}\n" for k, v in entries.items())
+        )
+        (self.root / "bcl2fastq.ini").write_text(
+            "[Paths]\n"
+            + "".join(
+                f"{key} = {self.root / d}\n"
+                for key, d in (
+                    ("nova_baseDir", "seq/nova"),
+                    ("ekista_baseDir", "seq/ekista"),
+                    ("outputDir", "output"),
+                    ("logDir", "logs"),
+                    ("manager_dir", "manager"),
+                )
+            )
+        )
+
+    def _write_inventory(self) -> None:
+        """flowcells.processed with the inventory rows, four projects per flowcell."""
+        rows = self.size.history
+        start = datetime.datetime(2015, 1, 1)
+        out = self.root / "output"
+        pd.DataFrame(
+            {
+                "project": [f"GCF-{2015 + i // 8000}-{i % 1000:03d}" for i in range(rows)],
+                "flowcell_path": [
+                    f"{out}/{i // 4:06d}_A01990_{i // 4:04d}_AHIST" for i in range(rows)
+                ],
+                "timestamp": [start + datetime.timedelta(hours=i) for i in range(rows)],
+                "archived": [int(i < rows * 0.8) for i in range(rows)],
+            },
+            columns=["project", "flowcell_path", "timestamp", "archived"],
+        ).to_csv(self.root / "manager" / "flowcells.processed", index=False)
+
+
+def reset_caches(fx: Fixture) -> None:
+    """Forget everything parsed before, in memory and on disk."""
+    with inputs._cache_lock:
+        inputs._cache.clear()
+    stats_json._summaries.clear()
+    (fx.output_path / stats_json.CACHE_NAME).unlink(missing_ok=True)
+    with libprep._registries_lock:
+        libprep._registries.clear()
+
+
+# --------------------------------------------------------------------------- #
+# Benchmarks
+# --------------------------------------------------------------------------- #
+@dataclass
+class Benchmark:
+    name: str
+    # fixture -> the call to time
+    setup: Callable[[Fixture], Callable[[], object]]
+
+
+def _after_fastq():
+    return importlib.import_module("bcl2fastq_pipeline.afterFastq")
+
+
+def _misc():
+    return importlib.import_module("bcl2fastq_pipeline.misc")
+
+
+def _fm():
+    return importlib.import_module("flowcell_manager.flowcell_manager")
+
+
+def _find_flowcells():
+    return importlib.import_module("bcl2fastq_pipeline.findFlowCells")
+
+
+def _fastqs(fx: Fixture) -> list[Path]:
+    return sorted(fx.output_path.glob("*/*.fastq.gz"))
+
+
+def _to_dirs(fx: Fixture) -> Callable[[], object]:
+    files = _fastqs(fx)
+    return lambda: _after_fastq().to_dirs(files)
+
+
+def _get_project_names(fx: Fixture) -> Callable[[], object]:
+    dirs = [str(f.parent) for f in _fastqs(fx)]
+    return lambda: _after_fastq().get_project_names(dirs)
+
+
+BENCHMARKS = [
+    Benchmark(
+        "parse_custom_options",
+        lambda fx: lambda: parse_custom_options(fx.run_dir / "SampleSheet.csv"),
+    ),
+    Benchmark(
+        "get_sample_sheet", lambda fx: lambda: _find_flowcells().get_sample_sheet(fx.run_dir)
+    ),
+    Benchmark(
+        "set_pipeline_from_yaml",
+        lambda fx: lambda: fx.cfg.run.set_pipeline_from_yaml(fx.libprep_config),
+    ),
+    Benchmark(
+        "parserDemultiplexStats",
+        lambda fx: lambda: _misc().parserDemultiplexStats(fx.cfg),
+    ),
+    Benchmark(
+        "getFCmetricsImproved",
+        lambda fx: _misc().getFCmetricsImproved,
+    ),
+    Benchmark(
+        "get_read_geometry",
+        lambda fx: lambda: _after_fastq().get_read_geometry(fx.output_path),
+    ),
+    Benchmark(
+        "to_dirs",
+        _to_dirs,
+    ),
+    Benchmark(
+        "get_project_names",
+        _get_project_names,
+    ),
+    Benchmark("fm.list_all", lambda fx: _fm().list_all),
+    Benchmark("fm.list_processed", lambda fx: _fm().list_processed),
+    Benchmark("fm.list_project", lambda fx: lambda: _fm().list_project("GCF-2016-123")),
+    Benchmark(
+        "fm.list_flowcell",
+        lambda fx: lambda: _fm().list_flowcell(
+            str(fx.root / "output" / "000042_A01990_0042_AHIST")
+        ),
+    ),
+    Benchmark(
+        "fm.list_flowcell_all", lambda fx: lambda: _fm().list_flowcell_all(str(fx.output_path))
+    ),
+]
+
+
+def measure(fx: Fixture, bench: Benchmark) -> dict[str, float]:
+    call = bench.setup(fx)
+    # once untimed, so the imports of the first call are not counted
+    call()
+
+    reset_caches(fx)
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    def timed(cold: bool) -> list[float]:
+        times, spent = [], 0.0
+        while len(times) < 3 or (spent < MIN_REPEAT_SECONDS and len(times) < MAX_REPEATS):
+            if cold:
+                reset_caches(fx)
+            t0 = time.perf_counter()
+            call()
+            times.append(time.perf_counter() - t0)
+            spent += times[-1]
+        return times
+
+    cold = timed(cold=True)
+    warm = timed(cold=False)
+    return {
+        "cold_ms": round(1000 * min(cold), 3),
+        "warm_ms": round(1000 * min(warm), 3),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+# --------------------------------------------------------------------------- #
+# Reporting
+# --------------------------------------------------------------------------- #
+def compare(
+    results: dict[str, dict[str, dict]], baseline: dict[str, dict[str, dict]], threshold: float
+) -> list[str]:
+    """Print the results next to the baseline; returns the regressions."""
+    regressions = []
+    print(
+        f"{'size':10}{'benchmark':26}{'cold ms':>11}{'warm ms':>11}{'peak KiB':>11}"
+        f"{'cold':>8}{'warm':>8}{'peak':>8}"
+    )
+    for size, benches in results.items():
+        for name, r in benches.items():
+            base = baseline.get(size, {}).get(name)
+            line = (
+                f"{size:10}{name:26}{r['cold_ms']:11.3f}{r['warm_ms']:11.3f}{r['peak_kib']:11.1f}"
+            )
+            if base:
+                for key in ("cold_ms", "warm_ms", "peak_kib"):
+                    ratio = r[key] / base[key] if base[key] else 1.0
+                    line += f"{ratio:7.2f}x"
+                    # sub-millisecond timings are too noisy to call regressions
+                    if ratio > threshold and (key == "peak_kib" or r[key] >= 1.0):
+                        regressions.append(f"{size} {name} {key}: {base[key]} -> {r[key]}")
+            print(line)
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("-s", "--sizes", default=",".join(SIZES), help="comma-separated fixture sizes")
+    ap.add_argument("-k", "--filter", default="", help="only benchmarks whose name contains this")
+    ap.add_argument("--work", type=Path, default=Path("/tmp/bfq-micro"), help="fixture directory")
+    ap.add_argument("--baseline", type=Path, default=BASELINE)
+    ap.add_argument("--save", action="store_true", help="write the results to --baseline")
+    ap.add_argument("--json", type=Path, help="also write the results to this file")
+    ap.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    ap.add_argument("--check", action="store_true", help="exit with 1 on regressions")
+    args = ap.parse_args(argv)
+
+    # TMPDIR is where the submission form and workflow caches go
+    os.environ.setdefault("TMPDIR", str(args.work / "tmp"))
+    selected = [b for b in BENCHMARKS if args.filter in b.name]
+    results: dict[str, dict[str, dict]] = {}
+    for size in args.sizes.split(","):
+        fx = Fixture(size, args.work / size, SIZES[size])
+        t0 = time.perf_counter()
+        fx.build()
+        print(f"[{size}] fixture ready in {time.perf_counter() - t0:.1f} s", file=sys.stderr)
+        results[size] = {}
+        for bench in selected:
+            results[size][bench.name] = measure(fx, bench)
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())["results"]
+    regressions = compare(results, baseline, args.threshold)
+
+    doc = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.json:
+        args.json.write_text(json.dumps(doc, indent=2) + "\n")
+    if args.save:
+        # results of benchmarks not run here (--filter, --sizes) are kept from the old baseline
+        for size, benches in baseline.items():
+            for name, r in benches.items():
+                results.setdefault(size, {}).setdefault(name, r)
+        args.baseline.write_text(json.dumps(doc, indent=2) + "\n")
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+    if regressions:
+        print("Regressions:\n  " + "\n  ".join(regressions), file=sys.stderr)
+        return 1 if args.check else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+"""
+End-to-end benchmark of the orchestration in bfq.py.
+
+Runs the stages of bfq.py on synthetic runs (see synthetic), with the stub
+tools of benchmarks/bin first on PATH, and reports the seconds spent in each
+stage as the number of projects, samples and inventory rows grows. With the
+stubs doing next to nothing, the time left is the pipeline's own overhead:
+parsing, scanning, copying, hashing and bookkeeping.
+
+    python -m benchmarks.run_pipeline --scales 2x8,4x24,8x96 --history 0,20000
+
+Every scale is PxS (projects x samples per project) and is run once for each
+history size, the number of rows in flowcells.processed before the run. Each
+combination gets a fresh work directory with its own bcl2fastq.ini, the trace
+of the stages is in its logs/. The results are printed as a table and, with
+--json, written as JSON.
+
+The stages are those of bfq.py, under the same span names. full_align needs
+configmaker and /opt/gcf-workflows (the docker image); without them each
+project is analysed by the snakemake stub directly and only the harvest of its
+reports is the pipeline's own code.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+
+import pandas as pd
+
+from bcl2fastq_pipeline.config import PipelineConfig
+
+from bcl2fastq_pipeline import (
+    afterFastq,
+    findFlowCells,
+    makeFastq,
+    manifest,
+    metrics_store,
+    misc,
+    procmon,
+    staging,
+    tracing,
+    validate,
+    workspace,
+)
+from benchmarks import synthetic
+
+STUB_BIN = Path(__file__).resolve().parent / "bin"
+LIBPREP_CONFIG = """\
+Lexogen SENSE mRNA-Seq Library Prep Kit V2 PE:
+  workflow: rnaseq
+  reads: PE
+Lexogen SENSE mRNA-Seq Library Prep Kit V2 SE:
+  workflow: rnaseq
+  reads: SE
+"""
+INI = """\
+[Paths]
+nova_baseDir = {work}/seq/nova
+ekista_baseDir = {work}/seq/ekista
+outputDir = {work}/output
+logDir = {work}/logs
+reportDir = {work}/reports
+analysisDir = {work}/analysis
+manager_dir = {work}/manager
+{scratch}
+[System]
+sleeptime = 1
+analysis_cores = {cores}
+procmon_interval = 1
+status_port = 0
+email_max_attempts = 1
+{system}
+[Email]
+host = 127.0.0.1:1
+from_address = bfq-bench@localhost
+finished_to = bfq-bench@localhost
+error_to = bfq-bench@localhost
+
+[Commands]
+multiqc_command = multiqc
+multiqc_options = -f --no-data-dir -q
+"""
+
+
+@dataclass
+class Result:
+    projects: int
+    samples_per_project: int
+    history: int
+    reads_per_sample: int
+    stages: dict[str, float] = field(default_factory=dict)
+    fastq_bytes: int = 0
+
+    @property
+    def label(self) -> str:
+        return f"{self.projects}x{self.samples_per_project} h={self.history}"
+
+    @property
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+
+def parse_scales(value: str) -> list[tuple[int, int]]:
+    scales = []
+    for item in value.split(","):
+        p, _, s = item.strip().lower().partition("x")
+        scales.append((int(p), int(s)))
+    return scales
+
+
+def write_history(path: Path, rows: int) -> None:
+    """flowcells.processed with rows earlier runs of four projects each."""
+    start = datetime.datetime(2015, 1, 1)
+    pd.DataFrame(
+        {
+            "project": [f"GCF-{2015 + i // 4000}-{i % 1000:03d}" for i in range(rows)],
+            "flowcell_path": [
+                f"/mnt/output/{i // 4:06d}_A01990_{i // 4:04d}_AHIST" for i in range(rows)
+            ],
+            "timestamp": [start + datetime.timedelta(hours=i) for i in range(rows)],
+            "archived": [int(i < rows * 0.8) for i in range(rows)],
+        },
+        columns=["project", "flowcell_path", "timestamp", "archived"],
+    ).to_csv(path, index=False)
+
+
+def setup(work: Path, spec: synthetic.FlowcellSpec, history: int, args) -> Path:
+    """A fresh work directory with one synthetic run; returns its bcl2fastq.ini."""
+    if work.exists():
+        shutil.rmtree(work)
+    for d in ("seq/nova", "seq/ekista", "output", "logs", "reports", "analysis", "manager", "tmp"):
+        (work / d).mkdir(parents=True)
+    synthetic.make_flowcell(work / "seq" / "nova", spec)
+    write_history(work / "manager" / "flowcells.processed", history)
+    (work / "libprep.config").write_text(LIBPREP_CONFIG)
+    ini = work / "bcl2fastq.ini"
+    scratch = f"scratchDir = {work}/scratch\n" if args.prefetch or args.stream else ""
+    system = "demux_to_scratch = yes\ndemux_settle = 0.5\n" if args.stream else ""
+    ini.write_text(INI.format(work=work, cores=args.cores, scratch=scratch, system=system))
+    return ini
+
+
+def can_align() -> bool:
+    """Whether full_align can run for real: configmaker and the workflows are installed."""
+    try:
+        importlib.import_module("configmaker.configmaker")
+    except ImportError:
+        return False
+    return workspace.WORKFLOWS_SRC.exists()
+
+
+def stub_align(cfg) -> None:
+    """full_align without configmaker: link the FASTQ files, run the snakemake stub, harvest."""
+    run_date = cfg.run.run_id.split("_")[0]
+    mf = manifest.get_manifest(cfg)
+    for p in mf.project_names():
+        with tracing.span("full_align", project=p, samples=len(mf.samples(p))):
+            analysis_dir = Path(os.environ["TMPDIR"]) / f"{p}_{run_date}"
+            fastq_dir = analysis_dir / "data" / "raw" / "fastq"
+            fastq_dir.mkdir(parents=True, exist_ok=True)
+            for f in (cfg.output_path / p).glob("*.fastq.gz"):
+                (fastq_dir / f.name).symlink_to(f)
+            tracing.check_call("snakemake --cores 1 multiqc_report", shell=True, cwd=analysis_dir)
+            afterFastq.harvest_project(cfg, p, analysis_dir)
+    (cfg.output_path / "analysis.made").write_text("")
+
+
+def run_once(work: Path, spec: synthetic.FlowcellSpec, history: int, args) -> Result:
+    result = Result(spec.projects, spec.samples_per_project, history, spec.reads_per_sample)
+    ini = setup(work, spec, history, args)
+    os.environ["TMPDIR"] = str(work / "tmp")
+    cfg = PipelineConfig.load(ini)
+    tracing.configure(cfg)
+    procmon.configure(cfg)
+
+    @contextlib.contextmanager
+    def stage(name: str):
+        with tracing.span(name) as s:
+            yield s
+        result.stages[name] = round(s.duration, 3)
+
+    with stage("discovery"):
+        dirs = sorted(
+            cfg.static.paths.nova_base_dir.glob(
+                f"*_A01990_*/{synthetic.COMPLETION_FILES['A01990']}"
+            )
+        )
+    cfg.run.begin(dirs[0].parent, cfg.static.paths)
+    with stage("flowCellProcessed"):
+        if findFlowCells.flowCellProcessed():
+            raise RuntimeError(f"{cfg.run.run_id} is in the history")
+    with stage("newFlowCell"):
+        findFlowCells.newFlowCell()
+    if not cfg.run.run_id:
+        raise RuntimeError("newFlowCell did not accept the synthetic run")
+
+    tracing.begin_run(cfg)
+    try:
+        with stage("bcl2fq"):
+            makeFastq.bcl2fq()
+        staging.release(cfg.run.run_id)
+        with stage("rename_fastqs"):
+            makeFastq.rename_fastqs()
+            manifest.build_manifest(cfg)
+        with stage("validate_fastqs"):
+            validate.validate_fastqs(cfg)
+        # the parts of postMakeSteps, timed on their own
+        cfg.run.set_pipeline_from_yaml(work / "libprep.config")
+        with stage("md5sum_worker"):
+            afterFastq.md5sum_worker(cfg)
+        with stage("full_align"):
+            if can_align():
+                afterFastq.full_align(cfg)
+            else:
+                stub_align(cfg)
+        with stage("multiqc_stats"):
+            afterFastq.multiqc_stats(cfg)
+        with stage("getFCmetrics"):
+            message = misc.getFCmetricsImproved()
+        with stage("record_metrics"):
+            metrics_store.record_run(cfg)
+        with stage("finishedEmail"):
+            misc.finishedEmail(message, datetime.timedelta(seconds=result.total))
+        with stage("finalize"):
+            afterFastq.finalize()
+        with stage("markFinished"):
+            findFlowCells.markFinished()
+        result.fastq_bytes = sum(
+            manifest.get_manifest(cfg).project_size(p)
+            for p in manifest.get_manifest(cfg).project_names()
+        )
+    finally:
+        tracing.end_run()
+        cfg.run.reset()
+    return result
+
+
+def print_table(results: list[Result]) -> None:
+    stages = list(dict.fromkeys(s for r in results for s in r.stages))
+    width = max(len(s) for s in [*stages, "total"]) + 2
+    cols = [r.label for r in results]
+    cw = max(12, *(len(c) + 2 for c in cols))
+    print("stage".ljust(width) + "".join(c.rjust(cw) for c in cols))
+    for s in stages:
+        print(s.ljust(width) + "".join(f"{r.stages.get(s, float('nan')):{cw}.3f}" for r in results))
+    print("total".ljust(width) + "".join(f"{r.total:{cw}.3f}" for r in results))
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--scales", default="2x8,4x24,8x96", help="projects x samples, e.g. 2x8,4x24")
+    ap.add_argument(
+        "--history", default="0,20000", help="rows in flowcells.processed, e.g. 0,20000"
+    )
+    ap.add_argument("--reads", type=int, default=1000, help="FASTQ records per sample and read")
+    ap.add_argument("--lanes", type=int, default=2)
+    ap.add_argument("--cores", type=int, default=os.cpu_count() or 4, help="analysis_cores")
+    ap.add_argument("--report-kb", type=int, default=500, help="size of every HTML report")
+    ap.add_argument("--work", type=Path, default=Path("/tmp/bfq-bench"))
+    ap.add_argument("--json", type=Path, help="write the results as JSON to this file")
+    ap.add_argument("--keep", action="store_true", help="keep the work directories")
+    ap.add_argument(
+        "--prefetch", action="store_true", help="copy the run to scratchDir before bcl-convert"
+    )
+    ap.add_argument(
+        "--stream",
+        action="store_true",
+        help="bcl-convert writes to scratchDir, its output is moved while it runs",
+    )
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+    )
+    # the emails go to a closed port on purpose
+    logging.getLogger("bcl2fastq_pipeline.outbox").setLevel(logging.CRITICAL)
+    os.environ["PATH"] = f"{STUB_BIN}{os.pathsep}{os.environ.get('PATH', '')}"
+    os.environ["BENCH_READS_PER_SAMPLE"] = str(args.reads)
+    os.environ["BENCH_REPORT_KB"] = str(args.report_kb)
+
+    results = []
+    for history in (int(h) for h in args.history.split(",")):
+        for projects, samples in parse_scales(args.scales):
+            spec = synthetic.FlowcellSpec(
+                projects=projects,
+                samples_per_project=samples,
+                reads_per_sample=args.reads,
+                lanes=args.lanes,
+            )
+            work = args.work / f"{projects}x{samples}_h{history}"
+            t0 = time.perf_counter()
+            results.append(run_once(work, spec, history, args))
+            print(
+                f"{results[-1].label}: {time.perf_counter() - t0:.1f} s",
+                file=sys.stderr,
+                flush=True,
+            )
+            if not args.keep:
+                shutil.rmtree(work, ignore_errors=True)
+
+    print_table(results)
+    if args.json:
+        args.json.write_text(
+            json.dumps([asdict(r) | {"total": round(r.total, 3)} for r in results], indent=2)
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
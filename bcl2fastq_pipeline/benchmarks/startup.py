@@ -0,0 +1,163 @@
+"""
+Startup benchmark of the flowcell_manager command line.
+
+Runs the commands of flowcell_manager as a user would, one fresh interpreter
+each, against a synthetic flowcells.processed, and reports the median wall
+time of every command and the modules that take longest to import:
+
+    python -m benchmarks.startup --rows 20000 --repeat 5 --ref HEAD~1
+
+With --ref the same commands are run on the tree of that git revision as
+well (extracted with git archive), and the ratio new/old is printed next to
+the times.
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+PACKAGE = Path(__file__).resolve().parent.parent
+SCRIPT = Path("flowcell_manager") / "flowcell_manager.py"
+COMMANDS = {
+    "help": ["--help"],
+    "list": ["list"],
+    "list-processed": ["list-processed"],
+    "query": ["query", "--project", "GCF-2016-007"],
+    "add": ["add", "GCF-2024-001", "/mnt/output/NEW_A01990_AXXX", "2024-04-15T12:00:00"],
+}
+
+
+def write_inventory(path: Path, rows: int) -> None:
+    """flowcells.processed with rows earlier runs of four projects each, 80% archived."""
+    with path.open("w") as fh:
+        fh.write("project,flowcell_path,timestamp,archived\n")
+        for i in range(rows):
+            archived = "2023-01-01 00:00:00" if i < rows * 0.8 else "0"
+            fh.write(
+                f"GCF-{2015 + i // 4000}-{i % 1000:03d},"
+                f"/mnt/output/{i // 4:06d}_A01990_{i // 4:04d}_AHIST,"
+                f"2015-01-01 00:00:00,{archived}\n"
+            )
+
+
+def run(tree: Path, work: Path, argv: list[str]) -> float:
+    """Wall seconds of one command, run on a fresh copy of the inventory."""
+    shutil.copy(work / "flowcells.template", work / "manager" / "flowcells.processed")
+    env = os.environ | {"BFQ_CONFIG": str(work / "bcl2fastq.ini"), "PYTHONPATH": str(tree)}
+    t0 = time.perf_counter()
+    subprocess.run(
+        [sys.executable, str(tree / SCRIPT), *argv],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - t0
+
+
+def import_times(tree: Path, work: Path, top: int) -> list[tuple[int, str]]:
+    """The cumulative import time in µs of the slowest top-level imports of the help command."""
+    env = os.environ | {"BFQ_CONFIG": str(work / "bcl2fastq.ini"), "PYTHONPATH": str(tree)}
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", str(tree / SCRIPT), "--help"],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # only the imports of the script itself, not what they import in turn
+        if name.startswith(" ") and not name.startswith("  "):
+            times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)[:top]
+
+
+def measure(tree: Path, work: Path, repeat: int) -> dict[str, float]:
+    """Median wall seconds of every command the tree has."""
+    times = {}
+    for name, argv in COMMANDS.items():
+        try:
+            times[name] = statistics.median(run(tree, work, argv) for _ in range(repeat))
+        except subprocess.CalledProcessError:
+            print(f"{name} failed in {tree}, skipped", file=sys.stderr)
+    return times
+
+
+def checkout(ref: str, dest: Path) -> Path:
+    """The package tree of a git revision, extracted to dest."""
+    top = subprocess.run(
+        ["git", "rev-parse", "--show-toplevel"],
+        cwd=PACKAGE,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+    prefix = PACKAGE.relative_to(top)
+    archive = subprocess.run(
+        ["git", "archive", ref, str(prefix)],
+        cwd=top,
+        capture_output=True,
+        check=True,
+    ).stdout
+    subprocess.run(["tar", "-x", "-C", str(dest)], input=archive, check=True)
+    dest = dest / prefix
+    # older trees read /config/bcl2fastq.ini, before BFQ_CONFIG
+    script = dest / SCRIPT
+    text = script.read_text()
+    if "BFQ_CONFIG" not in text:
+        script.write_text(
+            text.replace('"/config/bcl2fastq.ini"', 'os.environ["BFQ_CONFIG"]').replace(
+                "import argparse\n", "import argparse\nimport os\n", 1
+            )
+        )
+    return dest
+
+
+def main(argv: list[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--rows", type=int, default=20000, help="rows in flowcells.processed")
+    ap.add_argument("--repeat", type=int, default=5, help="runs of every command")
+    ap.add_argument("--top", type=int, default=8, help="slowest imports to show")
+    ap.add_argument("--ref", help="git revision to compare with, e.g. HEAD~1")
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="bfq-startup-") as tmp:
+        work = Path(tmp)
+        (work / "manager").mkdir()
+        (work / "bcl2fastq.ini").write_text(f"[Paths]\nmanager_dir = {work / 'manager'}\n")
+        write_inventory(work / "flowcells.template", args.rows)
+
+        new = measure(PACKAGE, work, args.repeat)
+        old = {}
+        if args.ref:
+            (work / "ref").mkdir()
+            old = measure(checkout(args.ref, work / "ref"), work, args.repeat)
+
+        print(f"{'command':16}{'ms':>10}" + (f"{args.ref:>12}{'ratio':>8}" if old else ""))
+        for name, seconds in new.items():
+            line = f"{name:16}{seconds * 1000:10.0f}"
+            if name in old:
+                line += f"{old[name] * 1000:12.0f}{seconds / old[name]:8.2f}"
+            print(line)
+
+        print(f"\nslowest imports of {SCRIPT} --help (cumulative ms)")
+        for us, name in import_times(PACKAGE, work, args.top):
+            print(f"  {us / 1000:8.1f}  {name}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
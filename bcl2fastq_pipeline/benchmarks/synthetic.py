@@ -0,0 +1,411 @@
+"""
+Synthetic sequencer runs for the benchmarks.
+
+make_flowcell() writes a run directory the pipeline accepts as a finished
+run, without any base calls:
+
+    • RunInfo.xml and RunParameters.xml
+    • InterOp/TileMetricsOut.bin (v2), QMetricsOut.bin (v4), IndexMetricsOut.bin (v1)
+    • SampleSheet.csv with [CustomOptions] and one [Data] row per sample
+    • Sample-Submission-Form.xlsx (if openpyxl is installed)
+    • the completion file bfq.py looks for, e.g. CopyComplete.txt
+
+write_demux_output() writes what the demultiplexer would make of such a run
+(FASTQ files, Reports/Demultiplex_Stats.csv, Stats.json); the bcl-convert
+stand-in in benchmarks/bin calls it. Sizes are set with FlowcellSpec, so runs
+of any number of projects, samples, lanes and reads can be made.
+
+Example
+-------
+>>> spec = FlowcellSpec(projects=4, samples_per_project=96, lanes=4)
+>>> run_dir = make_flowcell(Path("/tmp/bench/seq/nova"), spec)
+"""
+
+from __future__ import annotations
+
+import csv
+import gzip
+import importlib
+import json
+import random
+import struct
+import xml.etree.ElementTree as ET
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from bcl2fastq_pipeline.scheduler import COMPLETION_FILES
+
+BASES = "ACGT"
+
+
+@dataclass
+class FlowcellSpec:
+    """
+    Shape of a synthetic run.
+
+    Attributes
+    ----------
+    instrument : str
+        Instrument id, one of COMPLETION_FILES.
+    lanes, tiles_per_lane, cycles : int, int, tuple[int, ...]
+        Layout of the flowcell; cycles are the reads in order, index reads
+        are the ones shorter than 20 cycles.
+    projects, samples_per_project : int
+        Sample sheet size; projects are named GCF-<year>-<n>.
+    reads_per_sample : int
+        FASTQ records per sample and read, written by write_demux_output().
+    """
+
+    instrument: str = "A01990"
+    date: str = "240415"
+    run_number: int = 1
+    flowcell: str = "HBENCHDSXC"
+    lanes: int = 2
+    tiles_per_lane: int = 8
+    cycles: tuple[int, ...] = (51, 10, 10, 51)
+    projects: int = 2
+    samples_per_project: int = 8
+    reads_per_sample: int = 1000
+    libprep: str = "Lexogen SENSE mRNA-Seq Library Prep Kit V2 PE"
+    user: str = "bench@example.org"
+    seed: int = 1
+    extra_custom: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def run_id(self) -> str:
+        return f"{self.date}_{self.instrument}_{self.run_number:04d}_A{self.flowcell}"
+
+    @property
+    def project_names(self) -> list[str]:
+        return [f"GCF-20{self.date[:2]}-{i + 1:03d}" for i in range(self.projects)]
+
+    def samples(self, project: str) -> list[str]:
+        n = self.project_names.index(project)
+        return [f"S{n + 1:02d}-{i + 1:04d}" for i in range(self.samples_per_project)]
+
+    @property
+    def reads(self) -> list[tuple[int, int, bool]]:
+        """(number, cycles, is_index) of every read."""
+        return [(i + 1, c, c < 20) for i, c in enumerate(self.cycles)]
+
+
+def _index(rng: random.Random, n: int) -> str:
+    return "".join(rng.choice(BASES) for _ in range(n))
+
+
+def sample_rows(spec: FlowcellSpec) -> list[dict[str, str]]:
+    """The [Data] rows of the sample sheet, with unique index pairs."""
+    rng = random.Random(spec.seed)
+    index_lengths = [c for _, c, is_index in spec.reads if is_index]
+    rows, seen = [], set()
+    for project in spec.project_names:
+        for sample in spec.samples(project):
+            while True:
+                pair = tuple(_index(rng, n) for n in index_lengths)
+                if pair not in seen:
+                    seen.add(pair)
+                    break
+            row = {"Sample_ID": sample, "Sample_Name": sample, "Sample_Project": project}
+            for i, idx in enumerate(pair):
+                row["index" if i == 0 else f"index{i + 1}"] = idx
+            rows.append(row)
+    return rows
+
+
+# --------------------------------------------------------------------------- #
+# Run directory
+# --------------------------------------------------------------------------- #
+def write_run_info(run_dir: Path, spec: FlowcellSpec) -> None:
+    root = ET.Element("RunInfo", Version="6")
+    run = ET.SubElement(root, "Run", Id=spec.run_id, Number=str(spec.run_number))
+    ET.SubElement(run, "Flowcell").text = spec.flowcell
+    ET.SubElement(run, "Instrument").text = spec.instrument
+    ET.SubElement(run, "Date").text = spec.date
+    reads = ET.SubElement(run, "Reads")
+    for number, cycles, is_index in spec.reads:
+        ET.SubElement(
+            reads,
+            "Read",
+            Number=str(number),
+            NumCycles=str(cycles),
+            IsIndexedRead="Y" if is_index else "N",
+        )
+    ET.SubElement(
+        run, "FlowcellLayout", LaneCount=str(spec.lanes), TileCount=str(spec.tiles_per_lane)
+    )
+    ET.ElementTree(root).write(run_dir / "RunInfo.xml", encoding="utf-8", xml_declaration=True)
+
+
+def write_run_parameters(run_dir: Path, spec: FlowcellSpec) -> None:
+    root = ET.Element("RunParameters")
+    ET.SubElement(root, "Side").text = "A"
+    ET.SubElement(root, "InstrumentName").text = spec.instrument
+    ET.SubElement(root, "FlowCellMode").text = "S4" if spec.lanes == 4 else "SP"
+    for number, cycles, _ in spec.reads:
+        ET.SubElement(root, f"Read{number}NumberOfCycles").text = str(cycles)
+    ET.ElementTree(root).write(
+        run_dir / "RunParameters.xml", encoding="utf-8", xml_declaration=True
+    )
+
+
+def _tiles(spec: FlowcellSpec) -> list[tuple[int, int]]:
+    return [
+        (lane, 1101 + t) for lane in range(1, spec.lanes + 1) for t in range(spec.tiles_per_lane)
+    ]
+
+
+def write_interop(run_dir: Path, spec: FlowcellSpec, samples: list[dict[str, str]]) -> None:
+    """TileMetrics v2, QMetrics v4 and IndexMetrics v1, with plausible values."""
+    interop = run_dir / "InterOp"
+    interop.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(spec.seed)
+    tiles = _tiles(spec)
+    data_reads = [r for r in spec.reads if not r[2]]
+
+    tile_dt = np.dtype([("lane", "<u2"), ("tile", "<u2"), ("code", "<u2"), ("value", "<f4")])
+    recs = []
+    for lane, tile in tiles:
+        clusters = rng.uniform(3.5e6, 4.5e6)
+        recs.append((lane, tile, 100, rng.uniform(2.3e6, 2.6e6)))
+        recs.append((lane, tile, 102, clusters))
+        recs.append((lane, tile, 103, clusters * rng.uniform(0.75, 0.85)))
+        for number, _, _ in data_reads:
+            recs.append((lane, tile, 299 + number, rng.uniform(0.5, 1.5)))
+    with (interop / "TileMetricsOut.bin").open("wb") as fh:
+        fh.write(bytes([2, tile_dt.itemsize]))
+        fh.write(np.array(recs, dtype=tile_dt).tobytes())
+
+    q_dt = np.dtype([("lane", "<u2"), ("tile", "<u2"), ("cycle", "<u2"), ("hist", "<u4", 50)])
+    n_cycles = sum(spec.cycles)
+    q = np.zeros(len(tiles) * n_cycles, dtype=q_dt)
+    q["lane"] = np.repeat([t[0] for t in tiles], n_cycles)
+    q["tile"] = np.repeat([t[1] for t in tiles], n_cycles)
+    q["cycle"] = np.tile(np.arange(1, n_cycles + 1), len(tiles))
+    hist = np.zeros((len(q), 50), dtype="<u4")
+    hist[:, 36] = rng.integers(2_800_000, 3_200_000, len(q))  # Q37
+    hist[:, 25] = rng.integers(100_000, 300_000, len(q))  # Q26
+    hist[:, 10] = rng.integers(10_000, 50_000, len(q))  # Q11
+    q["hist"] = hist
+    with (interop / "QMetricsOut.bin").open("wb") as fh:
+        fh.write(bytes([4, q_dt.itemsize]))
+        fh.write(q.tobytes())
+
+    first_index = next((n for n, _, is_index in spec.reads if is_index), 2)
+
+    def field(value: str) -> bytes:
+        b = value.encode()
+        return struct.pack("<H", len(b)) + b
+
+    # the record of a sample after lane, tile and read: index, count, sample, project
+    records = []
+    for row in samples:
+        index = "-".join(v for k, v in row.items() if k.startswith("index"))
+        count = struct.pack("<I", int(rng.integers(5_000, 20_000)))
+        records.append(
+            field(index) + count + field(row["Sample_ID"]) + field(row["Sample_Project"])
+        )
+    with (interop / "IndexMetricsOut.bin").open("wb") as fh:
+        fh.write(bytes([1]))
+        for lane, tile in tiles:
+            head = struct.pack("<HHH", lane, tile, first_index)
+            fh.write(b"".join(head + r for r in records))
+
+
+def write_sample_sheet(path: Path, spec: FlowcellSpec, samples: list[dict[str, str]]) -> None:
+    columns = list(samples[0])
+    with path.open("w", newline="") as fh:
+        w = csv.writer(fh)
+        w.writerows([["[Header]"], ["FileFormatVersion", "2"], ["RunName", spec.run_id], []])
+        w.writerow(["[Reads]"])
+        w.writerows([[c] for _, c, is_index in spec.reads if not is_index])
+        w.writerows([[], ["[Settings]"], ["AdapterRead1", "AGATCGGAAGAGC"], []])
+        w.writerow(["[CustomOptions]"])
+        custom = {"Libprep": spec.libprep, "User": spec.user, "SensitiveData": "False"}
+        w.writerows([[k, v] for k, v in (custom | spec.extra_custom).items()])
+        w.writerows([[], ["[Data]"], columns])
+        w.writerows([[row[c] for c in columns] for row in samples])
+
+
+def write_submission_form(path: Path, spec: FlowcellSpec, samples: list[dict[str, str]]) -> bool:
+    """A minimal submission form, one row per sample. Returns False without openpyxl."""
+    try:
+        openpyxl = importlib.import_module("openpyxl")
+    except ImportError:
+        return False
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Samples"
+    ws.append(["Sample_ID", "Sample_Group", "Organism", "Sample_Project"])
+    for i, row in enumerate(samples):
+        ws.append([row["Sample_ID"], f"group{i % 4}", "human", row["Sample_Project"]])
+    wb.save(path)
+    return True
+
+
+def make_flowcell(base_dir: Path, spec: FlowcellSpec) -> Path:
+    """Write a complete synthetic run under base_dir and return its directory."""
+    run_dir = Path(base_dir) / spec.run_id
+    run_dir.mkdir(parents=True, exist_ok=True)
+    samples = sample_rows(spec)
+    write_run_info(run_dir, spec)
+    write_run_parameters(run_dir, spec)
+    write_interop(run_dir, spec, samples)
+    write_sample_sheet(run_dir / "SampleSheet.csv", spec, samples)
+    if not write_submission_form(run_dir / "Sample-Submission-Form.xlsx", spec, samples):
+        (run_dir / "Sample-Submission-Form.xlsx").write_bytes(b"")
+    (run_dir / COMPLETION_FILES[spec.instrument]).write_text("")
+    return run_dir
+
+
+# --------------------------------------------------------------------------- #
+# Demultiplexer output
+# --------------------------------------------------------------------------- #
+def read_sample_sheet(path: Path) -> list[dict[str, str]]:
+    """The [Data] rows of a sample sheet."""
+    rows, header, in_data = [], None, False
+    with Path(path).open(newline="") as fh:
+        for row in csv.reader(fh):
+            if row and row[0].startswith("["):
+                in_data = row[0].strip() in ("[Data]", "[BCLConvert_Data]")
+                continue
+            if in_data and row:
+                if header is None:
+                    header = row
+                else:
+                    rows.append(dict(zip(header, row)))
+    return rows
+
+
+def read_cycles(run_dir: Path) -> list[tuple[int, int, bool]]:
+    root = ET.parse(Path(run_dir) / "RunInfo.xml").getroot()
+    return [
+        (int(r.get("Number")), int(r.get("NumCycles")), r.get("IsIndexedRead") == "Y")
+        for r in root.iter("Read")
+    ]
+
+
+def _fastq_block(name: str, length: int, n: int, rng: random.Random) -> bytes:
+    seqs = ["".join(rng.choice(BASES) for _ in range(length)) for _ in range(min(n, 64))]
+    qual = "F" * length
+    lines = []
+    for i in range(n):
+        lines.append(f"@{name}:{i + 1} 1:N:0\n{seqs[i % len(seqs)]}\n+\n{qual}\n")
+    return "".join(lines).encode()
+
+
+def write_fastq(path: Path, name: str, length: int, n: int, rng: random.Random) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, "wb", compresslevel=1) as fh:
+        fh.write(_fastq_block(name, length, n, rng))
+
+
+def write_demux_output(
+    run_dir: Path,
+    output_dir: Path,
+    sample_sheet: Path,
+    reads_per_sample: int,
+    unknown_barcodes: int = 1000,
+) -> None:
+    """
+    Write bcl-convert style output for the samples of sample_sheet.
+
+    One FASTQ per sample and data read in <project>/ (no lane splitting), the
+    undetermined reads, Reports/Demultiplex_Stats.csv and the legacy
+    Reports/legacy/Stats/Stats.json with unknown_barcodes barcodes per lane,
+    as many as bcl2fastq lists.
+    """
+    rng = random.Random(Path(run_dir).name)
+    output_dir = Path(output_dir)
+    reads = read_cycles(run_dir)
+    data_reads = [(n, c) for n, c, is_index in reads if not is_index]
+    lanes = int(ET.parse(Path(run_dir) / "RunInfo.xml").find(".//FlowcellLayout").get("LaneCount"))
+    samples = read_sample_sheet(sample_sheet)
+    undetermined = max(1, reads_per_sample // 10)
+
+    stats_rows = []
+    for i, row in enumerate(samples, 1):
+        project, sample = row.get("Sample_Project", ""), row["Sample_ID"]
+        for r, (_, cycles) in enumerate(data_reads, 1):
+            write_fastq(
+                output_dir / project / f"{sample}_S{i}_R{r}_001.fastq.gz",
+                sample,
+                cycles,
+                reads_per_sample,
+                rng,
+            )
+        per_lane = [reads_per_sample // lanes] * lanes
+        per_lane[0] += reads_per_sample - sum(per_lane)
+        index = "-".join(v for k, v in row.items() if k.startswith("index"))
+        for lane, n in enumerate(per_lane, 1):
+            stats_rows.append((lane, sample, project, index, n))
+    for r, (_, cycles) in enumerate(data_reads, 1):
+        write_fastq(
+            output_dir / f"Undetermined_S0_R{r}_001.fastq.gz",
+            "Undetermined",
+            cycles,
+            undetermined,
+            rng,
+        )
+    per_lane = [undetermined // lanes] * lanes
+    per_lane[0] += undetermined - sum(per_lane)
+    for lane, n in enumerate(per_lane, 1):
+        stats_rows.append((lane, "Undetermined", "", "", n))
+
+    reports = output_dir / "Reports"
+    reports.mkdir(parents=True, exist_ok=True)
+    with (reports / "Demultiplex_Stats.csv").open("w", newline="") as fh:
+        w = csv.writer(fh)
+        w.writerow(
+            ["Lane", "SampleID", "Sample_Project", "Index", "# Reads", "# Perfect Index Reads"]
+        )
+        w.writerows([(*r, r[-1]) for r in stats_rows])
+
+    legacy = reports / "legacy" / "Stats"
+    legacy.mkdir(parents=True, exist_ok=True)
+    lane_totals = {}
+    for lane, sample, _, _, n in stats_rows:
+        lane_totals.setdefault(lane, [0, 0])
+        lane_totals[lane][0 if sample != "Undetermined" else 1] += n
+    stats = {
+        "Flowcell": run_dir.name.split("_")[-1][1:],
+        "RunNumber": 1,
+        "RunId": run_dir.name,
+        "ReadInfosForLanes": [
+            {
+                "LaneNumber": lane,
+                "ReadInfos": [
+                    {"Number": n, "NumCycles": c, "IsIndexedRead": is_index}
+                    for n, c, is_index in reads
+                ],
+            }
+            for lane in range(1, lanes + 1)
+        ],
+        "ConversionResults": [
+            {
+                "LaneNumber": lane,
+                "TotalClustersRaw": (det + und) * 2,
+                "TotalClustersPF": det + und,
+                "Yield": (det + und) * sum(c for _, c in data_reads),
+                "DemuxResults": [
+                    {"SampleId": s, "SampleName": s, "NumberReads": n}
+                    for la, s, _, _, n in stats_rows
+                    if la == lane and s != "Undetermined"
+                ],
+                "Undetermined": {"NumberReads": und},
+            }
+            for lane, (det, und) in sorted(lane_totals.items())
+        ],
+        "UnknownBarcodes": [
+            {
+                "Lane": lane,
+                "Barcodes": {
+                    _index(rng, 10): rng.randint(1, 5000) for _ in range(unknown_barcodes)
+                },
+            }
+            for lane in range(1, lanes + 1)
+        ],
+    }
+    (legacy / "Stats.json").write_text(json.dumps(stats, indent=2))
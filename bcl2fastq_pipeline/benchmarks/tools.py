@@ -0,0 +1,186 @@
+"""
+Stand-ins for the external tools of the pipeline.
+
+The executables in benchmarks/bin are links to one launcher, which calls
+main() with the name it was started as. Each tool takes the command line the
+pipeline gives the real one and writes an output tree of the same shape:
+
+    • bcl-convert           – FASTQ files and reports, see synthetic.write_demux_output()
+    • interop_summary       – the summary CSV (from the native InterOp reader)
+    • interop_index-summary – the index summary CSV (idem)
+    • multiqc               – an HTML report of BENCH_REPORT_KB
+    • snakemake             – the bfq/ output of an analysis: report, multiqc
+                              config and sample_info.tsv
+    • 7za                   – an uncompressed zip of its inputs
+    • parallel              – GNU parallel's simplest form, which md5sum_worker()
+                              uses: the command once per line of stdin
+
+Sizes and timing are set with environment variables:
+
+    BENCH_READS_PER_SAMPLE  – FASTQ records per sample and read (default 1000)
+    BENCH_REPORT_KB         – size of every HTML report (default 500)
+    BENCH_STUB_DELAY        – seconds every tool sleeps before it starts (default 0)
+    BENCH_PIPELINE          – workflow name of the analysis output (default rnaseq)
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import importlib
+import os
+import random
+import subprocess
+import sys
+import time
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import yaml
+
+
+def _env(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def _html(path: Path, title: str) -> None:
+    """An HTML report of BENCH_REPORT_KB, incompressible like the embedded plots."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    size = int(_env("BENCH_REPORT_KB", 500) * 1024)
+    rng = random.Random(title)
+    with path.open("w") as fh:
+        fh.write(f"<html><head><title>{title}</title></head><body><h1>{title}</h1>\n<pre>")
+        fh.write(base64.b64encode(rng.randbytes(size * 3 // 4)).decode())
+        fh.write("</pre></body></html>\n")
+
+
+def bcl_convert(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(prog="bcl-convert")
+    ap.add_argument("--bcl-input-directory", type=Path, required=True)
+    ap.add_argument("--output-directory", type=Path, required=True)
+    ap.add_argument("--sample-sheet", type=Path, required=True)
+    args, _ = ap.parse_known_args(argv)
+    # numpy and pandas are only imported by the tools that need them, the others start faster
+    synthetic = importlib.import_module("benchmarks.synthetic")
+    synthetic.write_demux_output(
+        args.bcl_input_directory,
+        args.output_directory,
+        args.sample_sheet,
+        int(_env("BENCH_READS_PER_SAMPLE", 1000)),
+    )
+    return 0
+
+
+def interop(argv: list[str], index: bool) -> int:
+    """<tool> <run directory> --csv=1, the CSV is written to stdout."""
+    interop_reader = importlib.import_module("bcl2fastq_pipeline.interop")
+    writer = interop_reader.write_index_summary_csv if index else interop_reader.write_summary_csv
+    writer(Path(argv[0]), Path("/dev/stdout"))
+    return 0
+
+
+def multiqc(argv: list[str]) -> int:
+    ap = argparse.ArgumentParser(prog="multiqc")
+    ap.add_argument("--filename", type=Path, required=True)
+    args, _ = ap.parse_known_args(argv)
+    _html(args.filename, args.filename.stem)
+    return 0
+
+
+def snakemake(argv: list[str]) -> int:
+    """Writes the bfq/ output of the analysis in the current directory, <project>_<date>."""
+    cwd = Path.cwd()
+    project = cwd.name.rsplit("_", 1)[0]
+    pipeline = os.environ.get("BENCH_PIPELINE", "rnaseq")
+    bfq = cwd / "data" / "tmp" / pipeline / "bfq"
+    bfq.mkdir(parents=True, exist_ok=True)
+
+    samples = []
+    config = cwd / "config.yaml"
+    if config.exists():
+        samples = list((yaml.safe_load(config.read_text()) or {}).get("samples", {}))
+    if not samples:
+        fastq = cwd / "data" / "raw" / "fastq"
+        samples = sorted({p.name.split("_R1")[0] for p in fastq.glob("*_R1*.fastq.gz")})
+
+    _html(bfq / f"multiqc_{project}.html", f"multiqc_{project}")
+    rng = random.Random(project)
+    mqc = {
+        "title": project,
+        "custom_data": {
+            "general_statistics": {
+                "plot_type": "generalstats",
+                "data": {
+                    s: {"Sample_Group": f"group{i % 4}", "RIN": round(rng.uniform(6, 10), 1)}
+                    for i, s in enumerate(samples)
+                },
+            }
+        },
+    }
+    (bfq / ".multiqc_config.yaml").write_text(yaml.safe_dump(mqc))
+    rows = ["Sample_ID\tSample_Group\tProject"] + [
+        f"{s}\tgroup{i % 4}\t{project}" for i, s in enumerate(samples)
+    ]
+    (cwd / "data" / "tmp" / "sample_info.tsv").write_text("\n".join(rows) + "\n")
+    return 0
+
+
+def sevenza(argv: list[str]) -> int:
+    """7za a [-l] [-p<password>] <archive> <files and directories>..."""
+    args = [a for a in argv if not a.startswith("-")]
+    if not args or args[0] != "a":
+        print(f"7za stub: unsupported command {argv}", file=sys.stderr)
+        return 2
+    archive, inputs = Path(args[1]), [Path(a) for a in args[2:]]
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zf:
+        for src in inputs:
+            if src.is_dir():
+                for f in sorted(src.rglob("*")):
+                    if f.is_file():
+                        zf.write(f, Path(src.name) / f.relative_to(src))
+            elif src.is_file():
+                zf.write(src, src.name)
+    return 0
+
+
+def parallel(argv: list[str]) -> int:
+    """parallel [-j N] <command>...: the command with each line of stdin appended, N at a time."""
+    ap = argparse.ArgumentParser(prog="parallel")
+    ap.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("command", nargs=argparse.REMAINDER)
+    args = ap.parse_args(argv)
+    lines = [line.rstrip("\n") for line in sys.stdin if line.strip()]
+    with ThreadPoolExecutor(args.jobs) as pool:
+        done = list(
+            pool.map(
+                lambda a: subprocess.run([*args.command, a], check=False, capture_output=True),
+                lines,
+            )
+        )
+    # the output of every job in one piece, like GNU parallel
+    for proc in done:
+        sys.stdout.buffer.write(proc.stdout)
+        sys.stderr.buffer.write(proc.stderr)
+    # GNU parallel exits with the number of failed jobs
+    return min(sum(1 for proc in done if proc.returncode), 101)
+
+
+TOOLS = {
+    "bcl-convert": bcl_convert,
+    "interop_summary": lambda argv: interop(argv, index=False),
+    "interop_index-summary": lambda argv: interop(argv, index=True),
+    "multiqc": multiqc,
+    "snakemake": snakemake,
+    "7za": sevenza,
+    "parallel": parallel,
+}
+
+
+def main(name: str, argv: list[str]) -> int:
+    if name not in TOOLS:
+        print(f"Unknown stub {name}, one of {', '.join(TOOLS)}", file=sys.stderr)
+        return 2
+    time.sleep(_env("BENCH_STUB_DELAY", 0))
+    return TOOLS[name](argv)
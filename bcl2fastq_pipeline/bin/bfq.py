@@ -7,15 +7,23 @@ import signal
 import sys
 
 from threading import Event
+from types import ModuleType
 
 import bcl2fastq_pipeline.afterFastq
 import bcl2fastq_pipeline.findFlowCells
 import bcl2fastq_pipeline.makeFastq
+import bcl2fastq_pipeline.manifest
+import bcl2fastq_pipeline.metrics_store
 import bcl2fastq_pipeline.misc
+import bcl2fastq_pipeline.outbox
+import bcl2fastq_pipeline.scheduler
+import bcl2fastq_pipeline.validate
 import urllib3
 
 from bcl2fastq_pipeline.config import PipelineConfig
 
+from bcl2fastq_pipeline import lease, procmon, profiling, staging, status, tracing
+
 # Disable excess warning messages if we disable SSL checks
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 gotHUP = Event()
@@ -37,7 +45,64 @@ def setup_logging(verbosity: int = 1) -> None:
     logging.basicConfig(level=level, format=fmt, datefmt="%Y-%m-%d %H:%M:%S")
 
 
+# Modules reloaded at the start of every loop when their source changed, in
+# dependency order. The outbox, lease, staging, tracing, profiling, procmon and
+# status hold state of the running process and are never reloaded.
+RELOADABLE = [
+    bcl2fastq_pipeline.manifest,
+    bcl2fastq_pipeline.findFlowCells,
+    bcl2fastq_pipeline.scheduler,
+    bcl2fastq_pipeline.makeFastq,
+    bcl2fastq_pipeline.afterFastq,
+    bcl2fastq_pipeline.misc,
+    bcl2fastq_pipeline.validate,
+    bcl2fastq_pipeline.metrics_store,
+]
+# module name -> (mtime, size) of its source when it was last loaded
+source_stamps: dict[str, tuple[int, int]] = {}
+
+
+def _uses(module: ModuleType, names: set[str]) -> bool:
+    """Whether module holds one of the modules in names, or something defined in them."""
+    for value in vars(module).values():
+        if isinstance(value, ModuleType):
+            if value.__name__ in names:
+                return True
+        elif getattr(value, "__module__", None) in names:
+            return True
+    return False
+
+
+def reload_changed(modules: list[ModuleType]) -> None:
+    """
+    Reload the modules whose source file changed since they were loaded.
+
+    A module that imported names from a reloaded one is reloaded after it as
+    well, otherwise it would keep calling the old code.
+    """
+    reloaded: set[str] = set()
+    for module in modules:
+        st = os.stat(module.__file__)
+        stamp = (st.st_mtime_ns, st.st_size)
+        changed = source_stamps.setdefault(module.__name__, stamp) != stamp
+        if changed or (reloaded and _uses(module, reloaded)):
+            importlib.reload(module)
+            source_stamps[module.__name__] = stamp
+            reloaded.add(module.__name__)
+            log.info(f"Reloaded {module.__name__}")
+
+
+def lost_run(cfg) -> bool:
+    """Whether another instance took the current run over; it is then left to that instance."""
+    if not lease.run_lost():
+        return False
+    log.error(f"Another instance took over {cfg.run.run_id}, leaving it to finish the run")
+    cfg.run.reset()
+    return True
+
+
 signal.signal(signal.SIGHUP, breakSleep)
+signal.signal(signal.SIGUSR1, profiling.toggle)
 
 verbosity = 2 if os.environ.get("BFQ_DEBUG", None) else 1
 setup_logging(verbosity)
@@ -48,10 +113,7 @@ PipelineConfig.load("/config/bcl2fastq.ini")
 
 while True:
     # Reimport to allow reloading a new version
-    importlib.reload(bcl2fastq_pipeline.findFlowCells)
-    importlib.reload(bcl2fastq_pipeline.makeFastq)
-    importlib.reload(bcl2fastq_pipeline.afterFastq)
-    importlib.reload(bcl2fastq_pipeline.misc)
+    reload_changed(RELOADABLE)
 
     # Read the config file
     cfg = PipelineConfig.get()
@@ -60,32 +122,53 @@ while True:
         log.error("Unable to read configfile")
         sys.exit(1)
 
-    in_pths = [cfg.static.paths.nova_base_dir, cfg.static.paths.ekista_base_dir]
-    completion_files = {
-        "SN7001334": "ImageAnalysis_Netcopy_complete.txt",
-        "NB501038": "RunCompletionStatus.xml",
-        "M026575": "ImageAnalysis_Netcopy_complete.txt",
-        "M03942": "ImageAnalysis_Netcopy_complete.txt",
-        "M05617": "ImageAnalysis_Netcopy_complete.txt",
-        "M71102": "ImageAnalysis_Netcopy_complete.txt",
-        "K00251": "SequencingComplete.txt",
-        "A01990": "CopyComplete.txt",
-        "MN00686": "CopyComplete.txt",
-    }
-    dirs = list()
+    # Deliver mail left in the outbox. The outbox is not reloaded, its sender thread keeps running
+    bcl2fastq_pipeline.outbox.get_outbox(cfg)
+    # Neither are tracing, which holds the span of the current run, profiling, procmon and status
+    tracing.configure(cfg)
+    profiling.configure(cfg)
+    procmon.configure(cfg)
+    status.serve(cfg)
+
     # Get the next flow cell to process, or sleep
-    for pth in in_pths:
-        for machine, fin_file in completion_files.items():
-            dirs += list(pth.glob(f"*_{machine}_*/{fin_file}"))
+    with tracing.span("discovery") as s:
+        completed = bcl2fastq_pipeline.scheduler.completed_runs(cfg)
+        ranked = bcl2fastq_pipeline.scheduler.rank(cfg, completed)
+        s.set(flowcells=len(ranked))
+    status.set_queue([r.run_id for r in ranked if not r.held])
+    # Copy the next runs to local scratch, if configured, while this loop is busy or asleep
+    staging.watch(
+        cfg,
+        lambda cfg: [
+            r.completion_file.parent
+            for r in bcl2fastq_pipeline.scheduler.rank(
+                cfg, bcl2fastq_pipeline.scheduler.completed_runs(cfg)
+            )
+            if not r.held
+        ],
+    )
 
-    for d in sorted(dirs):
+    # Highest score first, ranked again after each run, see scheduler
+    queue = bcl2fastq_pipeline.scheduler.queue(cfg, bcl2fastq_pipeline.scheduler.completed_runs)
+    for d in queue:
         cfg.run.begin(d.parent, cfg.static.paths)
         log.debug(f"Initiate {d.parent}")
-        if bcl2fastq_pipeline.findFlowCells.flowCellProcessed():
+        with tracing.span("flowCellProcessed", flowcell=d.parent.name):
+            processed = bcl2fastq_pipeline.findFlowCells.flowCellProcessed()
+        if processed:
             log.debug(f"Already processed {d.parent}")
             cfg.run.reset()
             continue
 
+        # Another instance may have the run; once leased, check again in case it just finished
+        if not lease.claim_run(cfg):
+            cfg.run.reset()
+            continue
+        if bcl2fastq_pipeline.findFlowCells.flowCellProcessed():
+            lease.release_run()
+            cfg.run.reset()
+            continue
+
         bcl2fastq_pipeline.findFlowCells.newFlowCell()
         if not cfg.run.run_id:
             continue
@@ -97,70 +180,106 @@ while True:
             break
 
         startTime = datetime.datetime.now()
+        # the run span is closed however the run ends, with the status of its last stage
+        tracing.begin_run(cfg)
+        try:
+            # Every stage below starts only while this instance still holds the lease on the run
+            # Make the fastq files, if not already done
+            if lost_run(cfg):
+                continue
+            if not (cfg.output_path / "bcl.done").exists():
+                try:
+                    with tracing.span("bcl2fq"):
+                        log.info(f"Starting demultiplexing: {cfg.run.run_id}")
+                        bcl_done = bcl2fastq_pipeline.makeFastq.bcl2fq()
+                        (cfg.output_path / "bcl.done").write_text("\t".join(bcl_done))
+                    staging.release(cfg.run.run_id)
+                except Exception as e:
+                    cfg.run.reset()
+                    log.exception("Got an error in bcl2fq")
+                    bcl2fastq_pipeline.misc.errorEmail(
+                        sys.exc_info(), f"Got an error in bcl2fq: {e}"
+                    )
+                    continue
+            else:
+                log.info(f"Demultiplexing already done for {cfg.output_path}")
+
+            if lost_run(cfg):
+                continue
+            if not (cfg.output_path / "files.renamed").exists():
+                try:
+                    with tracing.span("rename_fastqs"):
+                        log.info("Renaming files")
+                        bcl2fastq_pipeline.makeFastq.rename_fastqs()
+                        bcl2fastq_pipeline.manifest.build_manifest(cfg)
+                        (cfg.output_path / "files.renamed").write_text("")
+                except Exception as e:
+                    cfg.run.reset()
+                    log.exception("Got an error in rename_fastqs")
+                    bcl2fastq_pipeline.misc.errorEmail(
+                        sys.exc_info(), f"Got an error in rename_fastqs: {e}"
+                    )
+                    continue
 
-        # Make the fastq files, if not already done
-        if not (cfg.output_path / "bcl.done").exists():
+            # Verify gzip integrity and read counts before anything is archived
+            if lost_run(cfg):
+                continue
             try:
-                log.info(f"Starting demultiplexing: {cfg.run.run_id}")
-                bcl_done = bcl2fastq_pipeline.makeFastq.bcl2fq()
-                (cfg.output_path / "bcl.done").write_text("\t".join(bcl_done))
+                with tracing.span("validate_fastqs"):
+                    log.info("Validating fastq files")
+                    bcl2fastq_pipeline.validate.validate_fastqs(cfg)
             except Exception as e:
                 cfg.run.reset()
-                log.exception("Got an error in bcl2fq")
-                bcl2fastq_pipeline.misc.errorEmail(sys.exc_info(), f"Got an error in bcl2fq: {e}")
+                log.exception("Got an error in validate_fastqs")
+                bcl2fastq_pipeline.misc.errorEmail(
+                    sys.exc_info(), f"Got an error in validate_fastqs: {e}"
+                )
                 continue
-        else:
-            log.info(f"Demultiplexing already done for {cfg.output_path}")
 
-        if not (cfg.output_path / "files.renamed").exists():
+            # Run post-processing steps
+            if lost_run(cfg):
+                continue
             try:
-                log.info("Renaming files")
-                bcl2fastq_pipeline.makeFastq.rename_fastqs()
-                (cfg.output_path / "files.renamed").write_text("")
+                with tracing.span("postMakeSteps"):
+                    log.info("Starting post-processing")
+                    message = bcl2fastq_pipeline.afterFastq.postMakeSteps()
             except Exception as e:
                 cfg.run.reset()
-                log.exception("Got an error in rename_fastqs")
+                log.exception("Got an error during postMakeSteps")
                 bcl2fastq_pipeline.misc.errorEmail(
-                    sys.exc_info(), f"Got an error in rename_fastqs: {e}"
+                    sys.exc_info(), f"Got an error during postMakeSteps: {e}"
                 )
                 continue
 
-        # Run post-processing steps
-        try:
-            log.info("Starting post-processing")
-            message = bcl2fastq_pipeline.afterFastq.postMakeSteps()
-        except Exception as e:
-            cfg.run.reset()
-            log.exception("Got an error during postMakeSteps")
-            bcl2fastq_pipeline.misc.errorEmail(
-                sys.exc_info(), f"Got an error during postMakeSteps: {e}"
-            )
-            continue
+            # Get more statistics and create PDFs
+            try:
+                with tracing.span("getFCmetrics"):
+                    message += bcl2fastq_pipeline.misc.getFCmetricsImproved()
+            except Exception as e:
+                cfg.run.reset()
+                log.exception("Got an error during getFCmetrics")
+                bcl2fastq_pipeline.misc.errorEmail(
+                    sys.exc_info(), f"Got an error during getFCmetrics: {e}"
+                )
+                continue
 
-        # Get more statistics and create PDFs
-        try:
-            message += bcl2fastq_pipeline.misc.getFCmetricsImproved()
-        except Exception as e:
-            cfg.run.reset()
-            log.exception("Got an error during getFCmetrics")
-            bcl2fastq_pipeline.misc.errorEmail(
-                sys.exc_info(), f"Got an error during getFCmetrics: {e}"
-            )
-            continue
-        endTime = datetime.datetime.now()
-        runTime = endTime - startTime
+            # Keep the metrics for trend queries, a failure here should not stop the run
+            try:
+                with tracing.span("record_metrics"):
+                    bcl2fastq_pipeline.metrics_store.record_run(cfg)
+            except Exception:
+                log.exception("Got an error while recording the run metrics")
 
-        # Email finished message
-        retry_email = None
-        try:
-            bcl2fastq_pipeline.misc.finishedEmail(message, runTime)
-        except Exception as e:
-            if cfg.run.libprep.startswith(
-                ("10X Genomics Chromium Single Cell", "Parse Biosciences")
-            ):
-                retry_email = True
-                log.info("Got an error during finishedEmail().")
-            else:
+            endTime = datetime.datetime.now()
+            runTime = endTime - startTime
+
+            # Email finished message
+            if lost_run(cfg):
+                continue
+            try:
+                with tracing.span("finishedEmail"):
+                    bcl2fastq_pipeline.misc.finishedEmail(message, runTime)
+            except Exception as e:
                 cfg.run.reset()
                 log.exception("Got an error in finishedEmail")
                 bcl2fastq_pipeline.misc.errorEmail(
@@ -168,44 +287,44 @@ while True:
                 )
                 continue
 
-        if retry_email:
+            # Finalize
+            if lost_run(cfg):
+                continue
             try:
-                log.info("Retry without extra html")
-                extra_html = False
-                bcl2fastq_pipeline.misc.finishedEmail(message, runTime, extra_html)
+                with tracing.span("finalize"):
+                    bcl2fastq_pipeline.afterFastq.finalize()
             except Exception as e:
                 cfg.run.reset()
-                log.exception("Retry failed. Got an error in finishedEmail")
+                log.exception("Got an error during finalize!")
+                bcl2fastq_pipeline.misc.errorEmail(
+                    sys.exc_info(), f"Got an error during finalize(): {e}"
+                )
+                continue
+            finalizeTime = datetime.datetime.now() - endTime
+            runTime += finalizeTime
+            if lost_run(cfg):
+                continue
+            try:
+                with tracing.span("finalizedEmail"):
+                    bcl2fastq_pipeline.misc.finalizedEmail("", finalizeTime, runTime)
+            except Exception as e:
+                cfg.run.reset()
+                log.exception("Got an error during finishedEmail")
                 bcl2fastq_pipeline.misc.errorEmail(
                     sys.exc_info(), f"Got an error during finishedEmail(): {e}"
                 )
                 continue
-
-        # Finalize
-        try:
-            bcl2fastq_pipeline.afterFastq.finalize()
-        except Exception as e:
-            cfg.run.reset()
-            log.exception("Got an error during finalize!")
-            bcl2fastq_pipeline.misc.errorEmail(
-                sys.exc_info(), f"Got an error during finalize(): {e}"
-            )
-            continue
-        finalizeTime = datetime.datetime.now() - endTime
-        runTime += finalizeTime
-        try:
-            bcl2fastq_pipeline.misc.finalizedEmail("", finalizeTime, runTime)
-        except Exception as e:
+            if lost_run(cfg):
+                continue
+            # Mark the flow cell as having been processed
+            bcl2fastq_pipeline.findFlowCells.markFinished()
+            log.info(f"bfq finished processing for {cfg.output_path}")
+            lease.release_run()
             cfg.run.reset()
-            log.exception("Got an error during finishedEmail")
-            bcl2fastq_pipeline.misc.errorEmail(
-                sys.exc_info(), f"Got an error during finishedEmail(): {e}"
-            )
-            continue
-        # Mark the flow cell as having been processed
-        bcl2fastq_pipeline.findFlowCells.markFinished()
-        log.info(f"bfq finished processing for {cfg.output_path}")
-        cfg.run.reset()
+        finally:
+            tracing.end_run()
 
     # done processing, no more flowcells in queue
+    tracing.end_run()
+    lease.release_run()
     sleep(cfg)
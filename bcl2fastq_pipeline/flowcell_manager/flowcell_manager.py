@@ -1,18 +1,38 @@
 #!/usr/bin/env python
 
 import argparse
+import csv
 import datetime
+import importlib
+import io
+import os
 import shutil
 import subprocess
+import sys
 
 from pathlib import Path
 
-import pandas as pd
-
 from bcl2fastq_pipeline.config import PipelineConfig
 
-pd.set_option("display.max_rows", 5000)
-pd.set_option("display.max_columns", 6)
+from bcl2fastq_pipeline import lease
+
+CONFIG = Path(os.environ.get("BFQ_CONFIG", "/config/bcl2fastq.ini"))
+COLUMNS = ["project", "flowcell_path", "timestamp", "archived"]
+# the inventory is locked for single writes, a holder that stops for this long has died
+LOCK_TTL = 30.0
+
+
+def _pd():
+    """
+    pandas, imported on first use.
+
+    add, list, list-processed and query read the inventory with the csv module,
+    so the CLI only pays for the pandas import in the commands that need it.
+    """
+    pd = importlib.import_module("pandas")
+    pd.set_option("display.max_rows", 5000)
+    pd.set_option("display.max_columns", 6)
+    return pd
 
 
 def get_cfg():
@@ -21,33 +41,58 @@ def get_cfg():
         return PipelineConfig.get()
     except RuntimeError:
         # Not initialized yet → load static config only
-        return PipelineConfig.load("/config/bcl2fastq.ini")
+        return PipelineConfig.load(CONFIG)
+
+
+def inventory_path() -> Path:
+    return get_cfg().static.paths.manager_dir / "flowcells.processed"
+
+
+def inventory_lock():
+    """The lease on flowcells.processed, held while it is written by any bfq instance or CLI."""
+    leases = lease.lease_dir(get_cfg().static.paths.manager_dir / "leases", LOCK_TTL)
+    return leases.locked("flowcells.processed")
+
+
+def write_inventory(update) -> None:
+    """Rewrite the inventory with update(DataFrame) -> DataFrame, under the inventory lock."""
+    pd = _pd()
+    path = inventory_path()
+    tmp = path.with_name(f"{path.name}.tmp")
+    with inventory_lock():
+        update(pd.read_csv(path)).to_csv(tmp, index=False, columns=COLUMNS)
+        os.replace(tmp, path)
+
+
+def read_rows() -> list[dict[str, str]]:
+    """The inventory as dicts of strings, without pandas."""
+    with inventory_path().open(newline="") as fh:
+        return list(csv.DictReader(fh))
 
 
 def add_flowcell(**args):
-    cfg = get_cfg()
-    row_list = [
-        {
-            "project": args["project"],
-            "flowcell_path": args["path"],
-            "timestamp": args["timestamp"],
-            "archived": 0,
-        }
-    ]
-    df = pd.DataFrame(row_list)
-    flowcells_processed = pd.read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
-    flowcells_processed = pd.concat([flowcells_processed, df], sort=True)
-    flowcells_processed.to_csv(
-        cfg.static.paths.manager_dir / "flowcells.processed",
-        index=False,
-        columns=["project", "flowcell_path", "timestamp", "archived"],
+    """Append a row to the inventory; the rows already there are not rewritten."""
+    line = io.StringIO()
+    csv.writer(line, lineterminator="\n").writerow(
+        [args["project"], args["path"], args["timestamp"], 0]
     )
+    with inventory_lock(), inventory_path().open("ab+") as fh:
+        size = fh.seek(0, os.SEEK_END)
+        prefix = b""
+        if size == 0:
+            prefix = (",".join(COLUMNS) + "\n").encode()
+        else:
+            fh.seek(size - 1)
+            if fh.read(1) != b"\n":
+                prefix = b"\n"
+        fh.write(prefix + line.getvalue().encode())
 
 
 def archive_flowcell(**args):
     force = args.get("force", False)
     flowcell = Path(args["flowcell"])
     cfg = get_cfg()
+    pd = _pd()
     flowcells_processed = pd.read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
     fc_for_deletion = flowcells_processed.loc[flowcells_processed["flowcell_path"] == str(flowcell)]
     if fc_for_deletion.empty:
@@ -74,14 +119,13 @@ def archive_flowcell(**args):
             else:
                 d.unlink()
 
-        flowcells_processed.loc[
-            flowcells_processed["flowcell_path"] == str(flowcell), "archived"
-        ] = datetime.datetime.now()
-        flowcells_processed.to_csv(
-            cfg.static.paths.manager_dir / "flowcells.processed",
-            index=False,
-            columns=["project", "flowcell_path", "timestamp", "archived"],
-        )
+        archived = datetime.datetime.now()
+
+        def mark_archived(df):
+            df.loc[df["flowcell_path"] == str(flowcell), "archived"] = archived
+            return df
+
+        write_inventory(mark_archived)
     else:
         print("Skipping...")
 
@@ -90,6 +134,7 @@ def rerun_flowcell(**args):
     force = args.get("force", False)
     flowcell = args["flowcell"]
     cfg = get_cfg()
+    pd = _pd()
     flowcells_processed = pd.read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
     fc_for_deletion = flowcells_processed.loc[flowcells_processed["flowcell_path"] == flowcell]
     if fc_for_deletion.empty:
@@ -104,20 +149,14 @@ def rerun_flowcell(**args):
         cmd = f"rm -rf {flowcell}"
         print(f"DELETING FLOWCELL: {cmd}")
         subprocess.check_call(cmd, shell=True)
-        flowcells_processed = flowcells_processed.loc[
-            flowcells_processed["flowcell_path"] != flowcell
-        ]
-        flowcells_processed.to_csv(
-            cfg.static.paths.manager_dir / "flowcells.processed",
-            index=False,
-            columns=["project", "flowcell_path", "timestamp", "archived"],
-        )
+        write_inventory(lambda df: df.loc[df["flowcell_path"] != flowcell])
     else:
         print("Skipping...")
 
 
 def list_processed(**args):
     cfg = get_cfg()
+    pd = _pd()
     flowcells_processed = pd.read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
     return flowcells_processed.loc[
         (flowcells_processed["timestamp"] != "0") | (flowcells_processed["archived"] != "0")
@@ -126,11 +165,12 @@ def list_processed(**args):
 
 def list_all(**args):
     cfg = get_cfg()
-    return pd.read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
+    return _pd().read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
 
 
 def list_project(project):
     cfg = get_cfg()
+    pd = _pd()
     flowcells_processed = pd.read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
     return flowcells_processed.loc[
         (flowcells_processed["project"] == project) & (flowcells_processed["timestamp"] != "0")
@@ -139,6 +179,7 @@ def list_project(project):
 
 def list_flowcell(flowcell):
     cfg = get_cfg()
+    pd = _pd()
     flowcells_processed = pd.read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
     return flowcells_processed.loc[
         (flowcells_processed["flowcell_path"] == flowcell)
@@ -148,11 +189,91 @@ def list_flowcell(flowcell):
 
 def list_flowcell_all(flowcell):
     cfg = get_cfg()
+    pd = _pd()
     flowcells_processed = pd.read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
     # USED TO AVOID RUNNING OLD FLOWCELLS
     return flowcells_processed.loc[flowcells_processed["flowcell_path"] == flowcell]
 
 
+def _metrics_store():
+    # pandas and pyarrow, only for the metrics commands
+    return importlib.import_module("bcl2fastq_pipeline.metrics_store")
+
+
+def metrics(**args):
+    cfg = get_cfg()
+    metrics_store = _metrics_store()
+    if args["table"] not in metrics_store.TABLES:
+        sys.exit(f"Unknown metrics table {args['table']}, one of {', '.join(metrics_store.TABLES)}")
+    df = metrics_store.query(
+        metrics_store.store_root(cfg),
+        args["table"],
+        metrics_store.Selection(
+            instruments=args["instrument"] or [],
+            libpreps=args["libprep"] or [],
+            start=args["since"],
+            end=args["until"],
+        ),
+    )
+    if args["metric"]:
+        df = metrics_store.trend(df, args["metric"], by=args["by"], freq=args["freq"])
+    print(df.to_string())
+
+
+def metrics_backfill(**args):
+    cfg = get_cfg()
+    pd = _pd()
+    flowcells_processed = pd.read_csv(cfg.static.paths.manager_dir / "flowcells.processed")
+    paths = [Path(p) for p in flowcells_processed["flowcell_path"].unique()]
+    metrics_store = _metrics_store()
+    n = metrics_store.backfill(metrics_store.store_root(cfg), paths)
+    print(f"Recorded metrics of {n} of {len(paths)} flowcells")
+
+
+def _scheduler():
+    return importlib.import_module("bcl2fastq_pipeline.scheduler")
+
+
+def show_queue(**args):
+    """The completed runs in the order bfq.py will process them."""
+    cfg = get_cfg()
+    scheduler = _scheduler()
+    runs = scheduler.rank(cfg, scheduler.completed_runs(cfg))
+    if not args["all"]:
+        runs = [r for r in runs if not r.done]
+    print("Run \t Score \t Priority \t User \t Waited (h) \t Estimate (h) \t Reasons")
+    for r in runs:
+        score = "done" if r.done else "hold" if r.held else f"{r.score:.1f}"
+        reasons = ", ".join(r.reasons + ["SensitiveData"] * r.sensitive)
+        print(
+            f"{r.run_id}\t{score}\t{r.priority:g}\t{r.user}\t"
+            f"{r.age_hours:.1f}\t{r.est_hours:.1f}\t{reasons}"
+        )
+
+
+def reprioritize(**args):
+    """Set or clear the priority override of a run, read by bfq.py at its next ranking."""
+    cfg = get_cfg()
+    scheduler = _scheduler()
+    run_id = Path(args["run"]).name
+    if not args["clear"]:
+        if args["priority"] is None:
+            sys.exit("Give a priority or --clear")
+        try:
+            scheduler.parse_priority(args["priority"])
+        except ValueError as e:
+            sys.exit(str(e))
+    leases = lease.lease_dir(cfg.static.paths.manager_dir / "leases", LOCK_TTL)
+    with leases.locked(scheduler.OVERRIDES):
+        overrides = scheduler.read_overrides(cfg)
+        if args["clear"]:
+            overrides.pop(run_id, None)
+        else:
+            overrides[run_id] = args["priority"].strip().lower()
+        scheduler.write_overrides(cfg, overrides)
+    print(f"{run_id}: {overrides.get(run_id, 'priority of the sample sheet')}")
+
+
 def pretty_print(df):
     print("Project \t Flowcell path \t Timestamp \t Archived")
     for i, row in df.iterrows():
@@ -163,6 +284,36 @@ def pretty_print(df):
         )
 
 
+# --------------------------------------------------------------------------- #
+# Fast path of the CLI: the inventory is read with the csv module, no pandas
+# --------------------------------------------------------------------------- #
+def print_rows(rows):
+    print("Project \t Flowcell path \t Timestamp \t Archived")
+    for row in rows:
+        print("\t".join(row[c] for c in COLUMNS))
+
+
+def cli_list(**args):
+    print_rows(read_rows())
+
+
+def cli_list_processed(**args):
+    print_rows(r for r in read_rows() if r["timestamp"] != "0" or r["archived"] != "0")
+
+
+def cli_query(**args):
+    """Rows matching all of the given project, flowcell and archived state."""
+    rows = [r for r in read_rows() if r["timestamp"] != "0"]
+    if args["project"]:
+        rows = [r for r in rows if r["project"] in args["project"]]
+    if args["flowcell"]:
+        flowcells = {str(f).rstrip("/") for f in args["flowcell"]}
+        rows = [r for r in rows if r["flowcell_path"].rstrip("/") in flowcells]
+    if args["archived"] is not None:
+        rows = [r for r in rows if (r["archived"] not in ("", "0")) == args["archived"]]
+    print_rows(rows)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     subparsers = parser.add_subparsers()
@@ -189,16 +340,66 @@ if __name__ == "__main__":
     parser_rerun.add_argument("--force", action="store_true", help="Force archive (no prompt)")
 
     parser_list = subparsers.add_parser("list", help="List all flowcells.")
-    parser_list.set_defaults(func=list_all, print_res=True)
+    parser_list.set_defaults(func=cli_list)
 
     parser_list_processed = subparsers.add_parser(
         "list-processed",
         help="List only flowcells in the inventory file processed by bfq pipeline.",
     )
-    parser_list_processed.set_defaults(func=list_processed, print_res=True)
+    parser_list_processed.set_defaults(func=cli_list_processed)
+
+    parser_query = subparsers.add_parser(
+        "query", help="List the inventory rows of projects and/or flowcells."
+    )
+    parser_query.set_defaults(func=cli_query)
+    parser_query.add_argument("--project", nargs="+", help="GCF project numbers.")
+    parser_query.add_argument("--flowcell", nargs="+", help="Flowcell paths.")
+    state = parser_query.add_mutually_exclusive_group()
+    state.add_argument(
+        "--archived", action="store_true", default=None, help="Only archived flowcells."
+    )
+    state.add_argument(
+        "--not-archived", dest="archived", action="store_false", help="Only flowcells on disk."
+    )
+
+    parser_metrics = subparsers.add_parser(
+        "metrics", help="Query the flowcell metrics history, optionally as a trend."
+    )
+    parser_metrics.set_defaults(func=metrics)
+    parser_metrics.add_argument("table", help="Metrics table: lanes, reads or samples.")
+    parser_metrics.add_argument("--instrument", nargs="+", help="Instrument ids, e.g. A01990.")
+    parser_metrics.add_argument("--libprep", nargs="+", help="Library preps.")
+    parser_metrics.add_argument("--since", type=str, help="First run date, e.g. 2024-01-01.")
+    parser_metrics.add_argument("--until", type=str, help="Last run date.")
+    parser_metrics.add_argument(
+        "--metric", type=str, help="Show the mean of this column per period instead of rows."
+    )
+    parser_metrics.add_argument("--by", default="instrument", help="Trend grouping column.")
+    parser_metrics.add_argument("--freq", default="MS", help="Trend period (pandas offset alias).")
+
+    parser_backfill = subparsers.add_parser(
+        "metrics-backfill",
+        help="Record the metrics of all flowcells in the inventory file in the metrics history.",
+    )
+    parser_backfill.set_defaults(func=metrics_backfill)
+
+    parser_queue = subparsers.add_parser(
+        "queue", help="List the completed runs in the order bfq will process them."
+    )
+    parser_queue.set_defaults(func=show_queue)
+    parser_queue.add_argument("--all", action="store_true", help="Include processed runs.")
+
+    parser_reprioritize = subparsers.add_parser(
+        "reprioritize", help="Change the priority of a queued run, or hold it back."
+    )
+    parser_reprioritize.set_defaults(func=reprioritize)
+    parser_reprioritize.add_argument("run", type=str, help="Run folder name or path.")
+    parser_reprioritize.add_argument(
+        "priority", nargs="?", help="urgent, high, normal, low, hold or a number of points."
+    )
+    parser_reprioritize.add_argument(
+        "--clear", action="store_true", help="Use the priority of the sample sheet again."
+    )
 
     args = parser.parse_args()
-    if vars(args).get("print_res", False):
-        pretty_print(args.func(**vars(args)))
-    else:
-        args.func(**vars(args))
+    args.func(**vars(args))
@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks import synthetic
+
+from bcl2fastq_pipeline import manifest
+
+
+@pytest.fixture
+def demuxed(tmp_path):
+    """
+    A cfg stand-in for a synthetic run of two projects demultiplexed into tmp_path/output.
+
+    Written by synthetic.write_demux_output(), like the bcl-convert stand-in,
+    with 10 reads per sample.
+    """
+    spec = synthetic.FlowcellSpec(lanes=2, projects=2, samples_per_project=2)
+    run_dir = synthetic.make_flowcell(tmp_path / "seq", spec)
+    output_path = tmp_path / "output" / run_dir.name
+    synthetic.write_demux_output(run_dir, output_path, run_dir / "SampleSheet.csv", 10)
+    yield SimpleNamespace(
+        output_path=output_path,
+        run_dir=run_dir,
+        static=SimpleNamespace(system={"validation_threads": 2}),
+    )
+    with manifest._manifests_lock:
+        manifest._manifests.pop(output_path, None)
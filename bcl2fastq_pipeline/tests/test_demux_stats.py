@@ -0,0 +1,86 @@
+import pytest
+
+from bcl2fastq_pipeline import demux_stats
+
+XML = """<?xml version="1.0" encoding="utf-8"?>
+<Stats>
+  <Flowcell flowcell-id="HBENCHDSXC">
+    <Project name="GCF-2024-001">
+      <Sample name="S1">
+        <Barcode name="ACGT"><Lane number="1"><BarcodeCount>60</BarcodeCount></Lane></Barcode>
+        <Barcode name="all">
+          <Lane number="1"><BarcodeCount>70</BarcodeCount></Lane>
+          <Lane number="2"><BarcodeCount>80</BarcodeCount></Lane>
+        </Barcode>
+      </Sample>
+      <Sample name="all">
+        <Barcode name="all"><Lane number="1"><BarcodeCount>70</BarcodeCount></Lane></Barcode>
+      </Sample>
+    </Project>
+    <Project name="default">
+      <Sample name="Undetermined">
+        <Barcode name="all"><Lane number="1"><BarcodeCount>10</BarcodeCount></Lane></Barcode>
+      </Sample>
+      <Sample name="all">
+        <Barcode name="all">
+          <Lane number="1"><BarcodeCount>10</BarcodeCount></Lane>
+          <Lane number="2"><BarcodeCount>20</BarcodeCount></Lane>
+        </Barcode>
+      </Sample>
+    </Project>
+    <Project name="all">
+      <Sample name="all">
+        <Barcode name="all">
+          <Lane number="1"><BarcodeCount>80</BarcodeCount></Lane>
+          <Lane number="2"><BarcodeCount>100</BarcodeCount></Lane>
+        </Barcode>
+      </Sample>
+    </Project>
+  </Flowcell>
+</Stats>
+"""
+
+CSV = """Lane,SampleID,Sample_Project,Index,# Reads,# Perfect Index Reads
+1,S1,GCF-2024-001,ACGT,70,70
+2,S1,GCF-2024-001,ACGT,80,79
+1,S2,,TTGA,5,5
+1,Undetermined,,,10,0
+2,Undetermined,,,20,0
+"""
+
+
+def test_xml_counts_per_sample_and_lane(tmp_path):
+    (tmp_path / "Stats").mkdir()
+    (tmp_path / demux_stats.XML_PATH).write_text(XML)
+
+    stats = demux_stats.load(tmp_path)
+
+    assert stats.samples == {("GCF-2024-001", "S1", 1): 70, ("GCF-2024-001", "S1", 2): 80}
+    assert stats.undetermined == {1: 10, 2: 20}
+    assert stats.totals == {1: 80, 2: 100}
+    assert stats.sample_counts() == {("GCF-2024-001", "S1"): 150}
+
+
+def test_csv_is_preferred_and_aggregated(tmp_path):
+    (tmp_path / "Stats").mkdir()
+    (tmp_path / demux_stats.XML_PATH).write_text("not read")
+    (tmp_path / "Reports").mkdir()
+    (tmp_path / "Reports" / "Demultiplex_Stats.csv").write_text(CSV)
+
+    stats = demux_stats.load(tmp_path)
+
+    assert stats.samples == {
+        ("GCF-2024-001", "S1", 1): 70,
+        ("GCF-2024-001", "S1", 2): 80,
+        ("", "S2", 1): 5,
+    }
+    assert stats.undetermined == {1: 10, 2: 20}
+    assert stats.totals == {1: 85, 2: 100}
+    table = stats.undetermined_table()
+    assert table["Lane"].tolist() == [1, 2]
+    assert table["% Undetermined"].tolist() == [11.76, 20.0]
+
+
+def test_missing_statistics_raise(tmp_path):
+    with pytest.raises(FileNotFoundError, match="No demultiplexing statistics"):
+        demux_stats.load(tmp_path)
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# runs the CLI like "python flowcell_manager.py ...", then lists the heavy modules it loaded
+CLI = """
+import runpy, sys
+sys.argv = ["flowcell_manager", *sys.argv[1:]]
+runpy.run_module("flowcell_manager.flowcell_manager", run_name="__main__")
+print(*sorted(m for m in ("pandas", "yaml", "pyarrow") if m in sys.modules), file=sys.stderr)
+"""
+
+
+@pytest.fixture
+def cli(tmp_path):
+    ini = tmp_path / "bcl2fastq.ini"
+    ini.write_text(f"[Paths]\nmanager_dir = {tmp_path}\n")
+    env = os.environ | {"BFQ_CONFIG": str(ini), "PYTHONPATH": str(ROOT)}
+
+    def run(*args: str) -> tuple[list[str], str]:
+        p = subprocess.run(
+            [sys.executable, "-c", CLI, *args],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return p.stdout.splitlines()[1:], p.stderr.strip()
+
+    return run
+
+
+def test_add_list_and_query_do_not_import_pandas(cli, tmp_path):
+    cli("add", "GCF-2024-001", "/out/240101_A", "2024-01-02T03:04:05")
+    cli("add", "GCF-2024-002", "/out/240102_B", "2024-01-03T00:00:00")
+    # a line written without the trailing newline by another tool
+    with (tmp_path / "flowcells.processed").open("a") as fh:
+        fh.write("GCF-2024-003,/out/240103_C,2024-01-04 00:00:00,2024-02-01")
+
+    rows, loaded = cli("list")
+    assert loaded == ""
+    assert rows == [
+        "GCF-2024-001\t/out/240101_A\t2024-01-02 03:04:05\t0",
+        "GCF-2024-002\t/out/240102_B\t2024-01-03 00:00:00\t0",
+        "GCF-2024-003\t/out/240103_C\t2024-01-04 00:00:00\t2024-02-01",
+    ]
+
+    cli("add", "GCF-2024-004", "/out/240104_D", "2024-01-05T00:00:00")
+    rows, loaded = cli("query", "--flowcell", "/out/240102_B/", "/out/240104_D")
+    assert loaded == ""
+    assert [r.split("\t")[0] for r in rows] == ["GCF-2024-002", "GCF-2024-004"]
+    rows, _ = cli("query", "--archived")
+    assert [r.split("\t")[0] for r in rows] == ["GCF-2024-003"]
+    rows, _ = cli("query", "--not-archived", "--project", "GCF-2024-001", "GCF-2024-003")
+    assert [r.split("\t")[0] for r in rows] == ["GCF-2024-001"]
+
+
+def test_config_loads_without_yaml_and_pandas():
+    code = (
+        "import sys; import bcl2fastq_pipeline.config; "
+        "print(*sorted(m for m in ('pandas', 'yaml') if m in sys.modules))"
+    )
+    p = subprocess.run(
+        [sys.executable, "-c", code],
+        env=os.environ | {"PYTHONPATH": str(ROOT)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert p.stdout.strip() == ""
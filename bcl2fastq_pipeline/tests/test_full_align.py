@@ -0,0 +1,94 @@
+import threading
+
+from types import SimpleNamespace
+
+import pytest
+
+from bcl2fastq_pipeline import afterFastq, manifest
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    """A run of three projects; A has half of the samples and bytes, B 30 % and C 20 %."""
+    m = manifest.RunManifest(output_path=tmp_path)
+    for project, samples in (("GCF-A", 5), ("GCF-B", 3), ("GCF-C", 2)):
+        for i in range(samples):
+            path = f"{project}/S{i}_R1.fastq.gz"
+            m.files[path] = manifest.FastqEntry(path, project, f"S{i}", 100, 0)
+    with manifest._manifests_lock:
+        manifest._manifests[tmp_path] = m
+    yield SimpleNamespace(output_path=tmp_path, static=SimpleNamespace(system={}))
+    with manifest._manifests_lock:
+        del manifest._manifests[tmp_path]
+
+
+def test_weights_count_samples_and_bytes(cfg):
+    m = manifest.get_manifest(cfg)
+    m.files["GCF-C/S0_R1.fastq.gz"].size = 1000
+
+    weights = afterFastq.project_weights(m, m.project_names())
+
+    assert weights["GCF-C"] == pytest.approx(0.5 * 2 / 10 + 0.5 * 1100 / 1900)
+    assert sum(weights.values()) == pytest.approx(1)
+
+
+def test_projects_run_concurrently_with_cores_by_weight(cfg, monkeypatch):
+    started = {}
+    together = threading.Barrier(3, timeout=5)
+
+    def align_project(cfg, p, cores):
+        started[p] = cores
+        together.wait()
+        return p
+
+    monkeypatch.setattr(afterFastq, "align_project", align_project)
+
+    assert afterFastq.full_align(cfg)
+
+    assert started == {"GCF-A": 16, "GCF-B": 10, "GCF-C": 6}
+    assert (cfg.output_path / "analysis.made").exists()
+
+
+def test_waiting_projects_get_the_freed_cores(cfg, monkeypatch):
+    cfg.static.system.update(analysis_cores=8, analysis_min_cores=4)
+    started = {p: threading.Event() for p in ("GCF-A", "GCF-B", "GCF-C")}
+    cores = {}
+
+    def align_project(cfg, p, n):
+        cores[p] = n
+        started[p].set()
+        # A finishes once B runs, B only once C has been started with the cores of A
+        if p == "GCF-A":
+            assert started["GCF-B"].wait(5)
+            assert not started["GCF-C"].is_set()
+        elif p == "GCF-B":
+            assert started["GCF-C"].wait(5)
+        return p
+
+    monkeypatch.setattr(afterFastq, "align_project", align_project)
+
+    afterFastq.full_align(cfg)
+
+    assert cores == {"GCF-A": 4, "GCF-B": 4, "GCF-C": 4}
+
+
+def test_a_failed_project_stops_the_waiting_ones(cfg, monkeypatch):
+    cfg.static.system.update(analysis_cores=8, analysis_min_cores=4)
+    started = []
+    failed = threading.Event()
+
+    def align_project(cfg, p, cores):
+        started.append(p)
+        if p == "GCF-A":
+            failed.set()
+            raise RuntimeError("snakemake failed")
+        failed.wait(5)
+        return p
+
+    monkeypatch.setattr(afterFastq, "align_project", align_project)
+
+    with pytest.raises(RuntimeError, match="snakemake failed"):
+        afterFastq.full_align(cfg)
+
+    assert sorted(started) == ["GCF-A", "GCF-B"]
+    assert not (cfg.output_path / "analysis.made").exists()
@@ -0,0 +1,134 @@
+import os
+import time
+
+from pathlib import Path
+
+from bcl2fastq_pipeline import harvest
+
+
+def test_move_renames_within_a_filesystem(tmp_path):
+    src = tmp_path / "a" / "report.html"
+    src.parent.mkdir()
+    src.write_text("report")
+    dst = tmp_path / "b" / "report.html"
+
+    assert harvest.harvest_file(src, dst, move=True) == "rename"
+    assert dst.read_text() == "report"
+    assert not src.exists()
+
+
+def test_move_of_a_symlink_keeps_its_target(tmp_path):
+    shared = tmp_path / "reference" / "genome.fa"
+    shared.parent.mkdir()
+    shared.write_text(">chr1\nACGT\n")
+    src = tmp_path / "analysis" / "genome.fa"
+    src.parent.mkdir()
+    src.symlink_to(shared)
+    dst = tmp_path / "output" / "genome.fa"
+
+    harvest.harvest_file(src, dst, move=True)
+
+    assert shared.read_text() == ">chr1\nACGT\n"
+    assert not src.is_symlink() and not src.exists()
+    assert not dst.is_symlink() and dst.read_text() == ">chr1\nACGT\n"
+
+
+def test_copy_dereferences_symlinks(tmp_path):
+    target = tmp_path / "target.tsv"
+    target.write_text("sample\n")
+    src = tmp_path / "link.tsv"
+    src.symlink_to(target)
+    dst = tmp_path / "out" / "samplesheet.tsv"
+
+    harvest.harvest_file(src, dst)
+
+    assert src.is_symlink() and target.exists()
+    assert not dst.is_symlink() and dst.read_text() == "sample\n"
+
+
+def test_without_link_src_and_dst_never_share_an_inode(tmp_path):
+    src = tmp_path / "qc.zip"
+    src.write_bytes(b"zip")
+    dst = tmp_path / "cache" / "qc.zip"
+
+    assert harvest.harvest_file(src, dst, link=False) in ("reflink", "copy")
+    assert os.stat(src).st_ino != os.stat(dst).st_ino
+
+
+def test_existing_dst_is_replaced(tmp_path):
+    src = tmp_path / "new.txt"
+    src.write_text("new")
+    dst = tmp_path / "out.txt"
+    dst.symlink_to(tmp_path / "missing")
+
+    harvest.harvest_file(src, dst)
+
+    assert dst.read_text() == "new"
+
+
+def test_harvest_tree_keeps_the_layout(tmp_path):
+    src_dir = tmp_path / "bfq"
+    (src_dir / "summaries").mkdir(parents=True)
+    (src_dir / "multiqc.html").write_text("m")
+    (src_dir / "summaries" / "all_samples.html").write_text("s")
+
+    report = harvest.harvest_tree(src_dir, tmp_path / "QC")
+
+    assert report.files == 2 and report.bytes == 2
+    assert (tmp_path / "QC" / "summaries" / "all_samples.html").read_text() == "s"
+
+
+def _wait_for(path, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not path.exists():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_streaming_mover_leaves_open_files_until_stop(tmp_path):
+    src_dir = tmp_path.resolve() / "bcl-convert"
+    (src_dir / "GCF-2024-001").mkdir(parents=True)
+    done = src_dir / "GCF-2024-001" / "S1_S1_R1_001.fastq.gz"
+    done.write_bytes(b"done")
+    dst_dir = tmp_path.resolve() / "output"
+
+    mover = harvest.StreamingMover(
+        src_dir, dst_dir, rename=lambda rel: rel.with_name(f"x_{rel.name}"), settle=0, interval=0.01
+    ).start()
+    with (src_dir / "GCF-2024-001" / "S2_S2_R1_001.fastq.gz").open("wb") as writing:
+        writing.write(b"writing")
+        writing.flush()
+        assert _wait_for(dst_dir / "GCF-2024-001" / "x_S1_S1_R1_001.fastq.gz")
+        time.sleep(0.05)
+        assert not (dst_dir / "GCF-2024-001" / "x_S2_S2_R1_001.fastq.gz").exists()
+    report = mover.stop()
+
+    assert (dst_dir / "GCF-2024-001" / "x_S2_S2_R1_001.fastq.gz").read_bytes() == b"writing"
+    assert not src_dir.exists()
+    # S2 may be moved by the watcher once it is closed, or by stop()
+    assert mover.moved_early in (1, 2)
+    assert (report.files, report.bytes) == (2, 11)
+    assert mover.failed == {}
+
+
+def test_streaming_mover_keeps_files_it_cannot_move(tmp_path):
+    src_dir = tmp_path / "bcl-convert"
+    src_dir.mkdir()
+    (src_dir / "S1_R1.fastq.gz").write_bytes(b"ok")
+    (src_dir / "S2_R1.fastq.gz").write_bytes(b"stuck")
+    dst_dir = tmp_path / "output"
+    dst_dir.mkdir()
+    # a file where the destination directory of S2 should go
+    (dst_dir / "blocked").write_text("")
+
+    def rename(rel):
+        return Path("blocked", rel.name) if rel.name.startswith("S2") else rel
+
+    mover = harvest.StreamingMover(src_dir, dst_dir, rename=rename, interval=60).start()
+    mover.stop()
+
+    assert (dst_dir / "S1_R1.fastq.gz").read_bytes() == b"ok"
+    assert list(mover.failed) == [src_dir / "S2_R1.fastq.gz"]
+    assert (src_dir / "S2_R1.fastq.gz").read_bytes() == b"stuck"
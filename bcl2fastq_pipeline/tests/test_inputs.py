@@ -0,0 +1,69 @@
+import os
+import sys
+import types
+
+import pandas as pd
+
+from bcl2fastq_pipeline import inputs
+
+SHEET = """\
+[Header]
+IEMFileVersion,5
+Date,2024-04-15
+
+[Reads]
+151
+151
+
+[CustomOptions]
+Libprep,Lexogen SENSE mRNA-Seq Library Prep Kit V2 SE
+SensitiveData,false
+
+[Data]
+Lane,Sample_ID,Sample_Name,index,Sample_Project
+1,S1,S1,ACGT,GCF-2024-001
+2,S1,S1,ACGT,GCF-2024-001
+1,S2,S2,TGCA,GCF-2024-001
+1,S3,S3,GGCC,
+"""
+
+
+def test_sample_sheet_sections(tmp_path):
+    path = tmp_path / "SampleSheet.csv"
+    path.write_text(SHEET)
+
+    sheet = inputs.sample_sheet(path)
+
+    assert sheet.key_values("Header")["Date"] == "2024-04-15"
+    assert sheet.reads == [151, 151]
+    assert sheet.custom["Libprep"] == "Lexogen SENSE mRNA-Seq Library Prep Kit V2 SE"
+    assert len(sheet.data) == 4
+    assert sheet.projects() == ["GCF-2024-001"]
+    assert inputs.sample_sheet(path) is sheet
+
+
+def test_project_samples_are_configmakers_selected_once_per_version(tmp_path, monkeypatch):
+    calls = []
+
+    def get_project_samples_from_samplesheet(args):
+        calls.append((args.samplesheet[0], args.project_id[0]))
+        df = inputs.SampleSheet.parse(args.samplesheet[0]).data
+        return df[df["Sample_Project"].isin(args.project_id)], None, None
+
+    cm = types.ModuleType("configmaker.configmaker")
+    cm.get_project_samples_from_samplesheet = get_project_samples_from_samplesheet
+    monkeypatch.setitem(sys.modules, "configmaker", types.ModuleType("configmaker"))
+    monkeypatch.setitem(sys.modules, "configmaker.configmaker", cm)
+    path = tmp_path / "SampleSheet.csv"
+    path.write_text(SHEET)
+
+    # configmaker decides, lanes included
+    assert len(inputs.project_samples(path, "GCF-2024-001")) == 3
+    inputs.project_samples(path, "GCF-2024-001")
+    assert len(calls) == 1
+
+    path.write_text(SHEET.replace("1,S3,S3,GGCC,\n", ""))
+    st = path.stat()
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert isinstance(inputs.project_samples(path, "GCF-2024-001"), pd.DataFrame)
+    assert len(calls) == 2
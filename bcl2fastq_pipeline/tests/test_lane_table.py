@@ -0,0 +1,19 @@
+import pandas as pd
+
+from benchmarks import synthetic
+
+from bcl2fastq_pipeline import interop, misc
+
+
+def test_lane_table_reads_the_written_summary_csv(tmp_path):
+    spec = synthetic.FlowcellSpec(lanes=2, projects=1, samples_per_project=4)
+    run_dir = synthetic.make_flowcell(tmp_path, spec)
+    csv = tmp_path / "interop_summary.csv"
+    interop.write_summary_csv(run_dir, csv)
+
+    df = misc.lane_table_from_csv(csv)
+
+    assert list(df["Lane"]) == [1, 2]
+    assert "R1 %>=Q30" in df and "R2 %>=Q30" in df
+    native = interop.RunSummary.from_run(run_dir).lane_table()
+    pd.testing.assert_frame_equal(df, native, check_dtype=False, atol=0.01)
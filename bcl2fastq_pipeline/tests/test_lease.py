@@ -0,0 +1,70 @@
+import os
+import time
+
+import pytest
+
+from bcl2fastq_pipeline.lease import LeaseDir
+
+
+def _age(leases: LeaseDir, name: str, seconds: float) -> None:
+    """Make a lease file look as if its last heartbeat was seconds ago."""
+    t = time.time() - seconds
+    os.utime(leases.path(name), (t, t))
+
+
+def test_only_one_instance_gets_a_lease(tmp_path):
+    a = LeaseDir(tmp_path, ttl=60, owner="a")
+    b = LeaseDir(tmp_path, ttl=60, owner="b")
+
+    lease = a.acquire("run-1")
+    assert lease is not None and lease.owner == "a"
+    assert a.acquire("run-1") is lease
+    assert b.acquire("run-1") is None
+    assert b.read("run-1")["owner"] == "a"
+
+    a.release(lease)
+    assert b.acquire("run-1") is not None
+
+
+def test_stale_lease_is_taken_over(tmp_path):
+    a = LeaseDir(tmp_path, ttl=60, owner="a")
+    b = LeaseDir(tmp_path, ttl=60, owner="b")
+    lease = a.acquire("run-1")
+    _age(a, "run-1", 30)
+    assert b.acquire("run-1") is None
+
+    _age(a, "run-1", 61)
+    taken = b.acquire("run-1")
+
+    assert taken is not None and b.read("run-1")["owner"] == "b"
+    assert not (tmp_path / "run-1.takeover").exists()
+    # the old owner finds out at its next heartbeat, and leaves the new lease alone
+    assert not a.heartbeat(lease)
+    assert lease.lost
+    a.release(lease)
+    assert b.read("run-1")["owner"] == "b"
+
+
+def test_heartbeat_keeps_a_lease_fresh(tmp_path):
+    a = LeaseDir(tmp_path, ttl=60, owner="a")
+    lease = a.acquire("run-1")
+    _age(a, "run-1", 50)
+
+    assert a.heartbeat(lease)
+    assert a.read("run-1")["age"] < 5
+    assert not lease.lost
+
+
+def test_locked_waits_for_the_holder(tmp_path):
+    a = LeaseDir(tmp_path, ttl=60, owner="a")
+    b = LeaseDir(tmp_path, ttl=60, owner="b")
+    lease = a.acquire("flowcells.processed")
+
+    with pytest.raises(TimeoutError, match="held by a"):
+        with b.locked("flowcells.processed", timeout=0.2, poll=0.05):
+            pass
+
+    a.release(lease)
+    with b.locked("flowcells.processed", timeout=0.2):
+        assert b.read("flowcells.processed")["owner"] == "b"
+    assert b.read("flowcells.processed") is None
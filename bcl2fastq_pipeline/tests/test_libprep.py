@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from bcl2fastq_pipeline import libprep
+
+CONFIG = """
+Lexogen SENSE Total RNA-Seq Library Prep Kit (w/ RiboCop rRNA Depletion Kit V1.2) PE:
+  workflow: rna-seq
+10X Genomics Chromium Single Cell 3p GEM Library & Gel Bead Kit v3:
+  workflow: singlecell
+  reads: pe
+Broken: not a mapping
+"""
+
+
+@pytest.fixture
+def config(tmp_path):
+    path = tmp_path / "libprep.config"
+    path.write_text(CONFIG)
+    return path
+
+
+def test_lookup_is_normalized_and_tries_the_read_suffixes(config):
+    lp = libprep.lookup(
+        " lexogen SENSE  Total RNA-Seq Library Prep Kit (w/ RiboCop rRNA Depletion Kit V1.2)",
+        config,
+    )
+
+    assert lp.key.endswith("V1.2) PE")
+    assert (lp.workflow, lp.reads, lp.demultiplexer) == ("rna-seq", "PE", "bcl-convert")
+    assert not lp.is_10x
+    assert not lp.extra_html
+
+
+def test_10x_kit(config):
+    lp = libprep.lookup(
+        "10X Genomics Chromium Single Cell 3p GEM Library & Gel Bead Kit v3", config
+    )
+
+    assert (lp.workflow, lp.reads) == ("singlecell", "PE")
+    assert lp.demultiplexer == "cellranger mkfastq"
+    assert lp.mkfastq_command == "cellranger_mkfastq"
+    assert lp.extra_html
+
+
+def test_unknown_and_malformed_entries_are_empty(config):
+    for name in ("Broken", "Unknown kit", None):
+        lp = libprep.lookup(name, config)
+        assert (lp.key, lp.entry, lp.workflow) == (None, {}, None)
+
+
+def test_changes_are_picked_up_and_a_broken_file_keeps_the_last_good_entries(config):
+    reg = libprep.LibprepRegistry(config)
+    assert reg.get("Broken").key is None
+
+    config.write_text(CONFIG + "New kit:\n  workflow: microbiome\n")
+    os.utime(config, ns=(0, 1))
+    assert reg.get("new kit").workflow == "microbiome"
+
+    config.write_text("New kit: [unclosed\n")
+    os.utime(config, ns=(0, 2))
+    assert reg.get("new kit").workflow == "microbiome"
+
+    config.unlink()
+    assert reg.get("new kit").key is None
@@ -0,0 +1,47 @@
+import argparse
+import os
+import subprocess
+
+import pytest
+
+from bcl2fastq_pipeline.config import PipelineConfig
+from benchmarks import run_pipeline, synthetic
+
+from bcl2fastq_pipeline import findFlowCells, makeFastq
+
+
+@pytest.fixture
+def streamed_run(tmp_path, monkeypatch):
+    """A synthetic run set up for bcl2fq(), with bcl-convert writing to scratch."""
+    work = tmp_path / "work"
+    args = argparse.Namespace(prefetch=False, stream=True, cores=1)
+    ini = run_pipeline.setup(
+        work, synthetic.FlowcellSpec(projects=1, samples_per_project=2), 0, args
+    )
+    monkeypatch.setenv("TMPDIR", str(work / "tmp"))
+    monkeypatch.setenv("BENCH_READS_PER_SAMPLE", "10")
+    monkeypatch.setenv("PATH", f"{run_pipeline.STUB_BIN}{os.pathsep}{os.environ['PATH']}")
+    cfg = PipelineConfig.load(ini)
+    cfg.run.begin(next((work / "seq" / "nova").iterdir()), cfg.static.paths)
+    findFlowCells.newFlowCell()
+    yield cfg
+    cfg.run.reset()
+
+
+def test_streamed_output_is_moved_and_renamed(streamed_run):
+    cfg = streamed_run
+    assert makeFastq.bcl2fq()[0] == "bcl-convert"
+    fastqs = sorted(cfg.output_path.glob("*/*.fastq.gz"))
+    assert fastqs
+    assert all(makeFastq.fastq_name(f.name) == f.name for f in fastqs)
+
+
+def test_failed_bcl_convert_is_raised(streamed_run, tmp_path, monkeypatch):
+    failing = tmp_path / "bin"
+    failing.mkdir()
+    (failing / "bcl-convert").write_text("#!/bin/sh\nexit 2\n")
+    (failing / "bcl-convert").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{failing}{os.pathsep}{os.environ['PATH']}")
+
+    with pytest.raises(subprocess.CalledProcessError):
+        makeFastq.bcl2fq()
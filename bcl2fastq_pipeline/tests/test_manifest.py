@@ -0,0 +1,69 @@
+import json
+import os
+
+import pytest
+
+from bcl2fastq_pipeline import manifest
+
+
+def test_projects_and_samples_are_detected(demuxed):
+    m = manifest.build_manifest(demuxed)
+
+    assert m.project_names() == ["GCF-2024-001", "GCF-2024-002"]
+    assert m.project_dirs() == {str(demuxed.output_path / p) for p in m.project_names()}
+    assert m.samples("GCF-2024-001") == ["S01-0001", "S01-0002"]
+    undetermined = [f for f in m.files.values() if f.sample == "Undetermined"]
+    assert undetermined
+    assert all(f.project == "" for f in undetermined)
+    assert m.project_size("GCF-2024-002") == sum(
+        f.stat().st_size for f in (demuxed.output_path / "GCF-2024-002").glob("*.fastq.gz")
+    )
+
+
+def test_project_is_found_below_a_nested_directory(tmp_path):
+    (tmp_path / "Lane1" / "GCF-2024-009").mkdir(parents=True)
+    (tmp_path / "Lane1" / "GCF-2024-009" / "A1_S1_L001_R1_001.fastq.gz").write_bytes(b"")
+
+    [entry] = manifest.RunManifest.build(tmp_path).files.values()
+
+    assert (entry.project, entry.sample) == ("GCF-2024-009", "A1")
+
+
+def test_save_is_atomic_and_round_trips(demuxed):
+    m = manifest.build_manifest(demuxed)
+    rel = next(iter(m.files))
+    m.update_reads({rel: 10, "not/in/the/run.fastq.gz": 1})
+    m.record("harvest", {"files": 3})
+
+    assert not (demuxed.output_path / f".{manifest.MANIFEST_NAME}.tmp").exists()
+    loaded = manifest.RunManifest.load(demuxed.output_path)
+    assert loaded.files == m.files
+    assert loaded.files[rel].reads == 10
+    assert loaded.extra == {"harvest": {"files": 3}}
+
+
+def test_failed_save_keeps_the_previous_manifest(demuxed, monkeypatch):
+    m = manifest.build_manifest(demuxed)
+    before = (demuxed.output_path / manifest.MANIFEST_NAME).read_text()
+
+    def crash(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", crash)
+    m.extra["x"] = {}
+    with pytest.raises(OSError, match="disk full"):
+        m.save()
+
+    assert (demuxed.output_path / manifest.MANIFEST_NAME).read_text() == before
+    assert "x" not in json.loads(before)["extra"]
+
+
+def test_get_manifest_loads_once_and_is_shared(demuxed):
+    manifest.build_manifest(demuxed)
+    with manifest._manifests_lock:
+        del manifest._manifests[demuxed.output_path]
+
+    first = manifest.get_manifest(demuxed)
+
+    assert manifest.get_manifest(demuxed) is first
+    assert first.project_names() == ["GCF-2024-001", "GCF-2024-002"]
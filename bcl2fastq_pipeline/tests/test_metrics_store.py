@@ -0,0 +1,83 @@
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from bcl2fastq_pipeline import metrics_store
+
+
+def _lanes(run_id: str, undetermined: bool) -> dict[str, pd.DataFrame]:
+    df = pd.DataFrame(
+        {
+            "run_id": run_id,
+            "run_date": pd.Timestamp(metrics_store.run_date(run_id)),
+            "instrument": run_id.split("_")[1],
+            "libprep": "Lexogen",
+            "pipeline": "rnaseq",
+            "lane": [1, 2],
+            "tiles": [100, 100],
+            "density": [2500.0, 2600.0],
+            "reads_m": [800.0, 810.0],
+            "reads_pf_m": [700.0, 705.0],
+            "cluster_pf": [87.5, 87.0],
+            "phix": [1.1, 1.2],
+        }
+    )
+    if undetermined:
+        df["undetermined_pct"] = [3.5, 4.0]
+    return {"lanes": df}
+
+
+def test_query_has_every_column_whatever_was_recorded_first(tmp_path):
+    metrics_store.record(tmp_path, _lanes("240101_A01990_0001_AHAAAAAAXX", undetermined=False))
+    metrics_store.record(tmp_path, _lanes("240201_A01990_0002_AHBBBBBBXX", undetermined=True))
+
+    df = metrics_store.query(tmp_path, "lanes")
+
+    assert list(df["run_id"].unique()) == [
+        "240101_A01990_0001_AHAAAAAAXX",
+        "240201_A01990_0002_AHBBBBBBXX",
+    ]
+    assert df["undetermined_pct"].isna().tolist() == [True, True, False, False]
+    assert df["undetermined_pct"].iloc[2:].tolist() == [3.5, 4.0]
+
+
+def test_files_are_written_with_the_table_schema(tmp_path):
+    metrics_store.record(tmp_path, _lanes("240101_A01990_0001_AHAAAAAAXX", undetermined=False))
+    [path] = (tmp_path / "lanes").rglob("*.parquet")
+    assert pq.read_schema(path).names == metrics_store.SCHEMAS["lanes"].names
+
+
+def test_recording_a_run_again_replaces_its_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics_store, "COMPACT_AT", 2)
+    metrics_store.record(tmp_path, _lanes("240101_A01990_0001_AHAAAAAAXX", undetermined=False))
+    metrics_store.record(tmp_path, _lanes("240201_A01990_0002_AHBBBBBBXX", undetermined=True))
+    part_dir = tmp_path / "lanes" / "year=2024"
+    assert [f.name for f in part_dir.glob("*.parquet")] == [metrics_store.COMPACTED_NAME]
+
+    metrics_store.record(tmp_path, _lanes("240101_A01990_0001_AHAAAAAAXX", undetermined=True))
+
+    df = metrics_store.query(tmp_path, "lanes")
+    assert len(df) == 4
+    assert df["undetermined_pct"].notna().all()
+    # the partition lease is released
+    assert not list((tmp_path / "leases").glob("*.lease"))
+
+
+def test_query_filters_and_columns(tmp_path):
+    metrics_store.record(tmp_path, _lanes("231201_A01990_0001_AHAAAAAAXX", undetermined=True))
+    metrics_store.record(tmp_path, _lanes("240201_LH00534_0002_AHBBBBBBXX", undetermined=True))
+
+    df = metrics_store.query(
+        tmp_path,
+        "lanes",
+        metrics_store.Selection(instruments=["LH00534"], start="2024-01-01"),
+        columns=["density"],
+    )
+
+    assert list(df.columns) == ["run_id", "run_date", "density"]
+    assert set(df["run_id"]) == {"240201_LH00534_0002_AHBBBBBBXX"}
+
+
+def test_query_rejects_unknown_tables(tmp_path):
+    with pytest.raises(ValueError, match="Unknown metrics table"):
+        metrics_store.query(tmp_path, "flowcells")
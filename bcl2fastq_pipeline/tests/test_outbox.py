@@ -0,0 +1,120 @@
+import smtplib
+import threading
+import time
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pytest
+
+from bcl2fastq_pipeline.outbox import Outbox
+
+
+def test_spooled_message_has_crlf_line_endings(tmp_path):
+    report = tmp_path / "report.html"
+    report.write_bytes(bytes(range(256)) * 1000)
+    msg = MIMEMultipart()
+    msg["Subject"] = "240415_A01990_0001_AHBENCHDSXC finished"
+    msg["From"] = "bfq@example.org"
+    msg["To"] = "gcf@example.org"
+    msg.attach(MIMEText("Line one\nLine two\n"))
+
+    box = Outbox(tmp_path / "outbox", "localhost")
+    msg_id = box.enqueue(msg, [(report, "report.html")])
+
+    raw = (tmp_path / "outbox" / "queue" / f"{msg_id}.eml").read_bytes()
+    assert raw.count(b"\n") == raw.count(b"\r\n")
+    assert raw.count(b"\r\n") > 3000
+
+
+class RefusingSMTP:
+    def __init__(self, error):
+        self.error = error
+
+    def sendmail(self, *args):
+        raise self.error
+
+    def quit(self):
+        pass
+
+
+def _queued(tmp_path):
+    msg = MIMEText("body")
+    msg["Subject"] = "subject"
+    msg["From"] = "bfq@example.org"
+    msg["To"] = "gcf@example.org"
+    box = Outbox(tmp_path / "outbox", "localhost")
+    return box, box.enqueue(msg)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        smtplib.SMTPRecipientsRefused({"gcf@example.org": (550, b"No such user")}),
+        smtplib.SMTPSenderRefused(553, b"Sender rejected", "bfq@example.org"),
+        smtplib.SMTPDataError(552, b"Message size exceeds fixed limit"),
+    ],
+)
+def test_permanent_failures_are_not_retried(tmp_path, monkeypatch, error):
+    box, msg_id = _queued(tmp_path)
+    monkeypatch.setattr(box, "_connection", lambda: RefusingSMTP(error))
+    box.flush()
+    assert (tmp_path / "outbox" / "failed" / f"{msg_id}.eml").exists()
+    assert not box.pending()
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        smtplib.SMTPDataError(451, b"Try again later"),
+        smtplib.SMTPServerDisconnected("Connection unexpectedly closed"),
+        ConnectionRefusedError(111, "Connection refused"),
+    ],
+)
+def test_temporary_failures_are_retried(tmp_path, monkeypatch, error):
+    box, msg_id = _queued(tmp_path)
+    monkeypatch.setattr(box, "_connection", lambda: RefusingSMTP(error))
+    box.flush()
+    [delivery] = box.pending()
+    assert delivery.status == "retrying" and delivery.attempts == 1
+
+
+class SlowSMTP:
+    def __init__(self, sent):
+        self.sent = sent
+
+    def sendmail(self, sender, rcpts, raw):
+        time.sleep(0.2)
+        self.sent.append(raw)
+
+    def quit(self):
+        pass
+
+
+def test_shared_spool_sends_each_message_once(tmp_path, monkeypatch):
+    box, msg_id = _queued(tmp_path)
+    other = Outbox(tmp_path / "outbox", "localhost")
+    sent = []
+    for b in (box, other):
+        monkeypatch.setattr(b, "_connection", lambda: SlowSMTP(sent))
+    threads = [threading.Thread(target=b.flush) for b in (box, other)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(sent) == 1
+    assert (tmp_path / "outbox" / "sent" / f"{msg_id}.eml").exists()
+    assert not list((tmp_path / "outbox" / "leases").iterdir())
+
+
+def test_message_leased_by_another_instance_is_skipped(tmp_path, monkeypatch):
+    box, msg_id = _queued(tmp_path)
+    other = Outbox(tmp_path / "outbox", "localhost")
+    claim = other.claims.acquire(f"mail-{msg_id}")
+    sent = []
+    monkeypatch.setattr(box, "_connection", lambda: SlowSMTP(sent))
+    box.flush()
+    assert not sent and len(box.pending()) == 1
+    other.claims.release(claim)
+    box.flush()
+    assert len(sent) == 1 and not box.pending()
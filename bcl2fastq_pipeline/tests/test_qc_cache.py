@@ -0,0 +1,80 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from bcl2fastq_pipeline import manifest, qc_cache, workspace
+
+
+@pytest.fixture
+def cfg(demuxed, tmp_path, monkeypatch):
+    monkeypatch.setattr(workspace, "tree_digest", lambda: "workflows")
+    demuxed.static.system["qc_cache_dir"] = tmp_path / "cache"
+    demuxed.run = SimpleNamespace(
+        libprep="Lexogen", libprep_info=SimpleNamespace(entry={}), pipeline="rnaseq"
+    )
+    m = manifest.build_manifest(demuxed)
+    for f in m.files.values():
+        f.md5 = f"md5-{f.path}"
+    return demuxed
+
+
+def _write_bfq(analysis_dir: Path) -> Path:
+    bfq = analysis_dir / "data" / "tmp" / "rnaseq" / "bfq"
+    for rel in (
+        "fastqc/S01-0001_R1_fastqc.zip",
+        "S01-0002/qc.txt",
+        "S01-0002.log",
+        "multiqc_report.html",
+    ):
+        (bfq / rel).parent.mkdir(parents=True, exist_ok=True)
+        (bfq / rel).write_text(rel)
+    return bfq
+
+
+def test_files_belong_to_the_longest_matching_sample(tmp_path):
+    for rel in ("S1_fastqc.zip", "S1_2_fastqc.zip", "S1_2/x.txt", "S10.txt", "report.html"):
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text("")
+
+    assert qc_cache.sample_files(tmp_path, ["S1", "S1_2"]) == {
+        "S1": [Path("S1_fastqc.zip")],
+        "S1_2": [Path("S1_2/x.txt"), Path("S1_2_fastqc.zip")],
+    }
+
+
+def test_stored_output_is_restored_in_another_run(cfg, tmp_path):
+    _write_bfq(tmp_path / "first")
+
+    assert qc_cache.store(cfg, "GCF-2024-001", tmp_path / "first") == 2
+    assert qc_cache.store(cfg, "GCF-2024-001", tmp_path / "first") == 0
+
+    bfq = tmp_path / "second" / "data" / "tmp" / "rnaseq" / "bfq"
+    assert qc_cache.restore(cfg, "GCF-2024-001", tmp_path / "second") == 2
+    restored = sorted(str(p.relative_to(bfq)) for p in bfq.rglob("*") if p.is_file())
+    assert restored == ["S01-0002.log", "S01-0002/qc.txt", "fastqc/S01-0001_R1_fastqc.zip"]
+    assert (bfq / "S01-0002.log").read_text() == "S01-0002.log"
+    first = tmp_path / "first" / "data" / "tmp" / "rnaseq" / "bfq" / "S01-0002.log"
+    assert (bfq / "S01-0002.log").stat().st_ino != first.stat().st_ino
+
+
+def test_changed_inputs_miss_the_cache(cfg, tmp_path):
+    _write_bfq(tmp_path / "first")
+    qc_cache.store(cfg, "GCF-2024-001", tmp_path / "first")
+
+    m = manifest.get_manifest(cfg)
+    next(f for f in m.project_files("GCF-2024-001") if f.sample == "S01-0001").md5 = "changed"
+    next(f for f in m.project_files("GCF-2024-001") if f.sample == "S01-0002").md5 = None
+
+    assert qc_cache.sample_keys(cfg, "GCF-2024-001").keys() == {"S01-0001"}
+    assert qc_cache.restore(cfg, "GCF-2024-001", tmp_path / "second") == 0
+    cfg.run.pipeline = "other"
+    assert qc_cache.restore(cfg, "GCF-2024-001", tmp_path / "second") == 0
+
+
+def test_cache_root_does_not_need_tmpdir_when_configured(monkeypatch, tmp_path):
+    monkeypatch.delenv("TMPDIR", raising=False)
+    cfg = SimpleNamespace(static=SimpleNamespace(system={"qc_cache_dir": str(tmp_path)}))
+    assert qc_cache.cache_root(cfg) == tmp_path
+    cfg.static.system.clear()
+    assert qc_cache.cache_root(cfg) == Path("/tmp/.bfq-qc-cache")
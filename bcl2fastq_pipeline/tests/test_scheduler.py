@@ -0,0 +1,120 @@
+import os
+import time
+
+from types import SimpleNamespace
+
+import pytest
+
+from bcl2fastq_pipeline import scheduler
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    paths = SimpleNamespace(
+        nova_base_dir=tmp_path / "nova",
+        ekista_base_dir=tmp_path / "ekista",
+        output_dir=tmp_path / "output",
+        manager_dir=tmp_path / "manager",
+    )
+    for d in vars(paths).values():
+        d.mkdir()
+    # no runtime term, unless a test sets it
+    return SimpleNamespace(static=SimpleNamespace(paths=paths, system={"queue_runtime_weight": 0}))
+
+
+def add_run(cfg, name: str, hours_ago: float = 0.0, **custom) -> str:
+    """A completed NovaSeq run with the [CustomOptions] custom, completed hours_ago."""
+    run_id = f"{name}_A01990_0001_AHXXXXXXXX"
+    run_dir = cfg.static.paths.nova_base_dir / run_id
+    run_dir.mkdir()
+    options = "".join(f"{k},{v}\n" for k, v in custom.items())
+    (run_dir / "SampleSheet.csv").write_text(
+        f"[Header]\nDate,2024-04-15\n\n[CustomOptions]\n{options}\n[Data]\nSample_ID\nS1\n"
+    )
+    done = run_dir / "CopyComplete.txt"
+    done.write_text("")
+    t = time.time() - hours_ago * 3600
+    os.utime(done, (t, t))
+    return run_id
+
+
+def order(cfg) -> list[str]:
+    return [r.run_id[:6] for r in scheduler.rank(cfg, scheduler.completed_runs(cfg))]
+
+
+def test_priority_goes_first(cfg):
+    add_run(cfg, "240101")
+    add_run(cfg, "240102", Priority="urgent")
+    add_run(cfg, "240103", Priority="low")
+    assert order(cfg) == ["240102", "240101", "240103"]
+
+
+def test_aging_lets_old_runs_pass(cfg):
+    add_run(cfg, "240101", Priority="high")
+    add_run(cfg, "240102", hours_ago=30)
+    # 30 h x 2 points per hour beats the 50 points of high priority
+    assert order(cfg) == ["240102", "240101"]
+
+
+def test_sensitive_data_bonus(cfg):
+    add_run(cfg, "240101")
+    add_run(cfg, "240102", SensitiveData="true")
+    assert order(cfg) == ["240102", "240101"]
+
+
+def test_runs_of_one_user_are_interleaved(cfg):
+    add_run(cfg, "240101", hours_ago=3, User="alice")
+    add_run(cfg, "240102", hours_ago=2, User="alice")
+    add_run(cfg, "240103", hours_ago=1, User="bob")
+    assert order(cfg) == ["240101", "240103", "240102"]
+
+
+def test_overrides_and_hold(cfg):
+    add_run(cfg, "240101", Priority="urgent")
+    bumped = add_run(cfg, "240102")
+    held = add_run(cfg, "240103", Priority="high")
+    scheduler.write_overrides(cfg, {bumped: "200", held: "hold"})
+
+    runs = scheduler.rank(cfg, scheduler.completed_runs(cfg))
+
+    assert [r.run_id[:6] for r in runs] == ["240102", "240101", "240103"]
+    assert runs[-1].held
+
+
+def test_done_runs_come_last(cfg):
+    done = add_run(cfg, "240101", Priority="urgent")
+    (cfg.static.paths.output_dir / done).mkdir()
+    (cfg.static.paths.output_dir / done / "fastq.made").write_text("")
+    add_run(cfg, "240102")
+    assert order(cfg) == ["240102", "240101"]
+
+
+def test_runtime_estimate_counts_against_a_run(cfg):
+    cfg.static.system["queue_runtime_weight"] = 5
+    short = add_run(cfg, "240101")
+    long = add_run(cfg, "240102")
+    for run_id, cycles in ((short, 50), (long, 300)):
+        (cfg.static.paths.nova_base_dir / run_id / "RunInfo.xml").write_text(
+            f'<RunInfo><Run><Reads><Read Number="1" NumCycles="{cycles}"/></Reads>'
+            '<FlowcellLayout LaneCount="2"/></Run></RunInfo>'
+        )
+    assert order(cfg) == ["240101", "240102"]
+
+
+def test_run_removed_after_discovery_is_left_out(cfg):
+    add_run(cfg, "240101")
+    gone = add_run(cfg, "240102")
+    discovered = scheduler.completed_runs(cfg)
+    (cfg.static.paths.nova_base_dir / gone / "CopyComplete.txt").unlink()
+
+    assert [r.run_id[:6] for r in scheduler.rank(cfg, discovered)] == ["240101"]
+
+
+def test_queue_ranks_again_after_each_run(cfg):
+    add_run(cfg, "240101")
+    seen = []
+    for completion_file in scheduler.queue(cfg, scheduler.completed_runs):
+        seen.append(completion_file.parent.name[:6])
+        if len(seen) == 1:
+            add_run(cfg, "240102", Priority="urgent")
+    assert seen == ["240101", "240102"]
@@ -0,0 +1,104 @@
+import os
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from bcl2fastq_pipeline import staging
+
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch):
+    """A small run folder whose larger files span several chunks."""
+    monkeypatch.setattr(staging, "CHUNK_SIZE", 1000)
+    monkeypatch.setattr(staging, "BUFFER_SIZE", 300)
+    run_dir = tmp_path / "seq" / "240415_A01990_0001_AHBENCHDSXC"
+    bcl = run_dir / "Data" / "Intensities" / "BaseCalls" / "L001"
+    bcl.mkdir(parents=True)
+    for i in range(3):
+        (bcl / f"C{i}.1.cbcl").write_bytes(os.urandom(2500 + i))
+    (run_dir / "RunInfo.xml").write_text("<RunInfo/>")
+    (run_dir / "empty.txt").write_bytes(b"")
+    (run_dir / "Thumbnail_Images").mkdir()
+    (run_dir / "Thumbnail_Images" / "s_1.jpg").write_bytes(b"jpg")
+    return run_dir
+
+
+def _files(root: Path) -> dict[str, bytes]:
+    return {
+        str(p.relative_to(root)): p.read_bytes()
+        for p in root.rglob("*")
+        if p.is_file() and p.name != staging.DONE
+    }
+
+
+def test_copy_is_verified_and_reused(run_dir, tmp_path):
+    job = staging.Prefetch(run_dir, tmp_path / "scratch" / run_dir.name)
+
+    staging.copy_run(job, streams=4)
+
+    expected = {k: v for k, v in _files(run_dir).items() if not k.startswith("Thumbnail")}
+    assert _files(job.copy) == expected
+    assert (job.files, job.bytes) == (5, sum(map(len, expected.values())))
+    src, dst = run_dir / "RunInfo.xml", job.copy / "RunInfo.xml"
+    assert dst.stat().st_mtime_ns == src.stat().st_mtime_ns
+
+    marker = (job.copy / staging.DONE).stat().st_mtime_ns
+    again = staging.Prefetch(run_dir, job.copy)
+    staging.copy_run(again)
+    assert (job.copy / staging.DONE).stat().st_mtime_ns == marker
+    assert again.bytes == job.bytes
+
+
+def test_corrupted_copy_fails_the_crc_check(run_dir, tmp_path, monkeypatch):
+    job = staging.Prefetch(run_dir, tmp_path / "scratch" / run_dir.name)
+    crc_chunk = staging._crc_chunk
+
+    def flip_a_byte(path, offset, length):
+        if offset == 1000 and path.name == "C1.1.cbcl":
+            with path.open("r+b") as fh:
+                fh.seek(offset)
+                byte = fh.read(1)
+                fh.seek(offset)
+                fh.write(bytes([byte[0] ^ 0xFF]))
+        return crc_chunk(path, offset, length)
+
+    monkeypatch.setattr(staging, "_crc_chunk", flip_a_byte)
+
+    with pytest.raises(staging.PrefetchError, match="Checksum mismatch in 1 chunks.*C1.1.cbcl"):
+        staging.copy_run(job, streams=4)
+    assert not (job.copy / staging.DONE).exists()
+
+
+def test_source_changed_during_the_copy_fails(run_dir, tmp_path, monkeypatch):
+    job = staging.Prefetch(run_dir, tmp_path / "scratch" / run_dir.name)
+    copy_chunk = staging._copy_chunk
+
+    def touch_source(src, dst, offset, length, cancel):
+        crc = copy_chunk(src, dst, offset, length, cancel)
+        if src.name == "RunInfo.xml":
+            os.utime(src, ns=(0, 0))
+        return crc
+
+    monkeypatch.setattr(staging, "_copy_chunk", touch_source)
+
+    with pytest.raises(staging.PrefetchError, match="RunInfo.xml changed during the prefetch"):
+        staging.copy_run(job)
+
+
+def test_demultiplexer_reads_the_copy(run_dir, tmp_path):
+    cfg = SimpleNamespace(
+        static=SimpleNamespace(paths=SimpleNamespace(scratch_dir=tmp_path / "scratch"), system={}),
+        run=SimpleNamespace(run_id=run_dir.name, flowcell_path=run_dir),
+    )
+    stager = staging.Stager()
+
+    copy = stager.input_dir(cfg)
+
+    assert copy == tmp_path / "scratch" / "prefetch" / run_dir.name
+    assert (copy / staging.DONE).exists()
+    stager.done_reading(run_dir.name)
+    stager.release(run_dir.name)
+    assert not copy.exists()
+    assert stager.jobs == {}
@@ -0,0 +1,82 @@
+import io
+import json
+
+import pytest
+
+from bcl2fastq_pipeline.stats_json import _Scanner
+
+from bcl2fastq_pipeline import stats_json
+
+DOCUMENT = {
+    "ints": [0, 7, -12, 123456789012],
+    "floats": [12.5, -0.25, 3.0, 1234.5678, 0.0001],
+    "exponents": [1e5, 2.5e-7, -6.02e23, 1e2],
+    "strings": ["", "plain", 'quote " inside', "back\\slash", "brace { [ ] }", "ünïcode"],
+    "literals": [True, False, None],
+    "nested": {"a": [{"b": 1.5}, [], {}], "c": "x"},
+}
+TEXT = json.dumps(DOCUMENT, indent=1).replace("100000.0", "1e5").replace("100.0", "1E+2")
+
+
+def walk(sc):
+    """The next value, read through iter_object and iter_array as parse() does."""
+    ch = sc.peek()
+    if ch == "{":
+        return {key: walk(sc) for key in sc.iter_object()}
+    if ch == "[":
+        return [walk(sc) for _ in sc.iter_array()]
+    return sc.read_value()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 16])
+def test_values_split_over_chunks(chunk_size):
+    assert walk(_Scanner(io.StringIO(TEXT), chunk_size)) == json.loads(TEXT)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 16])
+@pytest.mark.parametrize("key", list(DOCUMENT))
+def test_skip_value_over_chunks(chunk_size, key):
+    sc = _Scanner(io.StringIO(TEXT), chunk_size)
+    found = {}
+    for k in sc.iter_object():
+        if k == key:
+            found[k] = walk(sc)
+        else:
+            sc.skip_value()
+    assert found == {key: json.loads(TEXT)[key]}
+
+
+@pytest.mark.parametrize("text", ["12.5", "-3.25e-4", "6E+23", "1234567", "0.5"])
+def test_number_at_every_split(text):
+    doc = f'{{"v": {text}, "w": 1}}'
+    for split in range(1, len(doc)):
+        fh = io.StringIO(doc)
+        sc = _Scanner(fh, split)
+        assert walk(sc) == json.loads(doc), split
+
+
+def test_parse_with_small_chunks(tmp_path, monkeypatch):
+    stats = {
+        "Flowcell": "HBENCHDSXC",
+        "RunId": "240415_A01990_0001_AHBENCHDSXC",
+        "ReadInfosForLanes": [{"LaneNumber": 1, "ReadInfos": [{"Number": 1, "NumCycles": 51}]}],
+        "ConversionResults": [
+            {
+                "LaneNumber": 1,
+                "TotalClustersRaw": 1000,
+                "TotalClustersPF": 812,
+                "Yield": 82812.0,
+                "DemuxResults": [{"SampleId": "S1", "NumberReads": 700}],
+                "Undetermined": {"NumberReads": 112, "Yield": 11424},
+            }
+        ],
+        "UnknownBarcodes": [{"Lane": 1, "Barcodes": {"AAAA": 50, "CCCC": 60, "GGGG": 2}}],
+    }
+    path = tmp_path / "Stats.json"
+    path.write_text(json.dumps(stats, indent=2))
+    expected = stats_json.parse(path)
+    for chunk_size in (1, 3, 7):
+        monkeypatch.setattr(stats_json, "CHUNK_SIZE", chunk_size)
+        assert stats_json.parse(path) == expected
+    assert expected.lanes[0].yield_bp == 82812
+    assert expected.unknown_barcodes[1][:2] == [("CCCC", 60), ("AAAA", 50)]
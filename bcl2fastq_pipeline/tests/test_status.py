@@ -0,0 +1,96 @@
+import json
+import socket
+import urllib.error
+import urllib.request
+
+from types import SimpleNamespace
+
+import pytest
+
+from bcl2fastq_pipeline import status, tracing
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    paths = SimpleNamespace(
+        log_dir=tmp_path,
+        output_dir=tmp_path,
+        nova_base_dir=tmp_path,
+        ekista_base_dir=tmp_path,
+        scratch_dir=None,
+    )
+    cfg = SimpleNamespace(
+        static=SimpleNamespace(paths=paths, system={}),
+        run=SimpleNamespace(run_id="240415_A01990_0001_AHBENCHDSXC", libprep="Lexogen"),
+    )
+    tracing.configure(cfg)
+    yield cfg
+    tracing.end_run()
+    tracing._tracer.log_dir = None
+
+
+@pytest.fixture
+def board(cfg):
+    board = status.StatusBoard()
+    tracing.add_listener(board.on_span)
+    yield board
+    tracing.remove_listener(board.on_span)
+
+
+def test_stages_of_a_run_are_tracked(cfg, board):
+    board.set_queue(["/nova/a", "/nova/b"])
+    tracing.begin_run(cfg)
+    with tracing.span("bcl2fq", bytes=100):
+        with tracing.span("bcl-convert"):
+            pass
+    with tracing.span("validate"):
+        running = board.as_json()["runs"][cfg.run.run_id]
+        assert running["stage"] == "validate"
+        assert running["stage_elapsed"] >= 0
+    tracing.end_run()
+
+    snap = board.as_json()
+    run = snap["runs"][cfg.run.run_id]
+    assert snap["queue"] == ["/nova/a", "/nova/b"]
+    assert (run["status"], run["stage"], run["libprep"]) == ("ok", None, "Lexogen")
+    assert [(s["name"], s["status"]) for s in run["stages"]] == [
+        ("bcl2fq", "ok"),
+        ("validate", "ok"),
+    ]
+    assert snap["bytes_processed"] == {"bcl2fq": 100}
+    assert snap["runs_total"] == {"ok": 1}
+
+
+def test_prometheus_text(cfg, board):
+    board.disk_paths = {"output": cfg.static.paths.output_dir}
+    tracing.begin_run(cfg)
+    with tracing.span("bcl2fq"):
+        text = board.as_prometheus()
+    tracing.end_run()
+
+    assert "# TYPE bfq_stage_active gauge" in text
+    assert f'bfq_stage_active{{run="{cfg.run.run_id}",stage="bcl2fq"}} 1' in text
+    assert f'bfq_disk_free_bytes{{name="output",path="{cfg.static.paths.output_dir}"}}' in text
+    assert 'bfq_runs_total{status="ok"} 1' in board.as_prometheus()
+
+
+def test_escape():
+    assert status._escape('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+
+def test_server(cfg):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    cfg.static.system["status_port"] = port
+    status.serve(cfg)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/status") as r:
+            assert "queue" in json.load(r)
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as r:
+            assert r.headers["Content-Type"].startswith("text/plain")
+        with pytest.raises(urllib.error.HTTPError, match="404"):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other")
+    finally:
+        status._servers.pop(port).shutdown()
+        tracing.remove_listener(status.board().on_span)
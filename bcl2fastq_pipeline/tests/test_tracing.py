@@ -0,0 +1,76 @@
+import json
+import subprocess
+import sys
+import threading
+
+from types import SimpleNamespace
+
+import pytest
+
+from bcl2fastq_pipeline import tracing
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    cfg = SimpleNamespace(
+        static=SimpleNamespace(paths=SimpleNamespace(log_dir=tmp_path), system={}),
+        run=SimpleNamespace(run_id="240415_A01990_0001_AHBENCHDSXC", libprep="Lexogen"),
+    )
+    tracing.configure(cfg)
+    yield cfg
+    tracing.end_run()
+    tracing._tracer.log_dir = None
+
+
+def _spans(cfg, name: str = "trace.jsonl") -> dict[str, dict]:
+    lines = (cfg.static.paths.log_dir / name).read_text().splitlines()
+    return {s["name"]: s for s in map(json.loads, lines)}
+
+
+def test_failed_run_is_closed_with_the_error_and_later_spans_are_not_its_children(cfg):
+    tracing.begin_run(cfg)
+    try:
+        with tracing.span("bcl2fq"):
+            raise RuntimeError("bcl-convert failed")
+    except RuntimeError:
+        pass
+    finally:
+        tracing.end_run()
+    with tracing.span("discovery"):
+        pass
+
+    spans = _spans(cfg)
+    assert spans["bcl2fq"]["parent_id"] == spans["run"]["span_id"]
+    assert spans["bcl2fq"]["error"] == "RuntimeError: bcl-convert failed"
+    assert spans["run"]["status"] == "error"
+    assert spans["discovery"]["parent_id"] is None
+    assert spans["discovery"]["run_id"] is None
+    assert "discovery" not in _spans(cfg, f"{cfg.run.run_id}.trace.jsonl")
+
+
+def test_spans_in_pool_threads_keep_their_parent(cfg):
+    def snakemake():
+        with tracing.span("snakemake"):
+            pass
+
+    tracing.begin_run(cfg)
+    with tracing.span("full_align"):
+        t = threading.Thread(target=tracing.propagate(snakemake))
+        t.start()
+        t.join()
+    tracing.end_run()
+
+    spans = _spans(cfg)
+    assert spans["snakemake"]["parent_id"] == spans["full_align"]["span_id"]
+    assert spans["full_align"]["parent_id"] == spans["run"]["span_id"]
+    assert spans["run"]["status"] == "ok"
+
+
+def test_check_call_records_the_return_code(cfg):
+    with pytest.raises(subprocess.CalledProcessError):
+        tracing.check_call([sys.executable, "-c", "raise SystemExit(3)"], name="bcl-convert")
+
+    span = _spans(cfg)["bcl-convert"]
+    assert span["attrs"]["returncode"] == 3
+    assert span["attrs"]["pid"] > 0
+    assert span["status"] == "error"
@@ -0,0 +1,78 @@
+import gzip
+import json
+
+import pytest
+
+from bcl2fastq_pipeline import manifest, validate
+
+RECORD = b"@r\nACGT\n+\nIIII\n"
+
+
+def test_multi_member_gzip_is_counted_across_chunks(tmp_path):
+    path = tmp_path / "S1_R1.fastq.gz"
+    # three members, like bgzf, split at arbitrary points by the small chunk size
+    path.write_bytes(b"".join(gzip.compress(RECORD * n) for n in (3, 1, 5)))
+
+    check = validate.count_fastq_records(path, chunk_size=7)
+
+    assert check.error is None
+    assert check.reads == 9
+
+
+def test_truncated_gzip_fails(tmp_path):
+    path = tmp_path / "S1_R1.fastq.gz"
+    data = gzip.compress(RECORD * 100)
+    path.write_bytes(data[: len(data) - 6])
+
+    check = validate.count_fastq_records(path)
+
+    assert check.reads is None
+    assert "truncated" in check.error
+
+
+def test_incomplete_record_fails(tmp_path):
+    path = tmp_path / "S1_R1.fastq.gz"
+    path.write_bytes(gzip.compress(RECORD * 2 + b"@r\nACGT\n"))
+
+    assert "not a multiple of 4" in validate.count_fastq_records(path).error
+
+
+def test_empty_file_fails(tmp_path):
+    path = tmp_path / "S1_R1.fastq.gz"
+    path.write_bytes(b"")
+
+    assert validate.count_fastq_records(path).error
+
+
+def test_run_matching_the_demux_stats_passes_and_is_cached(demuxed):
+    manifest.build_manifest(demuxed)
+
+    checks = validate.validate_fastqs(demuxed)
+
+    assert all(c.reads == 10 for rel, c in checks.items() if "GCF-" in rel)
+    cache = json.loads((demuxed.output_path / validate.CACHE_NAME).read_text())
+    assert set(cache) == set(checks)
+    fq = next(f for f in manifest.get_manifest(demuxed).files.values() if f.project)
+    assert fq.reads == 10
+
+
+def test_count_mismatch_with_the_demux_stats_fails(demuxed):
+    [fq] = demuxed.output_path.glob("GCF-2024-001/S01-0001_*_R1_001.fastq.gz")
+    [mate] = demuxed.output_path.glob("GCF-2024-001/S01-0001_*_R2_001.fastq.gz")
+    for f in (fq, mate):
+        f.write_bytes(gzip.compress(RECORD * 9))
+    manifest.build_manifest(demuxed)
+
+    with pytest.raises(
+        validate.FastqValidationError, match="9 reads in fastq, 10 in demultiplexing"
+    ):
+        validate.validate_fastqs(demuxed)
+
+
+def test_unequal_mates_fail(demuxed):
+    [fq] = demuxed.output_path.glob("GCF-2024-002/S02-0001_*_R2_001.fastq.gz")
+    fq.write_bytes(gzip.compress(RECORD * 4))
+    manifest.build_manifest(demuxed)
+
+    with pytest.raises(validate.FastqValidationError, match="unequal read counts"):
+        validate.validate_fastqs(demuxed)
@@ -0,0 +1,128 @@
+import os
+import time
+
+from pathlib import Path
+
+import pytest
+
+from bcl2fastq_pipeline import workspace
+
+FAKE_CONFIGMAKER = """\
+import os
+import sys
+
+if __name__ == "__main__":
+    if "--fail" in sys.argv:
+        sys.exit(3)
+    print("configmaker output")
+    with open("config.yaml", "w") as fh:
+        fh.write(" ".join(sys.argv[1:]) + " " + str(os.getpid()))
+"""
+
+
+@pytest.fixture
+def tmpdir_env(tmp_path, monkeypatch):
+    src = tmp_path / "gcf-workflows"
+    (src / "rules").mkdir(parents=True)
+    (src / "Snakefile").write_text("include: 'rules/qc.smk'\n")
+    (src / "rules" / "qc.smk").write_text("rule qc:\n")
+    monkeypatch.setenv("TMPDIR", str(tmp_path / "tmp"))
+    (tmp_path / "tmp").mkdir()
+    return src
+
+
+def _edit(src: Path, n: int) -> None:
+    # a subdirectory only, the mtime of src itself stays the same
+    (src / "rules" / "qc.smk").write_text(f"rule qc_{n}:\n")
+
+
+def test_snapshot_is_reused_until_the_sources_change(tmpdir_env):
+    first = workspace.snapshot(tmpdir_env)
+    assert workspace.snapshot(tmpdir_env) == first
+    _edit(tmpdir_env, 1)
+    second = workspace.snapshot(tmpdir_env)
+    assert second != first
+    assert (second / "rules" / "qc.smk").read_text() == "rule qc_1:\n"
+
+
+def test_snapshot_never_prunes_what_it_returns(tmpdir_env):
+    for n in range(30):
+        _edit(tmpdir_env, n)
+        snap = workspace.snapshot(tmpdir_env)
+        assert snap.is_dir()
+    root = Path(os.environ["TMPDIR"]) / ".gcf-workflows"
+    assert len([d for d in root.iterdir() if not d.name.startswith(".")]) == 3
+
+
+def test_snapshot_keeps_the_last_used(tmpdir_env):
+    first = workspace.snapshot(tmpdir_env)
+    _edit(tmpdir_env, 1)
+    second = workspace.snapshot(tmpdir_env)
+    time.sleep(0.01)
+    # back to the first content, which makes the first snapshot the last used
+    (tmpdir_env / "rules" / "qc.smk").write_text("rule qc:\n")
+    assert workspace.snapshot(tmpdir_env) == first
+    for n in (2, 3):
+        time.sleep(0.01)
+        _edit(tmpdir_env, n)
+        workspace.snapshot(tmpdir_env)
+    assert first.is_dir()
+    assert not second.exists()
+
+
+def test_snapshots_linked_by_an_analysis_dir_are_kept(tmpdir_env):
+    analysis_dir = Path(os.environ["TMPDIR"]) / "GCF-2024-001_240415"
+    link = workspace.provision(analysis_dir, tmpdir_env)
+    linked = link.readlink()
+    for n in range(5):
+        _edit(tmpdir_env, n)
+        workspace.snapshot(tmpdir_env)
+    assert linked.is_dir()
+    assert (link / "Snakefile").exists()
+
+
+def test_provision_relinks_to_the_current_snapshot(tmpdir_env):
+    analysis_dir = Path(os.environ["TMPDIR"]) / "GCF-2024-001_240415"
+    link = workspace.provision(analysis_dir, tmpdir_env)
+    assert link.is_symlink() and link.readlink() == workspace.snapshot(tmpdir_env)
+    _edit(tmpdir_env, 1)
+    workspace.provision(analysis_dir, tmpdir_env)
+    assert (link / "rules" / "qc.smk").read_text() == "rule qc_1:\n"
+
+
+@pytest.fixture
+def fake_configmaker(tmp_path, monkeypatch):
+    pkg = tmp_path / "site" / "configmaker"
+    pkg.mkdir(parents=True)
+    (pkg / "__init__.py").write_text("")
+    (pkg / "configmaker.py").write_text(FAKE_CONFIGMAKER)
+    package_root = Path(__file__).resolve().parents[1]
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join([str(pkg.parent), str(package_root)]))
+    yield
+    worker = workspace._workers.pop("configmaker", None)
+    if worker is not None:
+        worker.stdin.close()
+        worker.wait()
+
+
+def test_run_configmaker_writes_to_the_analysis_dir(tmp_path, fake_configmaker):
+    cwd = os.getcwd()
+    pids = set()
+    for p in ("GCF-2024-001", "GCF-2024-002"):
+        analysis_dir = tmp_path / p
+        analysis_dir.mkdir()
+        workspace.run_configmaker(analysis_dir, ["/output", "-p", p])
+        args = (analysis_dir / "config.yaml").read_text().split()
+        assert args[:3] == ["/output", "-p", p]
+        pids.add(args[3])
+    assert os.getcwd() == cwd
+    # one worker for all projects
+    assert len(pids) == 1
+
+
+def test_run_configmaker_raises_on_failure(tmp_path, fake_configmaker):
+    with pytest.raises(RuntimeError, match="exit code 3"):
+        workspace.run_configmaker(tmp_path, ["--fail"])
+    # the worker is still usable afterwards
+    workspace.run_configmaker(tmp_path, ["/output"])
+    assert (tmp_path / "config.yaml").exists()